@@ -1,186 +1,75 @@
 import streamlit as st
-import json
+import argparse
 import os
-from datetime import datetime
+import sys
+import io
+import tempfile
+import time
+from datetime import datetime, timedelta
 from PIL import Image
-import hashlib
 import plotly.express as px
+import plotly.io as pio
 import pandas as pd
 
-class SistemaFinanceiro:
-    def __init__(self, usuario):
-        self.usuario = usuario
-        self.dados = {
-            'faturamentos': [],
-            'custos': {'categorias': {}},
-            'lucros': []
-        }
-        self.carregar_dados()
+from gestor_financeiro import (
+    CacheGraficos,
+    CacheLedgers,
+    DiretorioUsuarios,
+    FORMATOS_EXPORTACAO,
+    FREQUENCIAS_RECORRENCIA,
+    ImportadorLancamentos,
+    LotePrevisoes,
+    PREVISAO_HORIZONTE,
+    RelatorioConsolidado,
+    SistemaFinanceiro,
+    armazenamento_existente,
+    exportar,
+    iniciar_servidor_metricas,
+    metricas,
+    migrar_para_sqlite,
+    reduzir_serie,
+)
 
-    def carregar_dados(self):
-        if not os.path.exists('dados_usuarios'):
-            os.makedirs('dados_usuarios')
-            
-        arquivo_usuario = f'dados_usuarios/{self.usuario}_dados.json'
-        if os.path.exists(arquivo_usuario):
-            with open(arquivo_usuario, 'r') as f:
-                self.dados = json.load(f)
-
-    def salvar_dados(self):
-        arquivo_usuario = f'dados_usuarios/{self.usuario}_dados.json'
-        with open(arquivo_usuario, 'w') as f:
-            json.dump(self.dados, f, indent=4)
-
-    def adicionar_faturamento(self, valor, descricao, data=None):
-        if data is None:
-            data = datetime.now().strftime('%Y-%m-%d')
-        
-        self.dados['faturamentos'].append({
-            'valor': float(valor),
-            'descricao': descricao,
-            'data': data
-        })
-        self.salvar_dados()
-        self.calcular_lucros()
-
-    def remover_faturamento(self, index):
-        if 0 <= index < len(self.dados['faturamentos']):
-            removed = self.dados['faturamentos'].pop(index)
-            self.salvar_dados()
-            self.calcular_lucros()
-            return removed
-        return None
-
-    def adicionar_custo(self, categoria, valor, descricao, data=None, subcategoria=None):
-        if data is None:
-            data = datetime.now().strftime('%Y-%m-%d')
-        
-        registro = {
-            'valor': float(valor),
-            'descricao': descricao,
-            'data': data
-        }
-        
-        if subcategoria:
-            if categoria not in self.dados['custos']['categorias']:
-                self.dados['custos']['categorias'][categoria] = {'subcategorias': {}}
-            
-            if 'subcategorias' not in self.dados['custos']['categorias'][categoria]:
-                self.dados['custos']['categorias'][categoria]['subcategorias'] = {}
-                
-            if subcategoria not in self.dados['custos']['categorias'][categoria]['subcategorias']:
-                self.dados['custos']['categorias'][categoria]['subcategorias'][subcategoria] = []
-            
-            self.dados['custos']['categorias'][categoria]['subcategorias'][subcategoria].append(registro)
-        else:
-            if categoria not in self.dados['custos']['categorias']:
-                self.dados['custos']['categorias'][categoria] = {'registros': []}
-            
-            if 'registros' not in self.dados['custos']['categorias'][categoria]:
-                self.dados['custos']['categorias'][categoria]['registros'] = []
-                
-            self.dados['custos']['categorias'][categoria]['registros'].append(registro)
-        
-        self.salvar_dados()
-        self.calcular_lucros()
+@st.cache_resource
+def cache_ledgers():
+    # st.cache_resource mantém a mesma instância entre reruns e sessões do processo
+    return CacheLedgers(
+        max_usuarios=int(os.environ.get('GESTOR_CACHE_USUARIOS', 64)),
+        max_bytes=int(os.environ.get('GESTOR_CACHE_MB', 256)) * 1024 * 1024
+    )
 
-    def remover_custo(self, categoria, index, subcategoria=None):
-        if categoria in self.dados['custos']['categorias']:
-            if subcategoria:
-                if 'subcategorias' in self.dados['custos']['categorias'][categoria] and \
-                   subcategoria in self.dados['custos']['categorias'][categoria]['subcategorias']:
-                    if 0 <= index < len(self.dados['custos']['categorias'][categoria]['subcategorias'][subcategoria]):
-                        removed = self.dados['custos']['categorias'][categoria]['subcategorias'][subcategoria].pop(index)
-                        self.salvar_dados()
-                        self.calcular_lucros()
-                        return removed
-            else:
-                if 'registros' in self.dados['custos']['categorias'][categoria]:
-                    if 0 <= index < len(self.dados['custos']['categorias'][categoria]['registros']):
-                        removed = self.dados['custos']['categorias'][categoria]['registros'].pop(index)
-                        self.salvar_dados()
-                        self.calcular_lucros()
-                        return removed
-        return None
+@st.cache_resource
+def diretorio_usuarios():
+    return DiretorioUsuarios()
 
-    def calcular_lucros(self):
-        total_faturamento = sum(f['valor'] for f in self.dados['faturamentos'])
-        total_custos = self.calcular_total_custos()
-        
-        lucro = total_faturamento - total_custos
-        
-        self.dados['lucros'].append({
-            'data': datetime.now().strftime('%Y-%m-%d'),
-            'lucro': lucro,
-            'faturamento_total': total_faturamento,
-            'custos_total': total_custos
-        })
-        self.salvar_dados()
-
-    def calcular_total_custos(self):
-        total = 0
-        for categoria, dados in self.dados['custos']['categorias'].items():
-            if 'registros' in dados:
-                total += sum(r['valor'] for r in dados['registros'])
-            if 'subcategorias' in dados:
-                for subcat, registros in dados['subcategorias'].items():
-                    total += sum(r['valor'] for r in registros)
-        return total
+@st.cache_resource
+def cache_graficos():
+    return CacheGraficos(max_bytes=int(os.environ.get('GESTOR_CACHE_GRAFICOS_MB', 64)) * 1024 * 1024)
 
-    def distribuir_custos_porcentagem(self, categoria, porcentagens):
-        total = sum(p for p in porcentagens.values())
-        if abs(total - 100) > 0.01:
-            st.error(f"Erro: A soma das porcentagens deve ser 100% (atual: {total}%)")
-            return
-        
-        for subcat, porcentagem in porcentagens.items():
-            valor_total_categoria = self.calcular_total_categoria(categoria)
-            valor_subcat = valor_total_categoria * (porcentagem / 100)
-            self.adicionar_custo(categoria, valor_subcat, f"Alocação de {porcentagem}% para {subcat}", subcategoria=subcat)
-        st.success("Custos distribuídos com sucesso!")
+def dados_grafico(sistema, nome, parametros, calcular):
+    # Dados agregados de um gráfico, recalculados só quando o ledger (versão) ou os parâmetros mudam
+    return cache_graficos().obter((sistema.usuario, sistema.versao(), 'dados', nome) + parametros, calcular)
 
-    def calcular_total_categoria(self, categoria):
-        total = 0
-        if categoria in self.dados['custos']['categorias']:
-            dados = self.dados['custos']['categorias'][categoria]
-            if 'registros' in dados:
-                total += sum(r['valor'] for r in dados['registros'])
-            if 'subcategorias' in dados:
-                for subcat, registros in dados['subcategorias'].items():
-                    total += sum(r['valor'] for r in registros)
-        return total
-
-def carregar_usuarios():
-    if not os.path.exists('dados_usuarios'):
-        os.makedirs('dados_usuarios')
-        
-    if os.path.exists('dados_usuarios/usuarios.json'):
-        with open('dados_usuarios/usuarios.json', 'r') as f:
-            return json.load(f)
-    return {}
-
-def salvar_usuarios(usuarios):
-    if not os.path.exists('dados_usuarios'):
-        os.makedirs('dados_usuarios')
-        
-    with open('dados_usuarios/usuarios.json', 'w') as f:
-        json.dump(usuarios, f, indent=4)
-
-def hash_senha(senha):
-    return hashlib.sha256(senha.encode()).hexdigest()
+def mostrar_grafico(sistema, nome, parametros, montar):
+    # A figura fica guardada já serializada em JSON; o Plotly só a monta de novo quando a chave muda
+    def construir():
+        with metricas.medir('ui_grafico_segundos', grafico=nome):
+            return montar().to_json()
+    figura = cache_graficos().obter((sistema.usuario, sistema.versao(), 'figura', nome) + parametros, construir)
+    st.plotly_chart(pio.from_json(figura), use_container_width=True)
 
 def tela_login():
     st.title("🔐 Login - Sistema Financeiro")
 
     aba = st.sidebar.radio("Acesso", ["Login", "Cadastrar"])
 
-    usuarios = carregar_usuarios()
+    usuarios = diretorio_usuarios()
 
     if aba == "Login":
         email = st.text_input("Email", key="login_email")
         senha = st.text_input("Senha", type="password", key="login_senha")
         if st.button("Entrar"):
-            if email in usuarios and usuarios[email]["senha"] == hash_senha(senha):
+            if usuarios.autenticar(email, senha):
                 st.session_state["usuario_logado"] = email
                 st.success(f"Bem-vindo, {email}!")
                 st.rerun()
@@ -195,26 +84,110 @@ def tela_login():
         if st.button("Registrar"):
             if not email.endswith("@e-flow.digital"):
                 st.error("Cadastro permitido apenas para emails @e-flow.digital.")
-            elif email in usuarios:
+            elif usuarios.existe(email):
                 st.warning("Este email já está cadastrado.")
             elif senha != confirmar:
                 st.error("As senhas não coincidem.")
+            elif not usuarios.cadastrar(email, senha):
+                st.warning("Este email já está cadastrado.")
             else:
-                usuarios[email] = {"senha": hash_senha(senha)}
-                salvar_usuarios(usuarios)
                 st.success("Cadastro realizado com sucesso! Agora você pode fazer login.")
                 st.experimental_rerun()
 
+def filtros_registros(sistema, chave):
+    col1, col2, col3, col4 = st.columns([2, 1, 1, 2])
+    with col1:
+        periodo = st.date_input("Período", value=(), key=f"{chave}_periodo")
+    with col2:
+        tipo = st.selectbox("Tipo", ["Todos", "Faturamento", "Custo"], key=f"{chave}_tipo")
+    with col3:
+        categoria = st.selectbox("Categoria", ["Todas"] + sistema.categorias(), key=f"{chave}_categoria")
+    with col4:
+        busca = st.text_input("Buscar na descrição", key=f"{chave}_busca")
+    
+    return {
+        'tipo': None if tipo == "Todos" else tipo,
+        'inicio': periodo[0] if len(periodo) > 0 else None,
+        'fim': periodo[1] if len(periodo) > 1 else None,
+        'categoria': None if categoria == "Todas" else categoria,
+        'busca': busca or None
+    }
+
+def tabela_paginada(sistema, chave, filtros):
+    # Os controles de paginação ficam abaixo da tabela; seus valores vêm do session_state do rerun anterior
+    tamanho = st.session_state.get(f"{chave}_tamanho", 50)
+    pagina = st.session_state.get(f"{chave}_pagina", 1)
+    pagina_df, total = sistema.analise().consultar_registros(**filtros, pagina=pagina - 1, tamanho_pagina=tamanho)
+    
+    paginas = max((total - 1) // tamanho + 1, 1)
+    if pagina > paginas:
+        st.session_state[f"{chave}_pagina"] = pagina = paginas
+        pagina_df, total = sistema.analise().consultar_registros(**filtros, pagina=pagina - 1, tamanho_pagina=tamanho)
+    
+    col1, col2, col3 = st.columns([1, 1, 2])
+    with col1:
+        st.selectbox("Registros por página", [25, 50, 100, 500], index=1, key=f"{chave}_tamanho")
+    with col2:
+        st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1, key=f"{chave}_pagina")
+    with col3:
+        st.caption(f"{total:,} registro(s) encontrados")
+    return pagina_df, total
+
+def formatar_registros(pagina_df):
+    tabela = pd.DataFrame({
+        "Data": pagina_df['data'].dt.strftime('%Y-%m-%d'),
+        "Tipo": pagina_df['tipo'].astype(str),
+        "Categoria": pagina_df['categoria'].astype(object).fillna(''),
+        "Subcategoria": pagina_df['subcategoria'].astype(object).fillna(''),
+        "Descrição": pagina_df['descricao'],
+        "Valor (R$)": pagina_df['valor'].map("{:,.2f}".format)
+    })
+    return tabela.reset_index(drop=True)
+
+@st.cache_resource
+def servidor_metricas():
+    # GESTOR_METRICAS_PORTA expõe /metrics (formato Prometheus) deste processo do Streamlit, só na própria
+    # máquina; o endpoint não tem autenticação, e GESTOR_METRICAS_HOST=0.0.0.0 o abre para a rede
+    porta = os.environ.get('GESTOR_METRICAS_PORTA')
+    host = os.environ.get('GESTOR_METRICAS_HOST', '127.0.0.1')
+    return iniciar_servidor_metricas(int(porta), host) if porta else None
+
+def administradores():
+    # GESTOR_ADMINS: emails separados por vírgula que veem o painel de desempenho
+    return {email.strip() for email in os.environ.get('GESTOR_ADMINS', '').split(',') if email.strip()}
+
+def painel_desempenho(segundos_rerun):
+    with st.sidebar.expander("⏱️ Desempenho"):
+        st.metric("Rerun", f"{segundos_rerun * 1000:,.1f} ms")
+        coleta = metricas.coleta()
+        if coleta:
+            st.dataframe(pd.DataFrame([{
+                'Métrica': nome,
+                'Detalhe': ', '.join(f'{chave}={valor}' for chave, valor in rotulos.items()),
+                'Chamadas': chamadas,
+                'ms': round(segundos * 1000, 2) if segundos else None,
+                'Quantidade': valor or None
+            } for nome, rotulos, chamadas, segundos, valor in coleta]).sort_values('ms', ascending=False),
+                hide_index=True, use_container_width=True)
+        st.write("Cache de ledgers:")
+        st.json(cache_ledgers().estatisticas())
+        st.write("Cache de gráficos:")
+        st.json(cache_graficos().estatisticas())
+
 def main():
+    metricas.iniciar_coleta()
+    inicio_rerun = time.perf_counter()
+    servidor_metricas()
     if "usuario_logado" not in st.session_state:
-        tela_login()
+        with metricas.medir('ui_secao_segundos', secao='Login'):
+            tela_login()
         return
     
     # Configuração da página
     st.set_page_config(page_title="Sistema Financeiro", layout="wide")
     
-    # Cria uma instância do sistema financeiro para o usuário logado
-    sistema = SistemaFinanceiro(st.session_state["usuario_logado"])
+    # Reaproveita o sistema financeiro do usuário logado entre reruns enquanto os dados não mudarem
+    sistema = cache_ledgers().obter(st.session_state["usuario_logado"])
     
     # Sidebar com logo fixa e menu
     with st.sidebar:
@@ -227,19 +200,21 @@ def main():
             st.warning(f"Logo não encontrada em: {caminho_logo}")
         
         st.title("Menu")
-        menu = st.radio("Navegação", 
-                       ["Dashboard", "Adicionar Faturamento", "Adicionar Custo", 
-                        "Distribuir Custos", "Relatório Completo", "Remover Registros", "Análise"])
+        paginas = ["Dashboard", "Adicionar Faturamento", "Adicionar Custo", "Recorrentes",
+                   "Distribuir Custos", "Importar Extrato", "Relatório Completo", "Remover Registros", "Análise"]
+        if st.session_state["usuario_logado"] in administradores():
+            paginas.append("Consolidado")
+        menu = st.radio("Navegação", paginas)
     
     # Página principal
     st.title(f"Sistema Financeiro - {st.session_state['usuario_logado']}")
+    inicio_secao = time.perf_counter()
     
     if menu == "Dashboard":
         st.header("📊 Dashboard Financeiro")
         
-        if sistema.dados['lucros']:
-            ultimo_lucro = sistema.dados['lucros'][-1]
-            
+        ultimo_lucro = sistema.ultimo_lucro()
+        if ultimo_lucro:
             col1, col2, col3 = st.columns(3)
             with col1:
                 st.metric("Faturamento Total", f"R${ultimo_lucro['faturamento_total']:,.2f}")
@@ -250,25 +225,16 @@ def main():
                 st.metric("Lucro", f"R${ultimo_lucro['lucro']:,.2f}", delta_color="off")
         
         st.subheader("Últimos Faturamentos")
-        if sistema.dados['faturamentos']:
-            for fat in reversed(sistema.dados['faturamentos'][-5:]):
+        ultimos_faturamentos = sistema.ultimos_faturamentos(5)
+        if ultimos_faturamentos:
+            for fat in reversed(ultimos_faturamentos):
                 st.write(f"📈 {fat['data']} - {fat['descricao']}: R${fat['valor']:,.2f}")
         else:
             st.info("Nenhum faturamento registrado ainda.")
         
         st.subheader("Últimos Custos")
-        custos_recentes = []
-        for categoria, dados in sistema.dados['custos']['categorias'].items():
-            if 'registros' in dados:
-                for reg in dados['registros'][-3:]:
-                    custos_recentes.append((reg['data'], categoria, None, reg['descricao'], reg['valor']))
-            if 'subcategorias' in dados:
-                for subcat, registros in dados['subcategorias'].items():
-                    for reg in registros[-3:]:
-                        custos_recentes.append((reg['data'], categoria, subcat, reg['descricao'], reg['valor']))
-        
-        custos_recentes.sort(reverse=True)
-        for data, cat, subcat, desc, valor in custos_recentes[:5]:
+        custos_recentes = sistema.ultimos_custos(5)
+        for data, cat, subcat, desc, valor in custos_recentes:
             if subcat:
                 st.write(f"📉 {data} - {cat} > {subcat}: {desc} - R${valor:,.2f}")
             else:
@@ -309,10 +275,80 @@ def main():
                 )
                 st.success("Custo adicionado com sucesso!")
     
+    elif menu == "Recorrentes":
+        st.header("🔁 Lançamentos Recorrentes")
+        st.write("Aluguel, folha, assinaturas: a regra é guardada uma vez e as ocorrências até hoje já entram nos "
+                 "totais e na análise. Fechar um período grava essas ocorrências como lançamentos comuns.")
+        
+        with st.form("regra_form"):
+            col1, col2 = st.columns(2)
+            with col1:
+                tipo = st.selectbox("Tipo", ["Custo", "Faturamento"])
+                categoria = st.text_input("Categoria (custos)")
+                subcategoria = st.text_input("Subcategoria (opcional)")
+                descricao = st.text_input("Descrição")
+            with col2:
+                valor = st.number_input("Valor (R$)", min_value=0.0, step=0.01)
+                frequencia = st.selectbox("Frequência", list(FREQUENCIAS_RECORRENCIA),
+                                          index=list(FREQUENCIAS_RECORRENCIA).index('mensal'))
+                inicio = st.date_input("Início", datetime.now())
+                fim = st.date_input("Fim (vazio = sem fim)", value=None)
+            
+            if st.form_submit_button("Adicionar Regra"):
+                if tipo == "Custo" and not categoria:
+                    st.error("Informe a categoria do custo.")
+                else:
+                    try:
+                        sistema.adicionar_regra(
+                            valor, descricao, categoria if tipo == "Custo" else None,
+                            subcategoria or None, frequencia, str(inicio), str(fim) if fim else None)
+                        st.success("Regra adicionada com sucesso!")
+                    except ValueError as erro:
+                        st.error(f"Erro: {erro}")
+        
+        regras = sistema.regras_recorrentes()
+        if regras:
+            st.subheader("Regras")
+            tabela = pd.DataFrame({
+                "Tipo": ["Faturamento" if r['categoria'] is None else "Custo" for r in regras],
+                "Categoria": [r['categoria'] or "" for r in regras],
+                "Subcategoria": [r['subcategoria'] or "" for r in regras],
+                "Descrição": [r['descricao'] for r in regras],
+                "Valor": [r['valor'] for r in regras],
+                "Frequência": [r['frequencia'] for r in regras],
+                "Início": [r['inicio'] for r in regras],
+                "Fim": [r['fim'] or "" for r in regras],
+                "Fechado até": [r['fechado_ate'] or "" for r in regras],
+            })
+            tabela.insert(0, "Remover", False)
+            editado = st.data_editor(
+                tabela.style.format({'Valor': "R${:,.2f}"}),
+                hide_index=True,
+                use_container_width=True,
+                disabled=[coluna for coluna in tabela.columns if coluna != "Remover"],
+                key=f"editor_regras_{sistema.seq}"
+            )
+            selecionadas = [regra['id'] for regra, marcada in zip(regras, editado["Remover"]) if marcada]
+            if st.button(f"Remover regras selecionadas ({len(selecionadas)})", disabled=not selecionadas):
+                with sistema.transacao():
+                    for id_regra in selecionadas:
+                        sistema.remover_regra(id_regra)
+                st.rerun()
+            
+            st.subheader("Fechar Período")
+            ultimo_dia = datetime.now().replace(day=1) - timedelta(days=1)
+            with st.form("fechamento_form"):
+                ate = st.date_input("Materializar as ocorrências até", ultimo_dia, max_value=datetime.now())
+                if st.form_submit_button("Fechar Período"):
+                    incluidos = sistema.fechar_periodo(str(ate))
+                    st.success(f"{incluidos:,} lançamento(s) materializado(s) até {ate}.")
+        else:
+            st.info("Nenhuma regra recorrente cadastrada.")
+    
     elif menu == "Distribuir Custos":
         st.header("📊 Distribuir Custos por Porcentagem")
         
-        categorias = list(sistema.dados['custos']['categorias'].keys())
+        categorias = sistema.categorias()
         if not categorias:
             st.warning("Nenhuma categoria de custo disponível. Adicione custos primeiro.")
         else:
@@ -352,151 +388,185 @@ def main():
                     if subcat4 and p4 > 0:
                         porcentagens[subcat4] = p4
                     
-                    sistema.distribuir_custos_porcentagem(categoria, porcentagens)
+                    try:
+                        sistema.distribuir_custos_porcentagem(categoria, porcentagens)
+                        st.success("Custos distribuídos com sucesso!")
+                    except ValueError as erro:
+                        st.error(f"Erro: {erro}")
+    
+    elif menu == "Importar Extrato":
+        st.header("📥 Importar Extrato")
+        st.write("CSV com as colunas `valor`, `descricao`, `data` e opcionalmente `tipo`, `categoria`, "
+                 "`subcategoria`; ou extrato bancário OFX. Valores negativos sem tipo são tratados como custo.")
+        
+        with st.form("importacao_form"):
+            arquivo = st.file_uploader("Arquivo", type=["csv", "ofx"])
+            regras_texto = st.text_area(
+                "Regras de categorização (uma por linha: palavra-chave; categoria; subcategoria opcional)")
+            
+            if st.form_submit_button("Importar") and arquivo is not None:
+                regras = []
+                for linha in regras_texto.splitlines():
+                    partes = [parte.strip() for parte in linha.split(';')]
+                    if len(partes) >= 2 and partes[0] and partes[1]:
+                        regras.append((partes[0], partes[1], partes[2] if len(partes) > 2 and partes[2] else None))
+                
+                importador = ImportadorLancamentos(sistema, regras)
+                texto = io.TextIOWrapper(arquivo, encoding='utf-8-sig', errors='replace', newline='')
+                if arquivo.name.lower().endswith('.ofx'):
+                    resultado = importador.importar_ofx(texto)
+                else:
+                    resultado = importador.importar_csv(texto)
+                
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("Importados", f"{resultado.importadas:,}")
+                with col2:
+                    st.metric("Rejeitados", f"{resultado.total_rejeitadas:,}")
+                with col3:
+                    st.metric("Linhas/s", f"{resultado.linhas_por_segundo:,.0f}")
+                
+                if resultado.rejeitadas:
+                    st.warning("Linhas rejeitadas:")
+                    st.dataframe(pd.DataFrame(resultado.rejeitadas, columns=["Linha", "Motivo"]), hide_index=True)
     
     elif menu == "Relatório Completo":
         st.header("📑 Relatório Financeiro Completo")
         
-        # Faturamentos
-        st.subheader("Faturamentos")
-        if sistema.dados['faturamentos']:
-            for fat in sistema.dados['faturamentos']:
-                st.write(f"📅 {fat['data']} - {fat['descricao']}: R${fat['valor']:,.2f}")
-            total_fat = sum(f['valor'] for f in sistema.dados['faturamentos'])
-            st.success(f"Total Faturamento: R${total_fat:,.2f}")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.success(f"Total Faturamento: R${sistema.total_faturamento():,.2f}")
+        with col2:
+            st.error(f"Total Custos: R${sistema.calcular_total_custos():,.2f}")
+        
+        # Lançamentos: apenas a página visível é consultada e enviada ao navegador
+        st.subheader("Lançamentos")
+        filtros = filtros_registros(sistema, "relatorio")
+        pagina_df, _ = tabela_paginada(sistema, "relatorio", filtros)
+        if pagina_df.empty:
+            st.info("Nenhum lançamento encontrado.")
         else:
-            st.info("Nenhum faturamento registrado ainda.")
+            st.dataframe(formatar_registros(pagina_df), hide_index=True, use_container_width=True)
         
         # Custos
-        st.subheader("Custos")
-        if sistema.dados['custos']['categorias']:
-            for categoria, dados in sistema.dados['custos']['categorias'].items():
-                with st.expander(f"Categoria: {categoria}"):
-                    if 'registros' in dados:
-                        st.write("**Custos diretos:**")
-                        for reg in dados['registros']:
-                            st.write(f"- {reg['data']} - {reg['descricao']}: R${reg['valor']:,.2f}")
-                    
-                    if 'subcategorias' in dados:
-                        st.write("**Subcategorias:**")
-                        for subcat, registros in dados['subcategorias'].items():
-                            total_sub = sum(r['valor'] for r in registros)
-                            with st.expander(f"{subcat} (R${total_sub:,.2f})"):
-                                for reg in registros:
-                                    st.write(f"- {reg['data']} - {reg['descricao']}: R${reg['valor']:,.2f}")
-            
-            total_custos = sistema.calcular_total_custos()
-            st.error(f"Total Custos: R${total_custos:,.2f}")
+        st.subheader("Custos por Categoria")
+        df_subcategorias = sistema.analise().por_subcategoria()
+        if not df_subcategorias.empty:
+            st.dataframe(df_subcategorias.style.format({'Valor': "R${:,.2f}"}), hide_index=True)
         else:
             st.info("Nenhum custo registrado ainda.")
         
         # Lucros
         st.subheader("Lucros")
-        if sistema.dados['lucros']:
-            ultimo_lucro = sistema.dados['lucros'][-1]
+        historico = sistema.historico_lucros()
+        if historico:
+            ultimo_lucro = historico[-1]
             st.metric("Último Cálculo de Lucro", 
                      f"R${ultimo_lucro['lucro']:,.2f}", 
                      delta=f"Faturamento: R${ultimo_lucro['faturamento_total']:,.2f} | Custos: R${ultimo_lucro['custos_total']:,.2f}")
             
             st.write("Histórico de Lucros:")
-            for lucro in reversed(sistema.dados['lucros']):
-                st.write(f"📅 {lucro['data']} - Lucro: R${lucro['lucro']:,.2f}")
+            df_lucros = pd.DataFrame(list(reversed(historico))).rename(columns={
+                'data': 'Data', 'lucro': 'Lucro', 'faturamento_total': 'Faturamento', 'custos_total': 'Custos'})
+            st.dataframe(df_lucros.style.format({'Lucro': "R${:,.2f}", 'Faturamento': "R${:,.2f}",
+                                                 'Custos': "R${:,.2f}"}), hide_index=True)
         else:
             st.info("Nenhum cálculo de lucro disponível.")
+        
+        # Exportação: o arquivo só é gerado quando o botão é clicado, fora do rerun, em blocos
+        st.subheader("Exportar")
+        col1, col2, col3 = st.columns([1, 1, 2])
+        with col1:
+            formato = st.selectbox("Formato", FORMATOS_EXPORTACAO, key="exportar_formato")
+        with col2:
+            conteudo = st.selectbox("Conteúdo", ["lancamentos", "mensal"], key="exportar_conteudo",
+                                    format_func={"lancamentos": "Lançamentos", "mensal": "Totais mensais"}.get)
+        with col3:
+            periodo = st.date_input("Período (vazio = tudo)", value=(), key="exportar_periodo")
+        st.caption("Como o relatório, a exportação inclui as ocorrências projetadas das regras recorrentes "
+                   "(nos lançamentos, marcadas na coluna projetado).")
+        inicio = periodo[0] if len(periodo) > 0 else None
+        fim = periodo[1] if len(periodo) > 1 else None
+        
+        def gerar_exportacao():
+            arquivo = tempfile.TemporaryFile()
+            exportar(sistema, arquivo, formato, conteudo, inicio, fim)
+            arquivo.seek(0)
+            return arquivo
+        
+        st.download_button(
+            "⬇️ Baixar arquivo",
+            data=gerar_exportacao,
+            file_name=f"{conteudo}_{inicio or 'inicio'}_{fim or 'hoje'}.{formato}",
+            mime={'csv': 'text/csv',
+                  'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                  'parquet': 'application/vnd.apache.parquet'}[formato],
+            on_click="ignore"
+        )
     
     elif menu == "Remover Registros":
         st.header("🗑️ Remover Registros")
         
-        tab1, tab2 = st.tabs(["Remover Faturamentos", "Remover Custos"])
-        
-        with tab1:
-            st.subheader("Remover Faturamentos")
-            if sistema.dados['faturamentos']:
-                st.write("Selecione o faturamento para remover:")
-                for i, fat in enumerate(sistema.dados['faturamentos']):
-                    col1, col2 = st.columns([4, 1])
-                    with col1:
-                        st.write(f"📅 {fat['data']} - {fat['descricao']}: R${fat['valor']:,.2f}")
-                    with col2:
-                        if st.button(f"Remover #{i+1}", key=f"rem_fat_{i}"):
-                            removed = sistema.remover_faturamento(i)
-                            if removed:
-                                st.success(f"Faturamento removido: {removed['descricao']} - R${removed['valor']:,.2f}")
-                                st.rerun()
-            else:
-                st.info("Nenhum faturamento registrado para remover.")
-        
-        with tab2:
-            st.subheader("Remover Custos")
-            if sistema.dados['custos']['categorias']:
-                categorias = list(sistema.dados['custos']['categorias'].keys())
-                categoria_selecionada = st.selectbox("Selecione a categoria", categorias)
-                
-                dados_categoria = sistema.dados['custos']['categorias'][categoria_selecionada]
-                
-                if 'registros' in dados_categoria and dados_categoria['registros']:
-                    st.write("Custos diretos:")
-                    for i, custo in enumerate(dados_categoria['registros']):
-                        col1, col2 = st.columns([4, 1])
-                        with col1:
-                            st.write(f"📅 {custo['data']} - {custo['descricao']}: R${custo['valor']:,.2f}")
-                        with col2:
-                            if st.button(f"Remover #{i+1}", key=f"rem_cat_{categoria_selecionada}_{i}"):
-                                removed = sistema.remover_custo(categoria_selecionada, i)
-                                if removed:
-                                    st.success(f"Custo removido: {removed['descricao']} - R${removed['valor']:,.2f}")
-                                    st.rerun()
-                
-                if 'subcategorias' in dados_categoria and dados_categoria['subcategorias']:
-                    st.write("Subcategorias:")
-                    for subcat, registros in dados_categoria['subcategorias'].items():
-                        with st.expander(f"Subcategoria: {subcat}"):
-                            for i, custo in enumerate(registros):
-                                col1, col2 = st.columns([4, 1])
-                                with col1:
-                                    st.write(f"📅 {custo['data']} - {custo['descricao']}: R${custo['valor']:,.2f}")
-                                with col2:
-                                    if st.button(f"Remover #{i+1}", key=f"rem_sub_{categoria_selecionada}_{subcat}_{i}"):
-                                        removed = sistema.remover_custo(categoria_selecionada, i, subcat)
-                                        if removed:
-                                            st.success(f"Custo removido: {removed['descricao']} - R${removed['valor']:,.2f}")
-                                            st.rerun()
-            else:
-                st.info("Nenhum custo registrado para remover.")
+        filtros = filtros_registros(sistema, "remocao")
+        # Ocorrências projetadas das regras recorrentes não estão no ledger: saem pela remoção da regra
+        st.caption("Ocorrências projetadas de regras recorrentes não aparecem aqui; remova a regra em Recorrentes.")
+        pagina_df, _ = tabela_paginada(sistema, "remocao", {**filtros, 'projetados': False})
+        if pagina_df.empty:
+            st.info("Nenhum registro encontrado para remover.")
+        else:
+            st.write("Marque os registros a remover:")
+            tabela = formatar_registros(pagina_df)
+            tabela.insert(0, "Remover", False)
+            # A chave muda a cada alteração do ledger para descartar seleções de uma versão anterior
+            editado = st.data_editor(
+                tabela,
+                hide_index=True,
+                use_container_width=True,
+                disabled=[coluna for coluna in tabela.columns if coluna != "Remover"],
+                key=f"editor_remocao_{sistema.seq}"
+            )
+            selecionados = pagina_df[editado["Remover"].to_numpy()]
+            if st.button(f"Remover selecionados ({len(selecionados)})", disabled=selecionados.empty):
+                removidos = sistema.remover_registros(selecionados['id'].tolist())
+                st.success(f"{len(removidos)} registro(s) removido(s).")
+                st.rerun()
     
     elif menu == "Análise":
         st.header("📈 Análise Gráfica")
         
-        tab1, tab2, tab3 = st.tabs(["Custos por Categoria", "Evolução Mensal", "Comparativo"])
+        analise = sistema.analise()
+        inicio, fim = None, None
+        if st.checkbox("Filtrar por período"):
+            periodo = st.date_input("Período", value=(datetime.now() - timedelta(days=365), datetime.now()))
+            if len(periodo) == 2:
+                inicio, fim = periodo
+        # Dados e figuras vêm de cache_graficos(): um rerun sem alteração no ledger não refaz nenhum gráfico
+        periodo = (inicio, fim)
+        
+        tab1, tab2, tab3, tab4 = st.tabs(["Custos por Categoria", "Evolução Mensal", "Comparativo", "Previsão"])
         
         with tab1:
             st.subheader("Distribuição de Custos por Categoria")
             
             # Preparar dados para o gráfico de pizza
-            dados_custos = []
-            for categoria, dados in sistema.dados['custos']['categorias'].items():
-                total_categoria = sistema.calcular_total_categoria(categoria)
-                dados_custos.append({
-                    'Categoria': categoria,
-                    'Valor': total_categoria,
-                    'Tipo': 'Custo'
-                })
+            df_custos = dados_grafico(sistema, 'por_categoria', periodo, lambda: analise.por_categoria(inicio, fim))
             
-            if dados_custos:
-                df_custos = pd.DataFrame(dados_custos)
-                fig = px.pie(
-                    df_custos, 
-                    values='Valor', 
-                    names='Categoria',
-                    title='Distribuição de Custos por Categoria',
-                    hover_data=['Valor'],
-                    labels={'Valor': 'Valor (R$)'}
-                )
-                fig.update_traces(textposition='inside', textinfo='percent+label')
-                st.plotly_chart(fig, use_container_width=True)
+            if not df_custos.empty:
+                def pizza():
+                    fig = px.pie(
+                        df_custos, 
+                        values='Valor', 
+                        names='Categoria',
+                        title='Distribuição de Custos por Categoria',
+                        hover_data=['Valor'],
+                        labels={'Valor': 'Valor (R$)'}
+                    )
+                    fig.update_traces(textposition='inside', textinfo='percent+label')
+                    return fig
+                mostrar_grafico(sistema, 'pizza_categorias', periodo, pizza)
                 
                 # Gráfico de barras horizontal
-                fig2 = px.bar(
+                mostrar_grafico(sistema, 'barras_categorias', periodo, lambda: px.bar(
                     df_custos.sort_values(by='Valor', ascending=True),
                     x='Valor',
                     y='Categoria',
@@ -505,8 +575,12 @@ def main():
                     labels={'Valor': 'Valor (R$)', 'Categoria': ''},
                     color='Valor',
                     color_continuous_scale='Blues'
-                )
-                st.plotly_chart(fig2, use_container_width=True)
+                ))
+                
+                st.subheader("Custos por Subcategoria")
+                df_subcategorias = dados_grafico(sistema, 'por_subcategoria', periodo,
+                                                 lambda: analise.por_subcategoria(inicio, fim))
+                st.dataframe(df_subcategorias.style.format({'Valor': "{:,.2f}"}), hide_index=True)
             else:
                 st.warning("Nenhum dado de custo disponível para análise.")
 
@@ -514,52 +588,22 @@ def main():
             st.subheader("Evolução Mensal de Faturamento, Custos e Lucro")
             
             # Preparar dados mensais
-            meses = {}
-            for fat in sistema.dados['faturamentos']:
-                data = datetime.strptime(fat['data'], '%Y-%m-%d')
-                mes_ano = f"{data.year}-{data.month:02d}"
-                if mes_ano not in meses:
-                    meses[mes_ano] = {'Faturamento': 0, 'Custos': 0, 'Lucro': 0}
-                meses[mes_ano]['Faturamento'] += fat['valor']
-            
-            for categoria, dados in sistema.dados['custos']['categorias'].items():
-                if 'registros' in dados:
-                    for custo in dados['registros']:
-                        data = datetime.strptime(custo['data'], '%Y-%m-%d')
-                        mes_ano = f"{data.year}-{data.month:02d}"
-                        if mes_ano not in meses:
-                            meses[mes_ano] = {'Faturamento': 0, 'Custos': 0, 'Lucro': 0}
-                        meses[mes_ano]['Custos'] += custo['valor']
-                
-                if 'subcategorias' in dados:
-                    for subcat, registros in dados['subcategorias'].items():
-                        for custo in registros:
-                            data = datetime.strptime(custo['data'], '%Y-%m-%d')
-                            mes_ano = f"{data.year}-{data.month:02d}"
-                            if mes_ano not in meses:
-                                meses[mes_ano] = {'Faturamento': 0, 'Custos': 0, 'Lucro': 0}
-                            meses[mes_ano]['Custos'] += custo['valor']
+            df_meses = dados_grafico(sistema, 'mensal', periodo, lambda: analise.mensal(inicio, fim))
             
-            # Calcular lucro por mês
-            for mes in meses:
-                meses[mes]['Lucro'] = meses[mes]['Faturamento'] - meses[mes]['Custos']
-            
-            if meses:
-                df_meses = pd.DataFrame.from_dict(meses, orient='index').reset_index()
-                df_meses = df_meses.rename(columns={'index': 'Mês'})
-                df_meses['Mês'] = pd.to_datetime(df_meses['Mês'])
-                df_meses = df_meses.sort_values('Mês')
-                
-                fig = px.line(
-                    df_meses,
-                    x='Mês',
-                    y=['Faturamento', 'Custos', 'Lucro'],
-                    title='Evolução Mensal',
-                    labels={'value': 'Valor (R$)', 'variable': ''},
-                    markers=True
-                )
-                fig.update_layout(hovermode='x unified')
-                st.plotly_chart(fig, use_container_width=True)
+            if not df_meses.empty:
+                def linha_mensal():
+                    # Séries longas são reduzidas antes de plotar; a tabela abaixo continua completa
+                    fig = px.line(
+                        reduzir_serie(df_meses, ['Faturamento', 'Custos', 'Lucro']),
+                        x='Mês',
+                        y=['Faturamento', 'Custos', 'Lucro'],
+                        title='Evolução Mensal',
+                        labels={'value': 'Valor (R$)', 'variable': ''},
+                        markers=True
+                    )
+                    fig.update_layout(hovermode='x unified')
+                    return fig
+                mostrar_grafico(sistema, 'linha_mensal', periodo, linha_mensal)
                 
                 # Mostrar tabela com os dados
                 st.subheader("Dados Mensais")
@@ -577,49 +621,181 @@ def main():
         with tab3:
             st.subheader("Comparativo: Faturamento vs Custos")
             
-            if sistema.dados['lucros']:
-                # Pegar os últimos 12 meses
-                lucros_recentes = sistema.dados['lucros'][-12:]
-                
-                df_comparativo = pd.DataFrame({
+            # Pegar os últimos 12 pontos da série de lucros
+            def comparativo():
+                lucros_recentes = sistema.historico_lucros(12)
+                df = pd.DataFrame({
                     'Data': [datetime.strptime(l['data'], '%Y-%m-%d') for l in lucros_recentes],
                     'Faturamento': [l['faturamento_total'] for l in lucros_recentes],
                     'Custos': [l['custos_total'] for l in lucros_recentes],
                     'Lucro': [l['lucro'] for l in lucros_recentes]
                 })
-                
-                fig = px.bar(
-                    df_comparativo,
-                    x='Data',
-                    y=['Faturamento', 'Custos'],
-                    title='Comparativo: Faturamento vs Custos',
-                    labels={'value': 'Valor (R$)', 'variable': ''},
-                    barmode='group'
-                )
-                fig.add_scatter(
-                    x=df_comparativo['Data'],
-                    y=df_comparativo['Lucro'],
-                    name='Lucro',
-                    mode='lines+markers',
-                    line=dict(color='green', width=2)
-                )
-                st.plotly_chart(fig, use_container_width=True)
+                # Eficiência (custo/faturamento)
+                df['Eficiência'] = df['Custos'] / df['Faturamento'] * 100
+                return df
+            df_comparativo = dados_grafico(sistema, 'comparativo', (12,), comparativo)
+            
+            if not df_comparativo.empty:
+                def barras_comparativo():
+                    df = reduzir_serie(df_comparativo, ['Faturamento', 'Custos', 'Lucro'])
+                    fig = px.bar(
+                        df,
+                        x='Data',
+                        y=['Faturamento', 'Custos'],
+                        title='Comparativo: Faturamento vs Custos',
+                        labels={'value': 'Valor (R$)', 'variable': ''},
+                        barmode='group'
+                    )
+                    fig.add_scatter(
+                        x=df['Data'],
+                        y=df['Lucro'],
+                        name='Lucro',
+                        mode='lines+markers',
+                        line=dict(color='green', width=2)
+                    )
+                    return fig
+                mostrar_grafico(sistema, 'barras_comparativo', (12,), barras_comparativo)
                 
                 # Mostrar eficiência (custo/faturamento)
-                df_comparativo['Eficiência'] = df_comparativo['Custos'] / df_comparativo['Faturamento'] * 100
-                fig2 = px.line(
-                    df_comparativo,
-                    x='Data',
-                    y='Eficiência',
-                    title='Percentual de Custos sobre Faturamento',
-                    labels={'Eficiência': 'Custos/Faturamento (%)'},
-                    markers=True
-                )
-                fig2.add_hline(y=100, line_dash="dash", line_color="red", 
-                              annotation_text="Limite de 100%", annotation_position="bottom right")
-                st.plotly_chart(fig2, use_container_width=True)
+                def linha_eficiencia():
+                    fig2 = px.line(
+                        reduzir_serie(df_comparativo, ['Eficiência']),
+                        x='Data',
+                        y='Eficiência',
+                        title='Percentual de Custos sobre Faturamento',
+                        labels={'Eficiência': 'Custos/Faturamento (%)'},
+                        markers=True
+                    )
+                    fig2.add_hline(y=100, line_dash="dash", line_color="red", 
+                                  annotation_text="Limite de 100%", annotation_position="bottom right")
+                    return fig2
+                mostrar_grafico(sistema, 'linha_eficiencia', (12,), linha_eficiencia)
             else:
                 st.warning("Nenhum cálculo de lucro disponível para comparação.")
 
+        with tab4:
+            st.subheader("Previsão de Fluxo de Caixa")
+            st.caption("Projeção dos próximos meses a partir dos meses já fechados (o mês corrente não entra no "
+                       "ajuste); a sazonalidade só é considerada com dois anos de histórico")
+            horizonte = st.slider("Meses à frente", 1, 24, PREVISAO_HORIZONTE)
+            
+            df_previsao = dados_grafico(sistema, 'previsao', (horizonte,), lambda: analise.previsao_mensal(horizonte))
+            df_historico = dados_grafico(sistema, 'mensal', (None, None), analise.mensal)
+            
+            if not df_historico.empty:
+                def linha_previsao():
+                    # Últimos 12 meses registrados seguidos da previsão, em traço tracejado
+                    df = pd.concat([df_historico.tail(12).assign(Tipo='Histórico'), df_previsao.assign(Tipo='Previsão')],
+                                   ignore_index=True)
+                    fig = px.line(
+                        df.melt(id_vars=['Mês', 'Tipo'], value_vars=['Faturamento', 'Custos', 'Lucro'],
+                                var_name='Série', value_name='Valor'),
+                        x='Mês',
+                        y='Valor',
+                        color='Série',
+                        line_dash='Tipo',
+                        title='Histórico e Previsão Mensal',
+                        labels={'Valor': 'Valor (R$)'},
+                        markers=True
+                    )
+                    fig.update_layout(hovermode='x unified')
+                    return fig
+                mostrar_grafico(sistema, 'linha_previsao', (horizonte,), linha_previsao)
+                
+                st.subheader("Custos Previstos por Categoria")
+                df_categorias = dados_grafico(sistema, 'previsao_categorias', (horizonte,),
+                                              lambda: analise.previsao_categorias(horizonte))
+                if not df_categorias.empty:
+                    df_display = df_categorias.pivot(index='Categoria', columns='Mês', values='Valor')
+                    df_display.columns = df_display.columns.strftime('%Y-%m')
+                    st.dataframe(df_display.style.format("R${:,.2f}"))
+            else:
+                st.warning("Nenhum dado disponível para previsão.")
+
+    elif menu == "Consolidado":
+        st.header("🏢 Relatório Consolidado")
+        
+        # Só os usuários com arquivos alterados desde a última execução são recalculados
+        with st.spinner("Consolidando os ledgers de todos os usuários..."):
+            relatorio = RelatorioConsolidado(workers=int(os.environ.get('GESTOR_WORKERS_CONSOLIDADO', os.cpu_count() or 2)))
+            relatorio.atualizar()
+        totais = relatorio.totais()
+        
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("Usuários", f"{totais['usuarios']:,}")
+        with col2:
+            st.metric("Faturamento Total", f"R${totais['faturamento_total']:,.2f}")
+        with col3:
+            st.metric("Custos Total", f"R${totais['custos_total']:,.2f}")
+        with col4:
+            st.metric("Lucro", f"R${totais['lucro']:,.2f}")
+        st.caption(f"{len(relatorio.recalculados):,} usuário(s) recalculado(s); os demais vieram do cache de parciais")
+        
+        df_meses = relatorio.mensal()
+        if not df_meses.empty:
+            fig = px.line(
+                reduzir_serie(df_meses, ['Faturamento', 'Custos', 'Lucro']),
+                x='Mês',
+                y=['Faturamento', 'Custos', 'Lucro'],
+                title='Evolução Mensal Consolidada',
+                labels={'value': 'Valor (R$)', 'variable': ''},
+                markers=True
+            )
+            fig.update_layout(hovermode='x unified')
+            st.plotly_chart(fig, use_container_width=True)
+        
+        st.subheader("Custos por Categoria")
+        df_categorias = pd.DataFrame([
+            {'Categoria': categoria, 'Subcategoria': subcategoria, 'Valor': valor}
+            for categoria, dados in relatorio.totais_categorias().items()
+            for subcategoria, valor in [('(total)', dados['total'])] + sorted(dados['subcategorias'].items())
+        ], columns=['Categoria', 'Subcategoria', 'Valor'])
+        st.dataframe(df_categorias.style.format({'Valor': "R${:,.2f}"}), hide_index=True)
+        
+        st.subheader("Por Usuário")
+        st.dataframe(relatorio.por_usuario().style.format({'Faturamento': "R${:,.2f}", 'Custos': "R${:,.2f}",
+                                                           'Lucro': "R${:,.2f}"}), hide_index=True)
+
+    metricas.observar('ui_secao_segundos', time.perf_counter() - inicio_secao, secao=menu)
+    if st.session_state["usuario_logado"] in administradores():
+        painel_desempenho(time.perf_counter() - inicio_rerun)
+
 if __name__ == "__main__":
-    main()
+    # python Agente_Gestao.py migrar-sqlite  ->  migração única dos dados JSON para SQLite
+    # python Agente_Gestao.py consolidado    ->  totais consolidados de todos os usuários
+    # python Agente_Gestao.py previsoes [--horizonte N]  ->  rotina noturna das previsões de todos os usuários
+    if sys.argv[1:] == ['migrar-sqlite']:
+        for usuario in migrar_para_sqlite():
+            print(f"Migrado: {usuario}")
+    elif sys.argv[1:2] == ['exportar']:
+        # python Agente_Gestao.py exportar <email> <arquivo.csv|.xlsx|.parquet> [--conteudo mensal] [--inicio/--fim AAAA-MM-DD]
+        parser = argparse.ArgumentParser(prog='Agente_Gestao.py exportar')
+        parser.add_argument('usuario')
+        parser.add_argument('arquivo')
+        parser.add_argument('--formato', choices=FORMATOS_EXPORTACAO, help='padrão: a extensão do arquivo')
+        parser.add_argument('--conteudo', choices=('lancamentos', 'mensal'), default='lancamentos')
+        parser.add_argument('--inicio')
+        parser.add_argument('--fim')
+        argumentos = parser.parse_args(sys.argv[2:])
+        formato = argumentos.formato or os.path.splitext(argumentos.arquivo)[1].lstrip('.').lower()
+        sistema = SistemaFinanceiro(argumentos.usuario, armazenamento_existente(argumentos.usuario))
+        linhas = exportar(sistema, argumentos.arquivo, formato, argumentos.conteudo, argumentos.inicio, argumentos.fim)
+        print(f"{linhas:,} linha(s) exportada(s) para {argumentos.arquivo}")
+    elif sys.argv[1:] == ['consolidado']:
+        relatorio = RelatorioConsolidado().atualizar()
+        totais = relatorio.totais()
+        print(f"Usuários: {totais['usuarios']} ({len(relatorio.recalculados)} recalculados)")
+        print(f"Faturamento: R${totais['faturamento_total']:,.2f}  Custos: R${totais['custos_total']:,.2f}  "
+              f"Lucro: R${totais['lucro']:,.2f}")
+    elif sys.argv[1:2] == ['previsoes']:
+        parser = argparse.ArgumentParser(prog='Agente_Gestao.py previsoes')
+        parser.add_argument('--horizonte', type=int, default=PREVISAO_HORIZONTE, help='meses à frente')
+        argumentos = parser.parse_args(sys.argv[2:])
+        lote = LotePrevisoes(horizonte=argumentos.horizonte).atualizar()
+        print(f"Previsões: {len(lote.previsoes)} usuário(s) ({len(lote.recalculados)} recalculados)")
+        totais = lote.por_usuario()[['Faturamento', 'Custos', 'Lucro']].sum()
+        print(f"Próximos {argumentos.horizonte} meses: Faturamento R${totais['Faturamento']:,.2f}  "
+              f"Custos R${totais['Custos']:,.2f}  Lucro R${totais['Lucro']:,.2f}")
+    else:
+        main()
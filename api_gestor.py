@@ -0,0 +1,328 @@
+# API HTTP/JSON do gestor financeiro, sem Streamlit:
+#   python api_gestor.py --porta 8600 --workers 8
+# GESTOR_API_TOKEN é exigido no cabeçalho "Authorization: Bearer <token>". Sem ele a API não sobe, a não ser
+# com --sem-autenticacao, aceito só para um host local (desenvolvimento)
+# GET /metricas devolve as métricas do processo no formato texto do Prometheus
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import os
+import re
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from gestor_financeiro import PREVISAO_HORIZONTE, CacheLedgers, DiretorioUsuarios, metricas
+
+logger = logging.getLogger('gestor_financeiro.api')
+
+HOSTS_LOCAIS = ('127.0.0.1', '::1', 'localhost')
+
+STATUS_HTTP = {
+    200: 'OK',
+    201: 'Created',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error'
+}
+
+class ErroHTTP(Exception):
+    def __init__(self, status, mensagem):
+        super().__init__(mensagem)
+        self.status = status
+        self.mensagem = mensagem
+
+def validar_data(texto):
+    if texto is None:
+        return None
+    return date.fromisoformat(texto).isoformat()
+
+def registros_json(df):
+    # DataFrame da análise -> lista de dicionários serializáveis (datas ISO, NaN -> None)
+    df = df.assign(data=df['data'].dt.strftime('%Y-%m-%d'))
+    df = df.drop(columns=['mes']).astype(object)
+    return df.where(df.notna(), None).to_dict('records')
+
+class ApiGestor:
+    # O loop asyncio só faz E/S; cada chamada ao motor roda no pool de workers,
+    # serializada por usuário (o SistemaFinanceiro em cache é compartilhado entre requisições)
+    MAX_CORPO = 1024 * 1024
+    PREFIXO = r'/usuarios/(?P<usuario>[^/]+)'
+
+    def __init__(self, cache=None, workers=8, token=None, usuarios=None, sem_autenticacao=False):
+        # Sem token, qualquer cliente que alcance a porta lê e altera o ledger de qualquer usuário:
+        # só com sem_autenticacao explícito
+        if not token and not sem_autenticacao:
+            raise ValueError('defina o token da API (GESTOR_API_TOKEN) ou use sem_autenticacao')
+        self.cache = cache or CacheLedgers(
+            max_usuarios=int(os.environ.get('GESTOR_CACHE_USUARIOS', 64)),
+            max_bytes=int(os.environ.get('GESTOR_CACHE_MB', 256)) * 1024 * 1024
+        )
+        self.usuarios = usuarios or DiretorioUsuarios()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='api-gestor')
+        self.token = token
+        # Uma trava por usuário, mantida viva só pelas requisições dele em andamento: o dicionário não cresce
+        # com cada usuário já atendido ao longo da vida do processo
+        self._travas = weakref.WeakValueDictionary()
+        self._trava_travas = threading.Lock()
+        self.rotas = [
+            ('GET', '/resumo', self.resumo),
+            ('GET', '/registros', self.listar_registros),
+            ('POST', '/registros/remover', self.remover_registros),
+            ('PATCH', '/registros/(?P<id_registro>[^/]+)', self.atualizar_registro),
+            ('DELETE', '/registros/(?P<id_registro>[^/]+)', self.remover_registro),
+            ('POST', '/faturamentos', self.adicionar_faturamento),
+            ('POST', '/custos', self.adicionar_custo),
+            ('POST', '/distribuicoes', self.distribuir),
+            ('GET', '/mensal', self.mensal),
+            ('GET', '/categorias', self.categorias),
+            ('GET', '/previsao', self.previsao),
+            ('GET', '/regras', self.listar_regras),
+            ('POST', '/regras', self.adicionar_regra),
+            ('POST', '/regras/fechar', self.fechar_periodo),
+            ('PATCH', '/regras/(?P<id_regra>[^/]+)', self.atualizar_regra),
+            ('DELETE', '/regras/(?P<id_regra>[^/]+)', self.remover_regra),
+        ]
+        self.rotas = [(metodo, re.compile(self.PREFIXO + caminho), tratador)
+                      for metodo, caminho, tratador in self.rotas]
+
+    async def tratar_conexao(self, leitor, escritor):
+        # HTTP/1.1 mínimo com keep-alive: uma requisição por vez em cada conexão
+        try:
+            while True:
+                linha = await leitor.readline()
+                if not linha:
+                    break
+                try:
+                    metodo, alvo, versao = linha.decode('latin-1').split()
+                except ValueError:
+                    break
+                cabecalhos = {}
+                while True:
+                    linha = await leitor.readline()
+                    if linha in (b'\r\n', b'\n', b''):
+                        break
+                    chave, _, valor = linha.decode('latin-1').partition(':')
+                    cabecalhos[chave.strip().lower()] = valor.strip()
+
+                tamanho = cabecalhos.get('content-length') or '0'
+                if not (tamanho.isascii() and tamanho.isdigit()):
+                    # Sem um tamanho válido não dá para saber onde o corpo termina: responde e fecha a conexão
+                    status, resposta = 400, {'erro': 'Content-Length inválido'}
+                    manter = False
+                elif int(tamanho) > self.MAX_CORPO:
+                    status, resposta = 413, {'erro': 'corpo da requisição muito grande'}
+                    manter = False
+                else:
+                    tamanho = int(tamanho)
+                    corpo = await leitor.readexactly(tamanho) if tamanho else b''
+                    status, resposta = await self.despachar(metodo, alvo, cabecalhos, corpo)
+                    manter = versao == 'HTTP/1.1' and cabecalhos.get('connection', '').lower() != 'close'
+
+                metricas.incrementar('api_respostas_total', status=status)
+                if isinstance(resposta, str):
+                    conteudo, tipo = resposta.encode('utf-8'), 'text/plain; version=0.0.4'
+                else:
+                    conteudo, tipo = json.dumps(resposta, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 'application/json'
+                escritor.write(
+                    f'HTTP/1.1 {status} {STATUS_HTTP[status]}\r\n'
+                    f'Content-Type: {tipo}; charset=utf-8\r\n'
+                    f'Content-Length: {len(conteudo)}\r\n'
+                    f'Connection: {"keep-alive" if manter else "close"}\r\n\r\n'.encode('latin-1') + conteudo)
+                await escritor.drain()
+                if not manter:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            escritor.close()
+
+    async def despachar(self, metodo, alvo, cabecalhos, corpo):
+        try:
+            # Comparação em tempo constante, como em verificar_senha
+            if self.token and not hmac.compare_digest(cabecalhos.get('authorization', '').encode('utf-8'),
+                                                      f'Bearer {self.token}'.encode('utf-8')):
+                raise ErroHTTP(401, 'token ausente ou inválido')
+
+            url = urlsplit(alvo)
+            if url.path == '/metricas' and metodo == 'GET':
+                return 200, metricas.texto_prometheus()
+
+            metodos_do_caminho = []
+            for metodo_rota, padrao, tratador in self.rotas:
+                encontrado = padrao.fullmatch(url.path)
+                if not encontrado:
+                    continue
+                metodos_do_caminho.append(metodo_rota)
+                if metodo_rota == metodo:
+                    break
+            else:
+                if metodos_do_caminho:
+                    raise ErroHTTP(405, f"use {', '.join(metodos_do_caminho)}")
+                raise ErroHTTP(404, 'rota inexistente')
+
+            argumentos = {chave: unquote(valor) for chave, valor in encontrado.groupdict().items()}
+            parametros = {chave: valores[-1] for chave, valores in parse_qs(url.query).items()}
+            dados = json.loads(corpo) if corpo else {}
+            if not isinstance(dados, dict):
+                raise ErroHTTP(400, 'o corpo deve ser um objeto JSON')
+
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor, self._executar, tratador, argumentos, parametros, dados)
+        except ErroHTTP as erro:
+            return erro.status, {'erro': erro.mensagem}
+        except (ValueError, KeyError, TypeError) as erro:
+            return 400, {'erro': str(erro)}
+        except Exception:
+            logger.exception('Erro interno em %s %s', metodo, urlsplit(alvo).path)
+            return 500, {'erro': 'erro interno'}
+
+    def _executar(self, tratador, argumentos, parametros, dados):
+        usuario = argumentos.pop('usuario')
+        if not self.usuarios.existe(usuario):
+            raise ErroHTTP(404, 'usuário não cadastrado')
+        with self._trava_travas:
+            trava = self._travas.setdefault(usuario, threading.Lock())
+        with trava, metricas.medir('api_requisicao_segundos', rota=tratador.__name__):
+            sistema = self.cache.obter(usuario)
+            return tratador(sistema, parametros, dados, **argumentos)
+
+    def resumo(self, sistema, parametros, dados):
+        return 200, {
+            'faturamento_total': sistema.total_faturamento(),
+            'custos_total': sistema.calcular_total_custos(),
+            'lucro': round(sistema.total_faturamento() - sistema.calcular_total_custos(), 2),
+            'ultimo_lucro': sistema.ultimo_lucro(),
+            'versao': sistema.seq
+        }
+
+    def listar_registros(self, sistema, parametros, dados):
+        pagina_df, total = sistema.analise().consultar_registros(
+            tipo=parametros.get('tipo'),
+            inicio=validar_data(parametros.get('inicio')),
+            fim=validar_data(parametros.get('fim')),
+            categoria=parametros.get('categoria'),
+            busca=parametros.get('busca'),
+            pagina=int(parametros.get('pagina', 0)),
+            tamanho_pagina=min(int(parametros.get('tamanho_pagina', 50)), 1000),
+            decrescente=parametros.get('ordem', 'desc') != 'asc'
+        )
+        return 200, {'total': total, 'registros': registros_json(pagina_df)}
+
+    def adicionar_faturamento(self, sistema, parametros, dados):
+        registro = sistema.adicionar_faturamento(
+            float(dados['valor']), dados.get('descricao', ''), validar_data(dados.get('data')))
+        return 201, registro
+
+    def adicionar_custo(self, sistema, parametros, dados):
+        registro = sistema.adicionar_custo(
+            dados['categoria'], float(dados['valor']), dados.get('descricao', ''),
+            validar_data(dados.get('data')), dados.get('subcategoria') or None)
+        return 201, registro
+
+    def atualizar_registro(self, sistema, parametros, dados, id_registro):
+        if 'data' in dados:
+            dados['data'] = validar_data(dados['data'])
+        atualizado = sistema.atualizar_registro(id_registro, **dados)
+        if atualizado is None:
+            raise ErroHTTP(404, 'registro não encontrado')
+        return 200, atualizado
+
+    def remover_registro(self, sistema, parametros, dados, id_registro):
+        removido = sistema.remover_registro(id_registro)
+        if removido is None:
+            raise ErroHTTP(404, 'registro não encontrado')
+        return 200, removido
+
+    def remover_registros(self, sistema, parametros, dados):
+        removidos = sistema.remover_registros(list(dados['ids']))
+        return 200, {'removidos': len(removidos)}
+
+    def distribuir(self, sistema, parametros, dados):
+        alocados = sistema.distribuir_custos_porcentagem(
+            dados['categoria'], {subcat: float(p) for subcat, p in dados['porcentagens'].items()})
+        return 201, alocados
+
+    def mensal(self, sistema, parametros, dados):
+        df = sistema.analise().mensal(validar_data(parametros.get('inicio')), validar_data(parametros.get('fim')))
+        df['Mês'] = df['Mês'].dt.strftime('%Y-%m')
+        return 200, df.to_dict('records')
+
+    def categorias(self, sistema, parametros, dados):
+        inicio, fim = validar_data(parametros.get('inicio')), validar_data(parametros.get('fim'))
+        if inicio is None and fim is None:
+            return 200, sistema.totais_categorias()
+        df = sistema.analise().por_subcategoria(inicio, fim)
+        return 200, df.to_dict('records')
+
+    def previsao(self, sistema, parametros, dados):
+        horizonte = int(parametros.get('horizonte', PREVISAO_HORIZONTE))
+        if not 1 <= horizonte <= 36:
+            raise ValueError('horizonte deve estar entre 1 e 36 meses')
+        analise = sistema.analise()
+        df = analise.previsao_mensal(horizonte)
+        df['Mês'] = df['Mês'].dt.strftime('%Y-%m')
+        categorias = analise.previsao_categorias(horizonte)
+        categorias['Mês'] = categorias['Mês'].dt.strftime('%Y-%m')
+        return 200, {'mensal': df.to_dict('records'), 'categorias': categorias.to_dict('records')}
+
+    def listar_regras(self, sistema, parametros, dados):
+        return 200, sistema.regras_recorrentes()
+
+    def adicionar_regra(self, sistema, parametros, dados):
+        regra = sistema.adicionar_regra(
+            float(dados['valor']), dados.get('descricao', ''), dados.get('categoria') or None,
+            dados.get('subcategoria') or None, dados.get('frequencia', 'mensal'),
+            validar_data(dados.get('inicio')), validar_data(dados.get('fim')))
+        return 201, regra
+
+    def atualizar_regra(self, sistema, parametros, dados, id_regra):
+        if dados.get('fim'):
+            dados['fim'] = validar_data(dados['fim'])
+        atualizada = sistema.atualizar_regra(id_regra, **dados)
+        if atualizada is None:
+            raise ErroHTTP(404, 'regra não encontrada')
+        return 200, atualizada
+
+    def remover_regra(self, sistema, parametros, dados, id_regra):
+        removida = sistema.remover_regra(id_regra)
+        if removida is None:
+            raise ErroHTTP(404, 'regra não encontrada')
+        return 200, removida
+
+    def fechar_periodo(self, sistema, parametros, dados):
+        return 200, {'incluidos': sistema.fechar_periodo(validar_data(dados.get('ate')))}
+
+async def servir(host='127.0.0.1', porta=8600, workers=8, sem_autenticacao=False):
+    token = os.environ.get('GESTOR_API_TOKEN')
+    if sem_autenticacao and host not in HOSTS_LOCAIS:
+        raise ValueError(f'--sem-autenticacao só é aceito em host local, não em {host}')
+    api = ApiGestor(workers=workers, token=token, sem_autenticacao=sem_autenticacao)
+    servidor = await asyncio.start_server(api.tratar_conexao, host, porta)
+    logger.info('API do gestor financeiro em http://%s:%s (%s workers%s)', host, porta, workers,
+                '' if token else ', sem autenticação')
+    async with servidor:
+        await servidor.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='API HTTP/JSON do gestor financeiro')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--porta', type=int, default=8600)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--sem-autenticacao', action='store_true',
+                        help='aceita requisições sem token (só em host local)')
+    argumentos = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if not os.environ.get('GESTOR_API_TOKEN') and not argumentos.sem_autenticacao:
+        parser.error('defina GESTOR_API_TOKEN ou use --sem-autenticacao (só em host local)')
+    if argumentos.sem_autenticacao and argumentos.host not in HOSTS_LOCAIS:
+        parser.error(f'--sem-autenticacao só é aceito em host local, não em {argumentos.host}')
+    asyncio.run(servir(argumentos.host, argumentos.porta, argumentos.workers, argumentos.sem_autenticacao))
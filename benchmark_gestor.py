@@ -0,0 +1,224 @@
+# Benchmark dos caminhos críticos do gestor financeiro sobre um ledger sintético:
+#   python benchmark_gestor.py --faturamentos 20000 --custos 50000 --backend sqlite --json atual.json
+#   python benchmark_gestor.py --comparar base.json     (sai com código 1 se a mediana piorar além da tolerância)
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import gestor_financeiro as gf
+
+USUARIO = 'benchmark@e-flow.digital'
+
+def gerar_ledger(sistema, faturamentos=10000, custos=20000, categorias=10, subcategorias=3,
+                 dias=730, lucros=365, semente=42):
+    # Registros aleatórios, mas reprodutíveis pela semente, espalhados pelos últimos `dias` dias;
+    # cada categoria tem `subcategorias` subcategorias além dos custos diretos
+    aleatorio = random.Random(semente)
+    hoje = date.today()
+    datas = [(hoje - timedelta(days=d)).isoformat() for d in range(dias)]
+    nomes_categorias = [f'Categoria {c}' for c in range(categorias)]
+    destinos = [(categoria, None) for categoria in nomes_categorias]
+    destinos += [(categoria, f'Sub {s}') for categoria in nomes_categorias for s in range(subcategorias)]
+
+    # A série de lucros só ganha um ponto por dia pela API do sistema; o histórico é gravado direto no
+    # backend (como em migrar_para_sqlite), antes dos registros, para que o ponto calculado hoje seja o último
+    with sistema.armazenamento.trava:
+        sistema.armazenamento.gravar([
+            {'op': 'lucro', 'seq': seq, 'registro': {
+                'data': data, 'lucro': 0.0, 'faturamento_total': 0.0, 'custos_total': 0.0}}
+            for seq, data in enumerate(sorted(datas[:lucros]), start=sistema.seq + 1)
+        ], sistema.agregados)
+    sistema.carregar_dados()
+
+    def lancamentos():
+        for i in range(faturamentos):
+            yield (None, None, gf.para_centavos(round(aleatorio.uniform(50, 5000), 2)), f'Venda {i}',
+                   aleatorio.choice(datas))
+        for i in range(custos):
+            categoria, subcategoria = aleatorio.choice(destinos)
+            yield (categoria, subcategoria, gf.para_centavos(round(aleatorio.uniform(10, 2000), 2)), f'Despesa {i}',
+                   aleatorio.choice(datas))
+    sistema.incluir_registros(lancamentos())
+    sistema.compactar()
+
+def gerar_usuarios(quantidade, semente=42):
+    # Um só hash para os usuários fictícios (o KDF de cada um tornaria a carga lenta); só o do USUARIO é conferido
+    aleatorio = random.Random(semente)
+    diretorio = gf.DiretorioUsuarios()
+    ficticio = gf.hash_senha(str(aleatorio.random()))
+    diretorio.importar({f'usuario{i}@e-flow.digital': ficticio for i in range(quantidade)})
+    diretorio.cadastrar(USUARIO, 'senha')
+    return diretorio
+
+def medir(funcao, repeticoes, preparar=None):
+    # Latências individuais em segundos; preparar() roda antes de cada chamada, fora da medição
+    tempos = []
+    for _ in range(repeticoes):
+        argumento = preparar() if preparar else None
+        inicio = time.perf_counter()
+        funcao(argumento) if preparar else funcao()
+        tempos.append(time.perf_counter() - inicio)
+    return tempos
+
+def medir_etapa(funcao, metrica, repeticoes):
+    # Latências de uma etapa interna de funcao, lidas do histograma `metrica` que o próprio motor observa
+    # (a coleta por thread de Metricas), sem chamar a etapa fora do caminho normal
+    tempos = []
+    for _ in range(repeticoes):
+        gf.metricas.iniciar_coleta()
+        funcao()
+        tempos.append(sum(segundos for nome, _, _, segundos, _ in gf.metricas.coleta() if nome == metrica))
+    return tempos
+
+def pico_memoria(funcao):
+    tracemalloc.start()
+    try:
+        funcao()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def percentil(ordenados, p):
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+def resumir(tempos, pico=None):
+    ordenados = sorted(tempos)
+    total = sum(tempos)
+    return {
+        'n': len(tempos),
+        'media_ms': statistics.fmean(tempos) * 1000,
+        'p50_ms': percentil(ordenados, 50) * 1000,
+        'p95_ms': percentil(ordenados, 95) * 1000,
+        'p99_ms': percentil(ordenados, 99) * 1000,
+        'max_ms': ordenados[-1] * 1000,
+        'ops_s': len(tempos) / total if total else 0.0,
+        'pico_mb': pico / 1024 / 1024 if pico is not None else None
+    }
+
+def executar(args):
+    fabricas = {'json': gf.ArmazenamentoJSON, 'binario': gf.ArmazenamentoBinario,
+                'segmentado': gf.ArmazenamentoSegmentado, 'sqlite': gf.ArmazenamentoSQLite}
+    fabrica = fabricas[args.backend]
+    novo_sistema = lambda: gf.SistemaFinanceiro(USUARIO, fabrica(USUARIO))
+    resultados = {}
+
+    inicio = time.perf_counter()
+    sistema = novo_sistema()
+    gerar_ledger(sistema, args.faturamentos, args.custos, args.categorias, args.subcategorias,
+                 args.dias, args.lucros, args.semente)
+    usuarios = gerar_usuarios(args.usuarios, args.semente)
+    print(f"Ledger sintético gerado em {time.perf_counter() - inicio:.1f}s "
+          f"({args.faturamentos} faturamentos, {args.custos} custos, backend {args.backend})")
+
+    resultados['carregar_dados'] = resumir(
+        medir(novo_sistema, args.repeticoes), pico_memoria(novo_sistema))
+
+    # Primeira renderização do Dashboard: totais, último lucro e últimos registros de um sistema recém-criado
+    def dashboard_frio():
+        sistema = novo_sistema()
+        sistema.ultimo_lucro()
+        sistema.ultimos_faturamentos(5)
+        sistema.ultimos_custos(5)
+    resultados['dashboard_frio'] = resumir(medir(dashboard_frio, args.repeticoes))
+
+    sistema = novo_sistema()
+    aleatorio = random.Random(args.semente)
+    categorias = sistema.categorias()
+
+    # Lote de 100 custos pela API de importação: uma gravação e um recálculo de lucro para o lote inteiro
+    lote = lambda: [(aleatorio.choice(categorias), None, 1000, 'benchmark', date.today().isoformat())
+                    for _ in range(100)]
+    resultados['incluir_lote_100'] = resumir(medir(sistema.incluir_registros, args.repeticoes, lote))
+    resultados['adicionar_custo'] = resumir(medir(
+        lambda: sistema.adicionar_custo(aleatorio.choice(categorias), 10.0, 'benchmark'), args.repeticoes))
+    resultados['calcular_lucros'] = resumir(medir(sistema.calcular_lucros, args.repeticoes))
+    resultados['calcular_total_custos'] = resumir(medir(sistema.calcular_total_custos, args.repeticoes * 100))
+
+    # Análise: montagem do DataFrame a partir do ledger (frio) e agregação mensal com e sem período
+    frio = lambda: gf.AnaliseFinanceira(sistema).mensal(date.today() - timedelta(days=365), date.today())
+    resultados['analise_mensal_frio'] = resumir(medir(frio, args.repeticoes), pico_memoria(frio))
+    analise = sistema.analise()
+    resultados['analise_mensal'] = resumir(medir(analise.mensal, args.repeticoes))
+    resultados['analise_mensal_periodo'] = resumir(medir(
+        lambda: analise.mensal(date.today() - timedelta(days=365), date.today()), args.repeticoes))
+    # Previsão sem estado guardado: leitura das séries mensais e ajuste completo
+    resultados['previsao_fria'] = resumir(medir(
+        lambda: gf.AnaliseFinanceira(sistema).previsao_mensal(), args.repeticoes))
+
+    # Persistência de uma mutação (journal, segmento ou banco): só o salvar_dados de cada adicionar_custo.
+    # Fica por último porque a coleta por thread continua ligada depois dela
+    resultados['salvar_dados'] = resumir(medir_etapa(
+        lambda: sistema.adicionar_custo(aleatorio.choice(categorias), 10.0, 'benchmark'),
+        'gestor_salvar_segundos', args.repeticoes))
+
+    resultados['login'] = resumir(medir(lambda: usuarios.autenticar(USUARIO, 'senha'), args.repeticoes))
+    return resultados
+
+def imprimir(resultados):
+    print(f"{'operação':<24}{'n':>7}{'média':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'máx':>10}{'ops/s':>11}{'pico MB':>9}")
+    for nome, r in resultados.items():
+        pico = f"{r['pico_mb']:.1f}" if r['pico_mb'] is not None else '-'
+        print(f"{nome:<24}{r['n']:>7}{r['media_ms']:>10.3f}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}"
+              f"{r['p99_ms']:>10.3f}{r['max_ms']:>10.3f}{r['ops_s']:>11.1f}{pico:>9}")
+    print("(tempos em ms)")
+
+def comparar(resultados, base, tolerancia):
+    # Regressão: mediana acima de (1 + tolerancia) vezes a da execução de referência
+    regressoes = []
+    for nome, r in resultados.items():
+        if nome in base and base[nome]['p50_ms'] > 0:
+            razao = r['p50_ms'] / base[nome]['p50_ms']
+            if razao > 1 + tolerancia:
+                regressoes.append((nome, base[nome]['p50_ms'], r['p50_ms'], razao))
+    for nome, antes, depois, razao in regressoes:
+        print(f"REGRESSÃO {nome}: p50 {antes:.3f}ms -> {depois:.3f}ms ({razao:.2f}x)")
+    return regressoes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark do gestor financeiro com um ledger sintético')
+    parser.add_argument('--faturamentos', type=int, default=10000)
+    parser.add_argument('--custos', type=int, default=20000)
+    parser.add_argument('--categorias', type=int, default=10)
+    parser.add_argument('--subcategorias', type=int, default=3, help='subcategorias por categoria')
+    parser.add_argument('--dias', type=int, default=730, help='espalhamento das datas, em dias até hoje')
+    parser.add_argument('--lucros', type=int, default=365, help='pontos na série de lucros')
+    parser.add_argument('--usuarios', type=int, default=1000, help='usuários cadastrados (caminho de login)')
+    parser.add_argument('--repeticoes', type=int, default=20)
+    parser.add_argument('--backend', choices=('json', 'binario', 'segmentado', 'sqlite'), default='json')
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--json', help='grava os resultados neste arquivo')
+    parser.add_argument('--comparar', help='resultados de referência (gerados com --json)')
+    parser.add_argument('--tolerancia', type=float, default=0.2)
+    args = parser.parse_args()
+
+    # Tudo roda em um diretório temporário: dados_usuarios é relativo ao diretório atual
+    origem = os.getcwd()
+    temporario = tempfile.mkdtemp(prefix='benchmark_gestor_')
+    os.chdir(temporario)
+    try:
+        resultados = executar(args)
+    finally:
+        os.chdir(origem)
+        shutil.rmtree(temporario, ignore_errors=True)
+
+    imprimir(resultados)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'parametros': vars(args), 'resultados': resultados}, f, indent=2)
+    if args.comparar:
+        with open(args.comparar) as f:
+            base = json.load(f)
+        diferentes = [chave for chave, valor in base['parametros'].items()
+                      if chave not in ('json', 'comparar', 'tolerancia', 'repeticoes') and vars(args).get(chave) != valor]
+        if diferentes:
+            print(f"Aviso: a referência foi gerada com parâmetros diferentes ({', '.join(diferentes)})")
+        if comparar(resultados, base['resultados'], args.tolerancia):
+            sys.exit(1)
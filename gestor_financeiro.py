@@ -0,0 +1,3859 @@
+# Motor do gestor financeiro (armazenamento, ledger, análise, importação e usuários), sem dependência de interface
+import io
+import json
+import calendar
+import mmap
+import os
+import sqlite3
+import glob
+import csv
+import re
+import struct
+import sys
+import time
+import math
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from fractions import Fraction
+import hashlib
+import atexit
+import itertools
+import hmac
+import secrets
+import threading
+import weakref
+import copy
+import logging
+import multiprocessing
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import pathname2url
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    # Sem flock (Windows): as gravações ficam serializadas apenas dentro do processo
+    fcntl = None
+
+# Quantidade de registros no journal que dispara a compactação em um novo snapshot
+LIMITE_JOURNAL = 500
+
+# Snapshot binário: assinatura, tamanho do manifesto (JSON) e o manifesto, seguidos das seções alinhadas em 8 bytes
+ASSINATURA_LIVRO = b'GFLIVRO1'
+
+# Registros mais recentes guardados no manifesto do snapshot binário, para o Dashboard não ler o ledger
+REGISTROS_NO_RESUMO = 20
+
+# Operações que não dependem do estado carregado para serem aplicadas
+OPERACOES_SEM_ESTADO = ('add_faturamento', 'add_custo', 'lucro', 'reter_lucros', 'fechar_regras')
+
+# Operações sobre as regras recorrentes, que não tocam o ledger (ver SistemaFinanceiro.adicionar_regra)
+OPERACOES_REGRAS = ('add_regra', 'upd_regra', 'rem_regra')
+
+# Passo de cada frequência das regras recorrentes, em (meses, dias)
+FREQUENCIAS_RECORRENCIA = {'semanal': (0, 7), 'mensal': (1, 0), 'trimestral': (3, 0), 'anual': (12, 0)}
+
+# Política da série de lucros: um ponto por dia nos últimos LUCROS_DIAS_DIARIOS dias,
+# um ponto por mês antes disso e descarte após LUCROS_MESES_RETENCAO meses (None mantém tudo)
+LUCROS_DIAS_DIARIOS = 90
+LUCROS_MESES_RETENCAO = None
+
+# Pontos máximos de uma série temporal enviada a um gráfico (ver reduzir_serie)
+MAX_PONTOS_SERIE = 400
+
+# Linhas por bloco nas exportações: a memória usada não depende do tamanho do ledger
+TAMANHO_BLOCO_EXPORTACAO = 50000
+
+# Previsão (ver ajustar_previsoes): meses previstos por padrão e pesos da suavização exponencial com tendência
+# amortecida e sazonalidade anual aditiva. A sazonalidade só entra na previsão de séries com dois anos de meses
+PREVISAO_HORIZONTE = 6
+PREVISAO_ALFA = 0.4
+PREVISAO_BETA = 0.1
+PREVISAO_GAMA = 0.3
+PREVISAO_AMORTECIMENTO = 0.9
+
+# Formato dos ids gerados por novo_id(); o livro colunar guarda cada um como um inteiro de 64 bits
+ID_VALIDO = re.compile(r'[0-9a-f]{16}')
+
+def novo_id():
+    # Identificador estável de um registro; não muda com remoções ou edições de outros registros
+    return secrets.token_hex(8)
+
+def para_centavos(valor):
+    # Reais (int, float, str ou Decimal) -> centavos inteiros, meio centavo arredondado para cima.
+    # Floats passam pelo texto: 0.29 vira 29 centavos, e não 28.999999999999996
+    try:
+        return int((Decimal(str(valor)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except (InvalidOperation, ValueError):
+        raise ValueError(f"valor inválido: {valor!r}") from None
+
+def normalizar_registro(registro):
+    # Registros gravados antes dos centavos guardavam o valor em reais como float
+    if 'centavos' not in registro:
+        registro['centavos'] = para_centavos(registro.pop('valor'))
+    return registro
+
+def com_valor(registro):
+    # Visão pública de um registro: o valor em reais ao lado dos centavos exatos
+    return {'id': registro['id'], 'valor': registro['centavos'] / 100, **registro}
+
+def distribuir_centavos(total, pesos):
+    # Maiores restos: cada parte recebe o piso da sua cota exata e os centavos que sobram vão, um a um,
+    # para as maiores partes fracionárias (empates na ordem dos pesos); a soma é exatamente o total
+    soma = sum(pesos)
+    cotas = [Fraction(total) * peso / soma for peso in pesos]
+    partes = [math.floor(cota) for cota in cotas]
+    ordem = sorted(range(len(cotas)), key=lambda i: cotas[i] - partes[i], reverse=True)
+    for i in ordem[:total - sum(partes)]:
+        partes[i] += 1
+    return partes
+
+def limites_serie_lucros(hoje, dias_diarios, meses_retencao):
+    # Datas a partir das quais os pontos são diários e antes das quais são descartados
+    hoje = datetime.strptime(hoje, '%Y-%m-%d')
+    limite_diario = (hoje - timedelta(days=dias_diarios)).strftime('%Y-%m-%d')
+    limite_retencao = ''
+    if meses_retencao is not None:
+        meses = hoje.year * 12 + hoje.month - 1 - meses_retencao
+        limite_retencao = f'{meses // 12:04d}-{meses % 12 + 1:02d}-01'
+    return limite_diario, limite_retencao
+
+def compactar_serie_lucros(lucros, hoje, dias_diarios=LUCROS_DIAS_DIARIOS, meses_retencao=LUCROS_MESES_RETENCAO):
+    limite_diario, limite_retencao = limites_serie_lucros(hoje, dias_diarios, meses_retencao)
+
+    # Último ponto de cada dia (ou de cada mês, nos dados antigos) prevalece
+    pontos = {}
+    for ponto in lucros:
+        if ponto['data'] < limite_retencao:
+            continue
+        chave = ponto['data'] if ponto['data'] >= limite_diario else ponto['data'][:7]
+        pontos[chave] = ponto
+    return list(pontos.values())
+
+def somar_meses(dia, meses):
+    # Mesmo dia do mês `meses` meses depois, limitado ao último dia de meses mais curtos
+    ano, mes = divmod(dia.month - 1 + meses, 12)
+    ano += dia.year
+    return date(ano, mes + 1, min(dia.day, calendar.monthrange(ano, mes + 1)[1]))
+
+def ocorrencias_regra(regra, fim, inicio=None):
+    # Datas ('AAAA-MM-DD') das ocorrências de uma regra recorrente em [inicio, fim] que ainda não foram
+    # materializadas no ledger (as posteriores a fechado_ate). O dia do mês das regras mensais, trimestrais
+    # e anuais é o do início da regra
+    primeira = date.fromisoformat(regra['inicio'])
+    desde = primeira
+    if regra.get('fechado_ate'):
+        desde = max(desde, date.fromisoformat(regra['fechado_ate']) + timedelta(days=1))
+    if inicio is not None:
+        desde = max(desde, pd.Timestamp(inicio).date())
+    ate = pd.Timestamp(fim).date()
+    if regra.get('fim'):
+        ate = min(ate, date.fromisoformat(regra['fim']))
+    if desde > ate:
+        return []
+
+    meses, dias = FREQUENCIAS_RECORRENCIA[regra['frequencia']]
+    datas = []
+    if dias:
+        dia = primeira + timedelta(days=-(-(desde - primeira).days // dias) * dias)
+        while dia <= ate:
+            datas.append(dia.isoformat())
+            dia += timedelta(days=dias)
+        return datas
+    # Começa pela ocorrência do mês anterior a `desde`, sem percorrer as anteriores
+    n = max(((desde.year - primeira.year) * 12 + desde.month - primeira.month) // meses - 1, 0)
+    while True:
+        dia = somar_meses(primeira, n * meses)
+        if dia > ate:
+            return datas
+        if dia >= desde:
+            datas.append(dia.isoformat())
+        n += 1
+
+def id_ocorrencia(id_regra, data):
+    # Id do registro de uma ocorrência: o mesmo na projeção e depois de materializado
+    return hashlib.sha256(f'{id_regra}:{data}'.encode()).hexdigest()[:16]
+
+class Metricas:
+    # Contadores e histogramas de tempo do processo, exportados no formato texto do Prometheus.
+    # Cada thread (um rerun do Streamlit, uma requisição da API) também acumula o detalhamento
+    # da própria execução, a partir de iniciar_coleta()
+    LIMITES = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self._trava = threading.Lock()
+        self._contadores = {}
+        self._histogramas = {}
+        self._local = threading.local()
+        self.limite_lento = float(os.environ.get('GESTOR_LENTO_MS', 1000)) / 1000
+
+    def incrementar(self, nome, valor=1, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._trava:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+        self._coletar(chave, rotulos, 0.0, valor)
+
+    def observar(self, nome, segundos, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._trava:
+            histograma = self._histogramas.get(chave)
+            if histograma is None:
+                histograma = self._histogramas[chave] = [0, 0.0] + [0] * len(self.LIMITES)
+            histograma[0] += 1
+            histograma[1] += segundos
+            for i, limite in enumerate(self.LIMITES):
+                if segundos <= limite:
+                    histograma[2 + i] += 1
+        self._coletar(chave, rotulos, segundos, 0)
+
+        # Log estruturado: uma linha JSON por medição em DEBUG, ou em WARNING quando passa do limite
+        nivel = logging.WARNING if segundos >= self.limite_lento else logging.DEBUG
+        if logger.isEnabledFor(nivel):
+            logger.log(nivel, json.dumps(dict(rotulos, metrica=nome, ms=round(segundos * 1000, 3)),
+                                         ensure_ascii=False, default=str))
+
+    @contextmanager
+    def medir(self, nome, **rotulos):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(nome, time.perf_counter() - inicio, **rotulos)
+
+    def _coletar(self, chave, rotulos, segundos, valor):
+        coleta = getattr(self._local, 'coleta', None)
+        if coleta is not None:
+            item = coleta.get(chave)
+            if item is None:
+                item = coleta[chave] = [chave[0], rotulos, 0, 0.0, 0]
+            item[2] += 1
+            item[3] += segundos
+            item[4] += valor
+
+    def iniciar_coleta(self):
+        self._local.coleta = {}
+
+    def coleta(self):
+        # Detalhamento da execução atual: (nome, rótulos, chamadas, segundos, valor) por métrica
+        return [tuple(item) for item in (getattr(self._local, 'coleta', None) or {}).values()]
+
+    def texto_prometheus(self):
+        def formatar_rotulos(rotulos, extra=()):
+            pares = [(chave, str(valor)) for chave, valor in rotulos] + list(extra)
+            if not pares:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(
+                chave, valor.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for chave, valor in pares) + '}'
+
+        with self._trava:
+            contadores = sorted(self._contadores.items())
+            histogramas = sorted((chave, list(valores)) for chave, valores in self._histogramas.items())
+
+        linhas = []
+        tipos = set()
+        for (nome, rotulos), valor in contadores:
+            if nome not in tipos:
+                tipos.add(nome)
+                linhas.append(f'# TYPE {nome} counter')
+            linhas.append(f'{nome}{formatar_rotulos(rotulos)} {valor}')
+        for (nome, rotulos), (contagem, soma, *baldes) in histogramas:
+            if nome not in tipos:
+                tipos.add(nome)
+                linhas.append(f'# TYPE {nome} histogram')
+            for limite, quantidade in zip(self.LIMITES, baldes):
+                linhas.append(f'{nome}_bucket{formatar_rotulos(rotulos, [("le", str(limite))])} {quantidade}')
+            linhas.append(f'{nome}_bucket{formatar_rotulos(rotulos, [("le", "+Inf")])} {contagem}')
+            linhas.append(f'{nome}_sum{formatar_rotulos(rotulos)} {soma}')
+            linhas.append(f'{nome}_count{formatar_rotulos(rotulos)} {contagem}')
+        return '\n'.join(linhas) + '\n'
+
+logger = logging.getLogger('gestor_financeiro')
+metricas = Metricas()
+
+def iniciar_servidor_metricas(porta, host='127.0.0.1'):
+    # Endpoint /metrics para o Prometheus em uma thread de fundo do próprio processo. Sem autenticação:
+    # por padrão só atende a própria máquina, e expor na rede (host='0.0.0.0') é uma escolha explícita
+    class Tratador(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/metricas'):
+                self.send_error(404)
+                return
+            conteudo = metricas.texto_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(conteudo)))
+            self.end_headers()
+            self.wfile.write(conteudo)
+
+        def log_message(self, formato, *args):
+            pass
+
+    servidor = ThreadingHTTPServer((host, porta), Tratador)
+    threading.Thread(target=servidor.serve_forever, name='metricas-gestor', daemon=True).start()
+    return servidor
+
+class TravaArquivo:
+    # Trava consultiva (flock) entre processos e workers que compartilham o diretório de dados;
+    # reentrante dentro da mesma instância. Compartilhada: leitores somente leitura não bloqueiam uns aos outros
+    def __init__(self, caminho, compartilhada=False):
+        self.caminho = caminho
+        self.compartilhada = compartilhada
+        self._trava = threading.RLock()
+        self._arquivo = None
+        self._nivel = 0
+
+    def __enter__(self):
+        self._trava.acquire()
+        if self._nivel == 0:
+            self._arquivo = open(self.caminho, 'a')
+            if fcntl is not None:
+                fcntl.flock(self._arquivo.fileno(), fcntl.LOCK_SH if self.compartilhada else fcntl.LOCK_EX)
+        self._nivel += 1
+        return self
+
+    def __exit__(self, *excecao):
+        self._nivel -= 1
+        if self._nivel == 0:
+            # Fechar o descritor libera o flock
+            self._arquivo.close()
+            self._arquivo = None
+        self._trava.release()
+
+def gravar_atomico(caminho, escrever, modo='w'):
+    # Escreve em um temporário no mesmo diretório e troca com os.replace:
+    # leitores veem o arquivo antigo ou o novo, nunca um arquivo pela metade
+    temporario = f'{caminho}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temporario, modo, encoding=None if 'b' in modo else 'utf-8') as f:
+            escrever(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporario, caminho)
+    except BaseException:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+
+def escrever_json(f, valor):
+    # Como json.dump, mas listas e geradores são escritos item a item: o snapshot de um ledger grande
+    # não precisa existir inteiro em memória como lista de dicionários
+    if isinstance(valor, dict):
+        f.write('{')
+        for i, (chave, item) in enumerate(valor.items()):
+            f.write(',' if i else '')
+            f.write(json.dumps(str(chave)) + ':')
+            escrever_json(f, item)
+        f.write('}')
+    elif valor is None or isinstance(valor, (str, int, float)):
+        f.write(json.dumps(valor))
+    else:
+        f.write('[')
+        for i, item in enumerate(valor):
+            f.write(',' if i else '')
+            f.write(json.dumps(item, separators=(',', ':')))
+        f.write(']')
+
+@contextmanager
+def mapear_secoes(caminho):
+    # Manifesto e leitor de seções de um arquivo gravado por gravar_secoes(), mapeado em memória. As seções são
+    # visões numpy sem cópia, válidas só dentro do bloco: quem as usa copia o que precisa antes de sair
+    with open(caminho, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapa:
+        if mapa[:len(ASSINATURA_LIVRO)] != ASSINATURA_LIVRO:
+            raise ValueError(f"arquivo binário inválido: {caminho}")
+        tamanho, = struct.unpack_from('<Q', mapa, len(ASSINATURA_LIVRO))
+        cabecalho = len(ASSINATURA_LIVRO) + 8
+        manifesto = json.loads(mapa[cabecalho:cabecalho + tamanho])
+        base = -(-(cabecalho + tamanho) // 8) * 8
+
+        def secao(nome):
+            inicio, quantidade, tipo = manifesto['secoes'][nome]
+            return np.frombuffer(mapa, dtype=tipo, count=quantidade, offset=base + inicio)
+        yield manifesto, secao
+
+def gravar_secoes(caminho, manifesto, secoes):
+    # Manifesto (JSON) + seções (arrays numpy), cada uma alinhada em 8 bytes, gravados atomicamente
+    manifesto = dict(manifesto, secoes={})
+    posicao = 0
+    for nome, coluna in secoes.items():
+        manifesto['secoes'][nome] = [posicao, len(coluna), coluna.dtype.str]
+        posicao += -(-coluna.nbytes // 8) * 8
+    texto_manifesto = json.dumps(manifesto, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def escrever(f):
+        cabecalho = ASSINATURA_LIVRO + struct.pack('<Q', len(texto_manifesto)) + texto_manifesto
+        f.write(cabecalho + bytes(-len(cabecalho) % 8))
+        for coluna in secoes.values():
+            f.write(memoryview(coluna).cast('B'))
+            f.write(bytes(-coluna.nbytes % 8))
+    gravar_atomico(caminho, escrever, modo='wb')
+
+class ArmazenamentoJSON:
+    # Snapshot JSON completo + journal append-only com uma linha por mutação
+    consultas_indexadas = False
+    nome = 'json'
+
+    def __init__(self, usuario, diretorio='dados_usuarios', somente_leitura=False):
+        self.usuario = usuario
+        self.diretorio = diretorio
+        self.arquivo_snapshot = os.path.join(diretorio, f'{usuario}_dados.json')
+        self.arquivo_journal = os.path.join(diretorio, f'{usuario}_dados.journal')
+        self._registros_journal = 0
+        if not os.path.exists(diretorio):
+            os.makedirs(diretorio)
+        self.trava = TravaArquivo(os.path.join(diretorio, f'{usuario}_dados.lock'), compartilhada=somente_leitura)
+
+    def carregar(self):
+        return self._carregar_documento(self.arquivo_snapshot)
+
+    def _carregar_documento(self, caminho):
+        dados = {
+            'faturamentos': [],
+            'custos': {'categorias': {}},
+            'lucros': []
+        }
+        if os.path.exists(caminho):
+            with open(caminho, 'r') as f:
+                dados = json.load(f)
+                metricas.incrementar('gestor_bytes_lidos_total', f.tell(), backend=self.nome)
+        seq = dados.pop('seq', 0)
+        agregados = dados.pop('agregados', None)
+        return dados, seq, self._ler_journal(seq), agregados
+
+    def carregar_resumo(self):
+        # O snapshot JSON só é lido inteiro
+        return None
+
+    def _ler_journal(self, seq):
+        # Mutações registradas depois do snapshot, a serem reaplicadas sobre ele
+        self._registros_journal = 0
+        if not os.path.exists(self.arquivo_journal):
+            return []
+
+        ops = []
+        posicao_valida = 0
+        with open(self.arquivo_journal, 'rb') as f:
+            for linha in f:
+                if not linha.endswith(b'\n'):
+                    break
+                try:
+                    op = json.loads(linha)
+                except ValueError:
+                    break
+                posicao_valida += len(linha)
+                # Um lote (uma transação) ocupa uma única linha: ou é reaplicado inteiro ou descartado
+                lote = op['ops'] if op['op'] == 'lote' else [op]
+                self._registros_journal += len(lote)
+                ops.extend(o for o in lote if o['seq'] > seq)
+
+        metricas.incrementar('gestor_bytes_lidos_total', posicao_valida, backend=self.nome)
+        # Descarta um registro final incompleto (queda durante a escrita)
+        if posicao_valida < os.path.getsize(self.arquivo_journal):
+            with open(self.arquivo_journal, 'r+b') as f:
+                f.truncate(posicao_valida)
+        return ops
+
+    def gravar(self, ops, agregados):
+        if len(ops) > 1:
+            ops = [{'op': 'lote', 'ops': ops, 'seq': ops[-1]['seq']}]
+        linhas = ''.join(
+            json.dumps(op, ensure_ascii=False, separators=(',', ':')) + '\n'
+            for op in ops
+        ).encode('utf-8')
+        with open(self.arquivo_journal, 'ab') as f:
+            f.write(linhas)
+            f.flush()
+            os.fsync(f.fileno())
+        self._registros_journal += len(ops)
+        metricas.incrementar('gestor_bytes_escritos_total', len(linhas), backend=self.nome)
+
+    def assinatura(self):
+        # Muda a cada escrita no snapshot ou no journal, inclusive por outros processos
+        estados = []
+        for arquivo in (self.arquivo_snapshot, self.arquivo_journal):
+            try:
+                info = os.stat(arquivo)
+                estados.append((info.st_mtime_ns, info.st_size))
+            except FileNotFoundError:
+                estados.append(None)
+        return tuple(estados)
+
+    def tamanho_bytes(self):
+        return sum(os.path.getsize(arquivo) for arquivo in (self.arquivo_snapshot, self.arquivo_journal)
+                   if os.path.exists(arquivo))
+
+    def precisa_compactar(self):
+        return self._registros_journal >= LIMITE_JOURNAL
+
+    def compactar(self, livro, lucros, seq, agregados, regras):
+        # Grava o estado completo em um novo snapshot e descarta o journal
+        dados = livro.documento(lucros, listas=False)
+        gravar_atomico(self.arquivo_snapshot, lambda f: escrever_json(
+            f, dict(dados, seq=seq, agregados=agregados, regras=regras)))
+        metricas.incrementar('gestor_bytes_escritos_total', os.path.getsize(self.arquivo_snapshot), backend=self.nome)
+        self._descartar_journal()
+
+    def _descartar_journal(self):
+        # Se houver queda antes desta remoção, o campo seq do snapshot evita reaplicar o journal
+        if os.path.exists(self.arquivo_journal):
+            os.remove(self.arquivo_journal)
+        self._registros_journal = 0
+
+class ArmazenamentoBinario(ArmazenamentoJSON):
+    # Snapshot binário colunar + o mesmo journal do backend JSON. O manifesto no início do arquivo traz seq,
+    # agregados, lucros e os registros mais recentes; as colunas do livro vêm depois e são lidas por mmap,
+    # inteiras (carregar) ou só as linhas de um período (ler_periodo). Sem snapshot binário, lê o snapshot
+    # JSON existente; a próxima compactação grava o binário no lugar dele
+    nome = 'binario'
+
+    def __init__(self, usuario, diretorio='dados_usuarios', somente_leitura=False):
+        super().__init__(usuario, diretorio, somente_leitura)
+        self.arquivo_json = self.arquivo_snapshot
+        self.arquivo_snapshot = os.path.join(diretorio, f'{usuario}_dados.livro')
+
+    def carregar(self):
+        if not os.path.exists(self.arquivo_snapshot):
+            return self._carregar_documento(self.arquivo_json)
+        with self._mapear() as (manifesto, secao):
+            dados = {'livro': LivroColunar.de_secoes(manifesto, secao), 'lucros': manifesto['lucros'],
+                     'regras': manifesto.get('regras', [])}
+        metricas.incrementar('gestor_bytes_lidos_total', os.path.getsize(self.arquivo_snapshot), backend=self.nome)
+        return dados, manifesto['seq'], self._ler_journal(manifesto['seq']), manifesto['agregados']
+
+    def carregar_resumo(self):
+        # Só o manifesto, e só quando o snapshot binário está em dia (journal vazio); None pede a carga completa
+        if not os.path.exists(self.arquivo_snapshot) or (
+                os.path.exists(self.arquivo_journal) and os.path.getsize(self.arquivo_journal)):
+            return None
+        with self._mapear() as (manifesto, _):
+            pass
+        self._registros_journal = 0
+        manifesto['ultimos_custos'] = [tuple(custo) for custo in manifesto['ultimos_custos']]
+        return manifesto
+
+    def ler_periodo(self, inicio, fim, seq):
+        # Livro (somente leitura) com as linhas do período [inicio, fim], achadas por busca binária na ordem
+        # por data do snapshot; None se o snapshot não corresponde mais ao seq esperado
+        if not os.path.exists(self.arquivo_snapshot):
+            return None
+        with self._mapear() as (manifesto, secao):
+            if manifesto['seq'] != seq:
+                return None
+            datas = secao('datas_ordenadas')
+            primeiro = np.searchsorted(datas, pd.Timestamp(inicio).toordinal(), 'left') if inicio is not None else 0
+            ultimo = np.searchsorted(datas, pd.Timestamp(fim).toordinal(), 'right') if fim is not None else len(datas)
+            linhas = np.sort(secao('ordem_datas')[primeiro:ultimo])
+            del datas
+            livro = LivroColunar.de_secoes(manifesto, secao, linhas)
+        metricas.incrementar('gestor_registros_lidos_total', len(livro), origem='periodo')
+        return livro
+
+    def _mapear(self):
+        return mapear_secoes(self.arquivo_snapshot)
+
+    def somas_por_mes_categoria(self, seq):
+        # O manifesto não tem somas por mês: None pede a leitura do ledger
+        return None
+
+    def compactar(self, livro, lucros, seq, agregados, regras):
+        metadados, secoes = livro.secoes()
+        gravar_secoes(self.arquivo_snapshot, dict(
+            metadados, versao=1, seq=seq, agregados=agregados, lucros=lucros, regras=regras,
+            ultimos_faturamentos=livro.ultimos_faturamentos(REGISTROS_NO_RESUMO),
+            ultimos_custos=livro.ultimos_custos(REGISTROS_NO_RESUMO)), secoes)
+        metricas.incrementar('gestor_bytes_escritos_total', os.path.getsize(self.arquivo_snapshot), backend=self.nome)
+        self._descartar_journal()
+        # O snapshot JSON de antes da conversão não é mais lido. Daqui em diante criar_armazenamento abre o
+        # usuário neste backend pelos arquivos, qualquer que seja GESTOR_ARMAZENAMENTO
+        if os.path.exists(self.arquivo_json):
+            os.remove(self.arquivo_json)
+
+    def assinatura(self):
+        return super().assinatura() + (os.path.exists(self.arquivo_json),)
+
+    def tamanho_bytes(self):
+        return super().tamanho_bytes() + (os.path.getsize(self.arquivo_json) if os.path.exists(self.arquivo_json) else 0)
+
+class CacheSegmentos:
+    # Segmentos mensais já decodificados, compartilhados por todos os sistemas do processo, com despejo LRU
+    # por memória. Um arquivo de segmento nunca é reescrito (cada regravação usa um nome novo), então o
+    # caminho basta como chave
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._partes = OrderedDict()
+        self._bytes = 0
+        self._trava = threading.Lock()
+
+    def obter(self, caminho):
+        with self._trava:
+            item = self._partes.get(caminho)
+            if item is not None:
+                self._partes.move_to_end(caminho)
+        metricas.incrementar('gestor_cache_segmentos_total', resultado='acerto' if item is not None else 'falha')
+        return item[0] if item is not None else None
+
+    def guardar(self, caminho, parte):
+        tamanho = parte.tamanho_bytes()
+        with self._trava:
+            if caminho in self._partes or tamanho > self.max_bytes:
+                return
+            self._partes[caminho] = (parte, tamanho)
+            self._bytes += tamanho
+            while self._bytes > self.max_bytes:
+                _, (_, tamanho_despejado) = self._partes.popitem(last=False)
+                self._bytes -= tamanho_despejado
+
+cache_segmentos = CacheSegmentos(int(os.environ.get('GESTOR_CACHE_SEGMENTOS_MB', 64)) * 1024 * 1024)
+
+class ArmazenamentoSegmentado(ArmazenamentoBinario):
+    # Ledger particionado por mês: um arquivo binário por mês (<usuario>_segmentos/AAAA-MM.<seq>.<sufixo>.livro)
+    # e um índice JSON com seq, agregados, lucros, últimos registros e os totais de cada segmento (faturamento
+    # e custos por categoria). A compactação só regrava os meses alterados desde o último snapshot e troca o
+    # índice por último: até lá, o índice antigo continua apontando para os arquivos antigos. Meses fechados
+    # ficam em cache no processo; consultas por período só abrem os meses do período. A ordem de inclusão é
+    # mantida dentro de cada mês; entre meses, vale a ordem cronológica. Sem índice, lê o snapshot binário
+    # ou JSON existente, e a primeira compactação grava todos os meses
+    nome = 'segmentado'
+
+    def __init__(self, usuario, diretorio='dados_usuarios', somente_leitura=False):
+        super().__init__(usuario, diretorio, somente_leitura)
+        self.diretorio_segmentos = os.path.join(diretorio, f'{usuario}_segmentos')
+        self.arquivo_indice = os.path.join(self.diretorio_segmentos, 'indice.json')
+
+    def _ler_indice(self):
+        if not os.path.exists(self.arquivo_indice):
+            return None
+        with open(self.arquivo_indice, 'r', encoding='utf-8') as f:
+            indice = json.load(f)
+            metricas.incrementar('gestor_bytes_lidos_total', f.tell(), backend=self.nome)
+        return indice
+
+    def _ler_segmento(self, mes, segmento):
+        caminho = os.path.join(self.diretorio_segmentos, segmento['arquivo'])
+        parte = cache_segmentos.obter(caminho)
+        if parte is not None:
+            return parte
+        with mapear_secoes(caminho) as (manifesto, secao):
+            parte = LivroColunar.de_secoes(manifesto, secao)
+        metricas.incrementar('gestor_bytes_lidos_total', os.path.getsize(caminho), backend=self.nome)
+        if mes < date.today().strftime('%Y-%m'):
+            # O mês corrente muda a cada compactação; só os fechados valem o cache
+            cache_segmentos.guardar(caminho, parte)
+        return parte
+
+    def carregar(self):
+        indice = self._ler_indice()
+        if indice is None:
+            return super().carregar()
+        partes = [self._ler_segmento(mes, segmento) for mes, segmento in indice['segmentos'].items()]
+        dados = {'livro': LivroColunar.concatenar(partes, indice['destinos']), 'lucros': indice['lucros'],
+                 'regras': indice.get('regras', [])}
+        return dados, indice['seq'], self._ler_journal(indice['seq']), indice['agregados']
+
+    def carregar_resumo(self):
+        indice = self._ler_indice()
+        if indice is None:
+            return super().carregar_resumo()
+        if os.path.exists(self.arquivo_journal) and os.path.getsize(self.arquivo_journal):
+            return None
+        self._registros_journal = 0
+        indice['ultimos_custos'] = [tuple(custo) for custo in indice['ultimos_custos']]
+        return indice
+
+    def ler_periodo(self, inicio, fim, seq):
+        # Só os segmentos dos meses do período; nos meses das pontas, os dias fora dele ficam como lápides
+        indice = self._ler_indice()
+        if indice is None:
+            return super().ler_periodo(inicio, fim, seq)
+        if indice['seq'] != seq:
+            return None
+        primeiro = pd.Timestamp(inicio) if inicio is not None else None
+        ultimo = pd.Timestamp(fim) if fim is not None else None
+        meses = [mes for mes in indice['segmentos']
+                 if (primeiro is None or mes >= primeiro.strftime('%Y-%m'))
+                 and (ultimo is None or mes <= ultimo.strftime('%Y-%m'))]
+        livro = LivroColunar.concatenar(
+            [self._ler_segmento(mes, indice['segmentos'][mes]) for mes in meses], indice['destinos'])
+        datas = np.frombuffer(livro.datas, dtype=np.intc)
+        fora = np.zeros(len(datas), dtype=bool)
+        if primeiro is not None:
+            fora |= datas < primeiro.toordinal()
+        if ultimo is not None:
+            fora |= datas > ultimo.toordinal()
+        livro.vivos = bytearray((~fora).astype(np.uint8).tobytes())
+        livro.mortos = int(fora.sum())
+        metricas.incrementar('gestor_registros_lidos_total', len(livro), origem='periodo')
+        return livro
+
+    def compactar(self, livro, lucros, seq, agregados, regras):
+        indice = self._ler_indice()
+        os.makedirs(self.diretorio_segmentos, exist_ok=True)
+        segmentos = dict(indice['segmentos']) if indice is not None else {}
+        meses_linha = livro.meses()
+        presentes = {str(np.datetime64(mes, 'M')) for mes in np.unique(meses_linha).tolist()}
+        alterados = presentes if indice is None else livro.meses_alterados | (presentes - set(segmentos))
+
+        destinos = np.frombuffer(livro.destinos, dtype=np.intc)
+        centavos = np.frombuffer(livro.centavos, dtype=np.int64)
+        escritos = 0
+        for mes in sorted(alterados):
+            linhas = np.flatnonzero(meses_linha == np.datetime64(mes, 'M').astype('int64'))
+            if not len(linhas):
+                segmentos.pop(mes, None)
+                continue
+            arquivo = f'{mes}.{seq}.{secrets.token_hex(4)}.livro'
+            caminho = os.path.join(self.diretorio_segmentos, arquivo)
+            metadados, secoes = livro.secoes(linhas)
+            gravar_secoes(caminho, dict(metadados, versao=1, mes=mes, seq=seq), secoes)
+            escritos += os.path.getsize(caminho)
+
+            por_destino = np.zeros(len(livro.tabela_destinos), dtype=np.int64)
+            np.add.at(por_destino, destinos[linhas], centavos[linhas])
+            categorias = {}
+            for codigo, (categoria, _) in enumerate(livro.tabela_destinos[1:], start=1):
+                if por_destino[codigo]:
+                    categorias[categoria] = categorias.get(categoria, 0) + int(por_destino[codigo])
+            segmentos[mes] = {
+                'arquivo': arquivo,
+                'linhas': len(linhas),
+                'faturamento': int(por_destino[0]),
+                'custos': int(por_destino[1:].sum()),
+                'categorias': categorias
+            }
+
+        indice = {
+            'versao': 1,
+            'seq': seq,
+            'agregados': agregados,
+            'lucros': lucros,
+            'regras': regras,
+            'destinos': livro.tabela_destinos,
+            'ultimos_faturamentos': livro.ultimos_faturamentos(REGISTROS_NO_RESUMO),
+            'ultimos_custos': livro.ultimos_custos(REGISTROS_NO_RESUMO),
+            'segmentos': dict(sorted(segmentos.items()))
+        }
+        gravar_atomico(self.arquivo_indice,
+                       lambda f: json.dump(indice, f, ensure_ascii=False, separators=(',', ':')))
+        escritos += os.path.getsize(self.arquivo_indice)
+        metricas.incrementar('gestor_bytes_escritos_total', escritos, backend=self.nome)
+        self._descartar_journal()
+
+        # Arquivos que o índice não referencia mais: versões antigas dos meses regravados, sobras de
+        # compactações interrompidas e os snapshots de antes da conversão. Sem eles, criar_armazenamento
+        # reconhece o usuário pelo índice e continua abrindo este backend
+        referenciados = {segmento['arquivo'] for segmento in segmentos.values()}
+        for nome in os.listdir(self.diretorio_segmentos):
+            if nome.endswith('.livro') and nome not in referenciados:
+                os.remove(os.path.join(self.diretorio_segmentos, nome))
+        for arquivo in (self.arquivo_snapshot, self.arquivo_json):
+            if os.path.exists(arquivo):
+                os.remove(arquivo)
+
+    def somas_por_mes_categoria(self, seq):
+        # Somas por ('AAAA-MM', categoria) direto dos totais de cada segmento no índice, sem abrir os segmentos;
+        # None se o índice não corresponde mais ao seq esperado
+        indice = self._ler_indice()
+        if indice is None:
+            return super().somas_por_mes_categoria(seq)
+        if indice['seq'] != seq:
+            return None
+        somas = {}
+        for mes, segmento in indice['segmentos'].items():
+            somas[(mes, None)] = segmento['faturamento']
+            for categoria, total in segmento['categorias'].items():
+                somas[(mes, categoria)] = total
+        return somas
+
+    def segmentos(self):
+        # Totais de cada mês gravados no índice ({'AAAA-MM': {'linhas', 'faturamento', 'custos', 'categorias'}},
+        # em centavos), sem abrir os segmentos; não inclui o que ainda está no journal
+        indice = self._ler_indice()
+        if indice is None:
+            return {}
+        return {mes: {chave: valor for chave, valor in segmento.items() if chave != 'arquivo'}
+                for mes, segmento in indice['segmentos'].items()}
+
+    def assinatura(self):
+        try:
+            info = os.stat(self.arquivo_indice)
+            indice = (info.st_mtime_ns, info.st_size)
+        except FileNotFoundError:
+            indice = None
+        return super().assinatura() + (indice,)
+
+    def tamanho_bytes(self):
+        segmentos = 0
+        if os.path.isdir(self.diretorio_segmentos):
+            segmentos = sum(entrada.stat().st_size for entrada in os.scandir(self.diretorio_segmentos))
+        return super().tamanho_bytes() + segmentos
+
+class ArmazenamentoSQLite:
+    # Tabelas indexadas por data e categoria; totais e listagens são resolvidos em SQL
+    consultas_indexadas = True
+    nome = 'sqlite'
+
+    ESQUEMA = '''
+        CREATE TABLE IF NOT EXISTS faturamentos (
+            id INTEGER PRIMARY KEY,
+            rid TEXT,
+            valor REAL NOT NULL,
+            descricao TEXT,
+            data TEXT NOT NULL,
+            centavos INTEGER
+        );
+
+        CREATE TABLE IF NOT EXISTS custos (
+            id INTEGER PRIMARY KEY,
+            rid TEXT,
+            categoria TEXT NOT NULL,
+            subcategoria TEXT,
+            valor REAL NOT NULL,
+            descricao TEXT,
+            data TEXT NOT NULL,
+            centavos INTEGER
+        );
+
+        CREATE TABLE IF NOT EXISTS lucros (
+            id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            lucro REAL NOT NULL,
+            faturamento_total REAL NOT NULL,
+            custos_total REAL NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS meta (
+            chave TEXT PRIMARY KEY,
+            valor
+        );
+
+        CREATE TABLE IF NOT EXISTS regras (
+            id TEXT PRIMARY KEY,
+            dados TEXT NOT NULL
+        );
+    '''
+
+    # Objetos do esquema atual; um banco sem algum deles ainda não passou pelas migrações
+    OBJETOS_MIGRADOS = ('regras', 'idx_lucros_data', 'idx_custos_rid', 'idx_custos_data_centavos')
+
+    def __init__(self, usuario, diretorio='dados_usuarios', somente_leitura=False):
+        self.usuario = usuario
+        self.diretorio = diretorio
+        self.arquivo = os.path.join(diretorio, f'{usuario}_dados.sqlite3')
+        if not os.path.exists(diretorio):
+            os.makedirs(diretorio)
+        self.trava = TravaArquivo(os.path.join(diretorio, f'{usuario}_dados.lock'), compartilhada=somente_leitura)
+        if somente_leitura:
+            # Conexão mode=ro: nem o esquema nem as migrações são gravados
+            self.conexao = sqlite3.connect(f'file:{pathname2url(os.path.abspath(self.arquivo))}?mode=ro',
+                                           uri=True, check_same_thread=False)
+            marcadores = ', '.join('?' * len(self.OBJETOS_MIGRADOS))
+            migrados = self.conexao.execute(f'SELECT COUNT(*) FROM sqlite_master WHERE name IN ({marcadores})',
+                                            self.OBJETOS_MIGRADOS).fetchone()[0]
+            if migrados < len(self.OBJETOS_MIGRADOS):
+                self.conexao.close()
+                raise ValueError(f'O banco de {usuario} precisa ser aberto uma vez para escrita (migração do esquema)')
+            return
+        self.conexao = sqlite3.connect(self.arquivo, check_same_thread=False)
+        with self.trava:
+            self.conexao.executescript(self.ESQUEMA)
+            self._migrar_lucros()
+            self._migrar_ids()
+            self._migrar_centavos()
+
+    def _migrar_ids(self):
+        # Bancos antigos não tinham o identificador estável (rid); gera um para cada registro existente
+        with self.conexao:
+            for tabela in ('faturamentos', 'custos'):
+                colunas = [linha[1] for linha in self.conexao.execute(f'PRAGMA table_info({tabela})')]
+                if 'rid' not in colunas:
+                    self.conexao.execute(f'ALTER TABLE {tabela} ADD COLUMN rid TEXT')
+                self.conexao.execute(f'UPDATE {tabela} SET rid = lower(hex(randomblob(8))) WHERE rid IS NULL')
+                self.conexao.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{tabela}_rid ON {tabela} (rid)')
+
+    def _migrar_centavos(self):
+        # Bancos antigos só tinham valor REAL; centavos passa a ser a coluna somada e indexada,
+        # e valor fica como espelho em reais para quem lê o banco diretamente
+        if self.conexao.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_custos_data_centavos'").fetchone():
+            return
+        with self.conexao:
+            for tabela in ('faturamentos', 'custos'):
+                colunas = [linha[1] for linha in self.conexao.execute(f'PRAGMA table_info({tabela})')]
+                if 'centavos' not in colunas:
+                    self.conexao.execute(f'ALTER TABLE {tabela} ADD COLUMN centavos INTEGER')
+                # Convertidos por para_centavos, como em qualquer outro caminho: o ROUND do SQLite arredonda o
+                # float multiplicado (2.675 * 100 = 267.49999...) e daria outro centavo para o mesmo valor
+                pendentes = self.conexao.execute(f'SELECT id, valor FROM {tabela} WHERE centavos IS NULL').fetchall()
+                self.conexao.executemany(f'UPDATE {tabela} SET centavos = ? WHERE id = ?',
+                                         [(para_centavos(valor), linha) for linha, valor in pendentes])
+            for indice in ('idx_faturamentos_data', 'idx_custos_categoria', 'idx_custos_data'):
+                self.conexao.execute(f'DROP INDEX IF EXISTS {indice}')
+            self.conexao.execute('CREATE INDEX idx_faturamentos_data_centavos ON faturamentos (data, centavos)')
+            self.conexao.execute(
+                'CREATE INDEX idx_custos_categoria_centavos ON custos (categoria, subcategoria, centavos)')
+            self.conexao.execute('CREATE INDEX idx_custos_data_centavos ON custos (data, centavos)')
+            # Os agregados gravados estavam em reais; são recalculados em centavos na próxima carga
+            self.conexao.execute("DELETE FROM meta WHERE chave = 'agregados'")
+
+    def _migrar_lucros(self):
+        # Bancos antigos guardavam um ponto por mutação; mantém o último de cada dia
+        if self.conexao.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'idx_lucros_data'").fetchone():
+            return
+        with self.conexao:
+            self.conexao.execute(
+                'DELETE FROM lucros WHERE id NOT IN (SELECT MAX(id) FROM lucros GROUP BY data)')
+            self.conexao.execute('CREATE UNIQUE INDEX idx_lucros_data ON lucros (data)')
+            self._reter_lucros(datetime.now().strftime('%Y-%m-%d'), LUCROS_DIAS_DIARIOS, LUCROS_MESES_RETENCAO)
+
+    def carregar(self):
+        dados = {
+            'faturamentos': [],
+            'custos': {'categorias': {}},
+            'lucros': []
+        }
+        for rid, centavos, descricao, data in self.conexao.execute(
+                'SELECT rid, centavos, descricao, data FROM faturamentos ORDER BY id'):
+            dados['faturamentos'].append({'id': rid, 'centavos': centavos, 'descricao': descricao, 'data': data})
+
+        categorias = dados['custos']['categorias']
+        for rid, categoria, subcategoria, centavos, descricao, data in self.conexao.execute(
+                'SELECT rid, categoria, subcategoria, centavos, descricao, data FROM custos ORDER BY id'):
+            registro = {'id': rid, 'centavos': centavos, 'descricao': descricao, 'data': data}
+            dados_categoria = categorias.setdefault(categoria, {})
+            if subcategoria:
+                dados_categoria.setdefault('subcategorias', {}).setdefault(subcategoria, []).append(registro)
+            else:
+                dados_categoria.setdefault('registros', []).append(registro)
+
+        for data, lucro, faturamento_total, custos_total in self.conexao.execute(
+                'SELECT data, lucro, faturamento_total, custos_total FROM lucros ORDER BY id'):
+            dados['lucros'].append({
+                'data': data,
+                'lucro': lucro,
+                'faturamento_total': faturamento_total,
+                'custos_total': custos_total
+            })
+
+        dados['regras'] = list(self.carregar_regras().values())
+        return dados, self.ultimo_seq(), [], self.carregar_agregados()
+
+    def ultimo_seq(self):
+        linha = self.conexao.execute("SELECT valor FROM meta WHERE chave = 'seq'").fetchone()
+        return linha[0] if linha else 0
+
+    def assinatura(self):
+        # O seq sozinho não serve de versão: dois processos que partiram do mesmo seq e gravaram o mesmo número
+        # de mutações chegam ao mesmo valor. Cada gravação deixa também uma marca aleatória na tabela meta
+        linhas = dict(self.conexao.execute("SELECT chave, valor FROM meta WHERE chave IN ('seq', 'gravacao')"))
+        return linhas.get('seq', 0), linhas.get('gravacao')
+
+    def tamanho_bytes(self):
+        return os.path.getsize(self.arquivo)
+
+    def carregar_agregados(self):
+        linha = self.conexao.execute("SELECT valor FROM meta WHERE chave = 'agregados'").fetchone()
+        return json.loads(linha[0]) if linha else None
+
+    def carregar_regras(self):
+        return {id_regra: json.loads(dados) for id_regra, dados in
+                self.conexao.execute('SELECT id, dados FROM regras ORDER BY rowid')}
+
+    def _gravar_regra(self, regra):
+        self.conexao.execute('INSERT OR REPLACE INTO regras (id, dados) VALUES (?, ?)',
+                             (regra['id'], json.dumps(regra, ensure_ascii=False, separators=(',', ':'))))
+
+    def gravar(self, ops, agregados):
+        with self.conexao:
+            for op in ops:
+                self._gravar_operacao(op)
+            self.conexao.executemany(
+                'INSERT OR REPLACE INTO meta (chave, valor) VALUES (?, ?)',
+                [('seq', ops[-1]['seq']), ('gravacao', novo_id()),
+                 ('agregados', json.dumps(agregados, separators=(',', ':')))])
+
+    def _gravar_operacao(self, op):
+        tipo = op['op']
+        if tipo == 'add_faturamento':
+            r = op['registro']
+            self.conexao.execute(
+                'INSERT INTO faturamentos (rid, centavos, valor, descricao, data) VALUES (?, ?, ?, ?, ?)',
+                (r['id'], r['centavos'], r['centavos'] / 100, r['descricao'], r['data']))
+        elif tipo == 'add_custo':
+            r = op['registro']
+            self.conexao.execute(
+                'INSERT INTO custos (rid, categoria, subcategoria, centavos, valor, descricao, data) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (r['id'], op['categoria'], op.get('subcategoria') or None, r['centavos'], r['centavos'] / 100,
+                 r['descricao'], r['data']))
+        elif tipo == 'rem':
+            self.conexao.execute('DELETE FROM faturamentos WHERE rid = ?', (op['id'],))
+            self.conexao.execute('DELETE FROM custos WHERE rid = ?', (op['id'],))
+        elif tipo == 'upd':
+            self._atualizar_registro(op['id'], op['campos'])
+        elif tipo == 'lucro':
+            r = op['registro']
+            self.conexao.execute(
+                'INSERT INTO lucros (data, lucro, faturamento_total, custos_total) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (data) DO UPDATE SET lucro = excluded.lucro, '
+                'faturamento_total = excluded.faturamento_total, custos_total = excluded.custos_total',
+                (r['data'], r['lucro'], r['faturamento_total'], r['custos_total']))
+        elif tipo == 'reter_lucros':
+            self._reter_lucros(op['hoje'], op['dias_diarios'], op['meses_retencao'])
+        elif tipo == 'add_regra':
+            self._gravar_regra(op['regra'])
+        elif tipo == 'upd_regra':
+            linha = self.conexao.execute('SELECT dados FROM regras WHERE id = ?', (op['id'],)).fetchone()
+            if linha is not None:
+                self._gravar_regra(dict(json.loads(linha[0]), **op['campos']))
+        elif tipo == 'rem_regra':
+            self.conexao.execute('DELETE FROM regras WHERE id = ?', (op['id'],))
+        elif tipo == 'fechar_regras':
+            # Os registros materializados vêm na própria operação (ver SistemaFinanceiro._aplicar_fechamento)
+            for inclusao in op['inclusoes']:
+                self._gravar_operacao(inclusao)
+            for regra in self.carregar_regras().values():
+                if (regra.get('fechado_ate') or '') < op['ate']:
+                    self._gravar_regra(dict(regra, fechado_ate=op['ate']))
+        else:
+            raise ValueError(f"Operação desconhecida: {tipo}")
+
+    def _atualizar_registro(self, rid, campos):
+        # Só as colunas presentes em campos mudam; nomes de coluna vêm de uma lista fixa
+        campos = dict(campos)
+        if 'subcategoria' in campos:
+            campos['subcategoria'] = campos['subcategoria'] or None
+        if 'centavos' in campos:
+            campos['valor'] = campos['centavos'] / 100
+        for tabela, permitidas in (('faturamentos', ('centavos', 'valor', 'descricao', 'data')),
+                                   ('custos', ('categoria', 'subcategoria', 'centavos', 'valor', 'descricao', 'data'))):
+            colunas = [coluna for coluna in permitidas if coluna in campos]
+            if colunas:
+                self.conexao.execute(
+                    f"UPDATE {tabela} SET {', '.join(f'{coluna} = ?' for coluna in colunas)} WHERE rid = ?",
+                    [campos[coluna] for coluna in colunas] + [rid])
+
+    def _reter_lucros(self, hoje, dias_diarios, meses_retencao):
+        # Mesma política de compactar_serie_lucros, aplicada com DELETEs no índice por data
+        limite_diario, limite_retencao = limites_serie_lucros(hoje, dias_diarios, meses_retencao)
+        self.conexao.execute(
+            'DELETE FROM lucros WHERE data < ? AND id NOT IN '
+            '(SELECT MAX(id) FROM lucros WHERE data < ? GROUP BY substr(data, 1, 7))',
+            (limite_diario, limite_diario))
+        if limite_retencao:
+            self.conexao.execute('DELETE FROM lucros WHERE data < ?', (limite_retencao,))
+
+    def precisa_compactar(self):
+        return False
+
+    def compactar(self, livro, lucros, seq, agregados, regras):
+        pass
+
+    def obter_faturamento(self, index):
+        linha = self.conexao.execute(
+            'SELECT rid, centavos, descricao, data FROM faturamentos ORDER BY id LIMIT 1 OFFSET ?', (index,)).fetchone()
+        if linha is None or index < 0:
+            return None
+        return {'id': linha[0], 'centavos': linha[1], 'descricao': linha[2], 'data': linha[3]}
+
+    def obter_custo(self, categoria, index, subcategoria=None):
+        linha = self.conexao.execute(
+            'SELECT rid, centavos, descricao, data FROM custos WHERE categoria = ? AND subcategoria IS ? '
+            'ORDER BY id LIMIT 1 OFFSET ?', (categoria, subcategoria or None, index)).fetchone()
+        if linha is None or index < 0:
+            return None
+        return {'id': linha[0], 'centavos': linha[1], 'descricao': linha[2], 'data': linha[3]}
+
+    def obter_registro(self, rid):
+        # Busca pelo índice único de rid; retorna (registro, categoria, subcategoria), categoria None para faturamentos
+        linha = self.conexao.execute(
+            'SELECT centavos, descricao, data FROM faturamentos WHERE rid = ?', (rid,)).fetchone()
+        if linha is not None:
+            return {'id': rid, 'centavos': linha[0], 'descricao': linha[1], 'data': linha[2]}, None, None
+        linha = self.conexao.execute(
+            'SELECT categoria, subcategoria, centavos, descricao, data FROM custos WHERE rid = ?', (rid,)).fetchone()
+        if linha is not None:
+            return {'id': rid, 'centavos': linha[2], 'descricao': linha[3], 'data': linha[4]}, linha[0], linha[1]
+        return None
+
+    def recalcular_agregados(self):
+        # Recálculo completo dos contadores direto nas tabelas indexadas; somas inteiras, em centavos
+        agregados = {
+            'unidade': 'centavos',
+            'faturamento_total': self.conexao.execute(
+                'SELECT COALESCE(SUM(centavos), 0) FROM faturamentos').fetchone()[0],
+            'custos_total': self.conexao.execute(
+                'SELECT COALESCE(SUM(centavos), 0) FROM custos').fetchone()[0],
+            'categorias': {},
+            'meses': {}
+        }
+        for categoria, subcategoria, total in self.conexao.execute(
+                'SELECT categoria, subcategoria, SUM(centavos) FROM custos '
+                'GROUP BY categoria, subcategoria ORDER BY MIN(id)'):
+            dados_categoria = agregados['categorias'].setdefault(categoria, {'total': 0, 'subcategorias': {}})
+            dados_categoria['total'] += total
+            if subcategoria and total:
+                dados_categoria['subcategorias'][subcategoria] = total
+
+        for tabela, coluna in (('faturamentos', 'Faturamento'), ('custos', 'Custos')):
+            for mes, total in self.conexao.execute(
+                    f'SELECT substr(data, 1, 7) AS mes, SUM(centavos) FROM {tabela} GROUP BY mes'):
+                agregados['meses'].setdefault(mes, {'Faturamento': 0, 'Custos': 0})[coluna] = total
+        agregados['meses'] = {mes: valores for mes, valores in agregados['meses'].items()
+                              if valores['Faturamento'] or valores['Custos']}
+        return agregados
+
+    def somas_por_mes_categoria(self):
+        return {(mes, categoria): total for mes, categoria, total in self.conexao.execute(
+            'SELECT substr(data, 1, 7) AS mes, NULL, SUM(centavos) FROM faturamentos GROUP BY mes '
+            'UNION ALL SELECT substr(data, 1, 7) AS mes, categoria, SUM(centavos) FROM custos GROUP BY mes, categoria')}
+
+    def colunas_registros(self):
+        linhas = self.conexao.execute(
+            "SELECT 'Faturamento', NULL, NULL, descricao, centavos / 100.0, centavos, data, rid FROM faturamentos "
+            "UNION ALL SELECT 'Custo', categoria, subcategoria, descricao, centavos / 100.0, centavos, data, rid "
+            "FROM custos").fetchall()
+        colunas = list(zip(*linhas)) or [()] * 8
+        return dict(zip(('tipo', 'categoria', 'subcategoria', 'descricao', 'valor', 'centavos', 'data', 'id'), colunas))
+
+    def blocos_registros(self, inicio, fim, tamanho_bloco):
+        # Conexão própria: a consulta lê uma única versão do banco e não disputa a conexão das gravações
+        condicoes, parametros = [], []
+        if inicio is not None:
+            condicoes.append('data >= ?')
+            parametros.append(pd.Timestamp(inicio).strftime('%Y-%m-%d'))
+        if fim is not None:
+            condicoes.append('data <= ?')
+            parametros.append(pd.Timestamp(fim).strftime('%Y-%m-%d'))
+        filtro = f"WHERE {' AND '.join(condicoes)}" if condicoes else ''
+        conexao = sqlite3.connect(self.arquivo, timeout=30)
+        try:
+            cursor = conexao.execute(
+                f"SELECT 'Faturamento', NULL, NULL, descricao, centavos / 100.0, centavos, data, rid, id, 0 "
+                f"FROM faturamentos {filtro} UNION ALL SELECT 'Custo', categoria, subcategoria, descricao, "
+                f"centavos / 100.0, centavos, data, rid, id, 1 FROM custos {filtro} ORDER BY 7, 10, 9",
+                parametros * 2)
+            nomes = ('tipo', 'categoria', 'subcategoria', 'descricao', 'valor', 'centavos', 'data', 'id')
+            while True:
+                linhas = cursor.fetchmany(tamanho_bloco)
+                if not linhas:
+                    break
+                yield quadro_de_colunas(dict(zip(nomes, zip(*linhas))))
+        finally:
+            conexao.close()
+
+    def ultimos_faturamentos(self, n):
+        linhas = self.conexao.execute(
+            'SELECT rid, centavos, descricao, data FROM faturamentos ORDER BY data DESC, rid DESC LIMIT ?',
+            (n,)).fetchall()
+        return [{'id': rid, 'centavos': c, 'descricao': d, 'data': dt} for rid, c, d, dt in reversed(linhas)]
+
+    def ultimos_custos(self, n):
+        return self.conexao.execute(
+            'SELECT data, categoria, subcategoria, descricao, centavos / 100.0 FROM custos '
+            'ORDER BY data DESC, rid DESC LIMIT ?', (n,)).fetchall()
+
+    def historico_lucros(self, n=None):
+        linhas = self.conexao.execute(
+            'SELECT data, lucro, faturamento_total, custos_total FROM lucros ORDER BY id DESC LIMIT ?',
+            (n if n else -1,)).fetchall()
+        return [{'data': d, 'lucro': l, 'faturamento_total': f, 'custos_total': c} for d, l, f, c in reversed(linhas)]
+
+    def ultimo_lucro(self):
+        linha = self.conexao.execute(
+            'SELECT data, lucro, faturamento_total, custos_total FROM lucros ORDER BY id DESC LIMIT 1').fetchone()
+        if linha is None:
+            return None
+        return {'data': linha[0], 'lucro': linha[1], 'faturamento_total': linha[2], 'custos_total': linha[3]}
+
+BACKENDS_ARMAZENAMENTO = {
+    'json': ArmazenamentoJSON,
+    'binario': ArmazenamentoBinario,
+    'segmentado': ArmazenamentoSegmentado,
+    'sqlite': ArmazenamentoSQLite,
+}
+
+def sqlite_com_dados(arquivo):
+    # Um banco só conta como ledger do usuário se já recebeu alguma gravação: abrir o backend SQLite
+    # antes da migração cria o arquivo com as tabelas vazias
+    if not os.path.exists(arquivo):
+        return False
+    conexao = sqlite3.connect(f'file:{pathname2url(os.path.abspath(arquivo))}?mode=ro', uri=True)
+    try:
+        return any(conexao.execute(consulta).fetchone() for consulta in (
+            "SELECT 1 FROM meta WHERE chave = 'seq'", 'SELECT 1 FROM faturamentos LIMIT 1',
+            'SELECT 1 FROM custos LIMIT 1', 'SELECT 1 FROM lucros LIMIT 1', 'SELECT 1 FROM regras LIMIT 1'))
+    except sqlite3.OperationalError:
+        # Arquivo criado sem o esquema (ou com um esquema incompleto)
+        return False
+    finally:
+        conexao.close()
+
+def backend_dos_arquivos(usuario, diretorio='dados_usuarios'):
+    # Classe do backend dos arquivos que o usuário já tem, ou None para um usuário sem dados. Depois de
+    # migrar_para_sqlite os arquivos antigos continuam lá, por isso o SQLite vem primeiro
+    if sqlite_com_dados(os.path.join(diretorio, f'{usuario}_dados.sqlite3')):
+        return ArmazenamentoSQLite
+    if os.path.exists(os.path.join(diretorio, f'{usuario}_segmentos', 'indice.json')):
+        return ArmazenamentoSegmentado
+    if os.path.exists(os.path.join(diretorio, f'{usuario}_dados.livro')):
+        return ArmazenamentoBinario
+    if any(os.path.exists(os.path.join(diretorio, f'{usuario}_dados.{sufixo}')) for sufixo in ('json', 'journal')):
+        return ArmazenamentoJSON
+    return None
+
+def criar_armazenamento(usuario, diretorio='dados_usuarios'):
+    # GESTOR_ARMAZENAMENTO=sqlite ativa o backend indexado, =binario o snapshot colunar e =segmentado os
+    # segmentos mensais; o padrão continua sendo JSON. A variável vale para usuários novos e para as
+    # conversões que o backend escolhido faz sozinho na compactação (o binário lê o snapshot JSON e o
+    # segmentado lê os dois). Fora isso, os arquivos do usuário decidem: trocar a variável não esconde um
+    # ledger gravado em outro formato, e os dados só passam para o SQLite por migrar_para_sqlite
+    classe = BACKENDS_ARMAZENAMENTO.get(os.environ.get('GESTOR_ARMAZENAMENTO', 'json').lower(), ArmazenamentoJSON)
+    existente = backend_dos_arquivos(usuario, diretorio)
+    if existente is not None and not issubclass(classe, existente):
+        classe = existente
+    return classe(usuario, diretorio)
+
+def armazenamento_existente(usuario, diretorio='dados_usuarios', somente_leitura=False):
+    # Backend dos arquivos que o usuário já tem, independente de GESTOR_ARMAZENAMENTO
+    classe = backend_dos_arquivos(usuario, diretorio) or ArmazenamentoJSON
+    return classe(usuario, diretorio, somente_leitura)
+
+def migrar_para_sqlite(diretorio='dados_usuarios'):
+    # Migração única dos arquivos *_dados.json/.livro e *_segmentos (snapshot + journal) para o backend SQLite.
+    # Um banco vazio (aberto antes da migração) não conta como migrado e recebe os dados
+    usuarios = set()
+    for padrao in ('*_dados.json', '*_dados.livro', '*_dados.journal'):
+        for arquivo in glob.glob(os.path.join(diretorio, padrao)):
+            usuarios.add(os.path.basename(arquivo).rsplit('_dados.', 1)[0])
+    for pasta in glob.glob(os.path.join(diretorio, '*_segmentos')):
+        usuarios.add(os.path.basename(pasta)[:-len('_segmentos')])
+
+    migrados = []
+    for usuario in sorted(usuarios):
+        if sqlite_com_dados(os.path.join(diretorio, f'{usuario}_dados.sqlite3')):
+            continue
+
+        origem = SistemaFinanceiro(usuario, armazenamento_existente(usuario, diretorio))
+        destino = ArmazenamentoSQLite(usuario, diretorio)
+        ops = []
+        for categoria, subcategoria, registro in origem._iterar_registros():
+            if categoria is None:
+                ops.append({'op': 'add_faturamento', 'registro': registro})
+            else:
+                ops.append({'op': 'add_custo', 'categoria': categoria, 'subcategoria': subcategoria, 'registro': registro})
+        ops.extend({'op': 'add_regra', 'regra': regra} for regra in origem.regras.values())
+        ops.extend({'op': 'lucro', 'registro': r} for r in origem.historico_lucros())
+        if ops:
+            ops[-1]['seq'] = origem.seq
+            destino.gravar(ops, origem.agregados)
+        destino.conexao.close()
+        migrados.append(usuario)
+    return migrados
+
+class LivroColunar:
+    # Registros do ledger em colunas compactas, uma linha por registro: id (os 16 dígitos hexadecimais como
+    # inteiro de 64 bits), valor em centavos, data (ordinal do dia), destino (código de categoria/subcategoria;
+    # 0 é faturamento) e descrição (código da tabela de textos internados). As linhas só crescem: remover
+    # desliga a linha em `vivos` (lápide) e purgar() reconstrói as colunas sem elas. Os dicionários
+    # {'id', 'centavos', 'descricao', 'data'} são montados sob demanda, só como visão
+    def __init__(self):
+        self.ids = array('Q')
+        self.centavos = array('q')
+        self.datas = array('i')
+        self.destinos = array('i')
+        self.descricoes = array('i')
+        self.vivos = bytearray()
+        self.mortos = 0
+        self.ids_novos = False
+        self.tabela_destinos = [(None, None)]
+        self._codigos_destino = {(None, None): 0}
+        self.tabela_descricoes = []
+        # Texto -> código dos textos internados. Depois de uma carga binária ou de uma purga, só os internados
+        # desde então: a tabela pode ter o mesmo texto com mais de um código, o que não muda nenhuma consulta
+        self._codigos_descricao = {}
+        self._bytes_descricoes = 0
+        self._ordinais = {}
+        self._textos_data = {}
+        # Índice id -> linha: as linhas carregadas ficam em colunas ordenadas por id (busca binária)
+        # e só as incluídas depois da carga ou da última purga passam por um dicionário
+        self._ids_ordenados = array('Q')
+        self._linhas_ordenadas = array('i')
+        self._recentes = {}
+        # Meses ('AAAA-MM') com registros incluídos, alterados ou removidos desde o último snapshot
+        self.meses_alterados = set()
+
+    def __len__(self):
+        return len(self.vivos) - self.mortos
+
+    @classmethod
+    def de_documento(cls, dados):
+        # Converte o documento lido do backend; as listas de dicionários saem do documento ao serem lidas
+        livro = cls()
+        livro._anexar_lista(dados.pop('faturamentos', []), None, None)
+        for categoria, dados_categoria in dados.pop('custos', {}).get('categorias', {}).items():
+            if 'registros' in dados_categoria:
+                livro._anexar_lista(dados_categoria['registros'], categoria, None)
+            for subcategoria, registros in dados_categoria.get('subcategorias', {}).items():
+                livro._anexar_lista(registros, categoria, subcategoria)
+        livro._reindexar()
+        return livro
+
+    @classmethod
+    def de_secoes(cls, manifesto, secao, linhas=None):
+        # Livro a partir das seções do snapshot binário (ArmazenamentoBinario._mapear). Com `linhas`, só essas
+        # linhas e só as descrições que elas usam: é um recorte para leitura, não um ledger completo
+        livro = cls()
+        colunas = {nome: secao(nome) for nome in ('ids', 'centavos', 'datas', 'destinos', 'descricoes')}
+        if linhas is not None:
+            colunas = {nome: coluna[linhas] for nome, coluna in colunas.items()}
+            usadas, colunas['descricoes'] = np.unique(colunas['descricoes'], return_inverse=True)
+        for nome, coluna in colunas.items():
+            destino = getattr(livro, nome)
+            destino.frombytes(memoryview(np.ascontiguousarray(coluna, dtype=destino.typecode)).cast('B'))
+        quantidade = len(livro.ids)
+        livro.vivos = bytearray(b'\x01') * quantidade
+
+        livro.tabela_destinos = [tuple(destino) for destino in manifesto['destinos']]
+        livro._codigos_destino = {destino: codigo for codigo, destino in enumerate(livro.tabela_destinos)}
+
+        # Descrições: textos separados por \x00, com o início de cada um em bytes; None e textos que contêm
+        # \x00 vão no manifesto
+        textos = secao('textos')
+        if linhas is None:
+            codigos = range(manifesto['quantidade_descricoes'])
+            tabela = bytes(textos).decode('utf-8').split('\x00') if len(codigos) else []
+        else:
+            codigos = usadas.tolist()
+            inicios = secao('inicio_textos')
+            tabela = [bytes(textos[inicios[codigo]:inicios[codigo + 1] - 1]).decode('utf-8') for codigo in codigos]
+            del inicios
+        del textos
+        especiais = {int(codigo): texto for codigo, texto in manifesto['descricoes_especiais'].items()}
+        especiais.update((codigo, None) for codigo in manifesto['descricoes_nulas'])
+        if especiais:
+            tabela = [especiais.get(codigo, texto) for codigo, texto in zip(codigos, tabela)]
+        livro.tabela_descricoes = tabela
+        livro._codigos_descricao = {}
+        livro._bytes_descricoes = sum(map(len, filter(None, tabela)))
+
+        for ordinal in np.unique(np.frombuffer(livro.datas, dtype=np.intc)).tolist():
+            texto = date.fromordinal(ordinal).isoformat()
+            livro._textos_data[ordinal] = texto
+            livro._ordinais[texto] = ordinal
+
+        if linhas is None:
+            # A ordem por id gravada no snapshot dispensa o argsort da carga
+            ordem = np.ascontiguousarray(secao('ordem_ids'), dtype=np.intc)
+            livro._linhas_ordenadas = array('i', ordem.tobytes())
+            livro._ids_ordenados = array('Q', np.frombuffer(livro.ids, dtype=np.uint64)[ordem].tobytes())
+        else:
+            livro._reindexar()
+        return livro
+
+    def secoes(self, linhas=None):
+        # Colunas para o snapshot binário, em little-endian, com as ordens por id e por data. Só para um livro
+        # sem lápides (compactar() purga antes); com `linhas`, só essas linhas e as descrições que elas usam
+        ids = np.frombuffer(self.ids, dtype=np.uint64)
+        centavos = np.frombuffer(self.centavos, dtype=np.int64)
+        datas = np.frombuffer(self.datas, dtype=np.intc)
+        destinos = np.frombuffer(self.destinos, dtype=np.intc)
+        descricoes = np.frombuffer(self.descricoes, dtype=np.intc)
+        tabela = self.tabela_descricoes
+        if linhas is not None:
+            ids, centavos, datas, destinos = ids[linhas], centavos[linhas], datas[linhas], destinos[linhas]
+            usadas, descricoes = np.unique(descricoes[linhas], return_inverse=True)
+            tabela = [tabela[codigo] for codigo in usadas.tolist()]
+        ordem_datas = np.argsort(datas, kind='stable')
+        nulas, especiais, textos = [], {}, []
+        for codigo, texto in enumerate(tabela):
+            if texto is None:
+                nulas.append(codigo)
+                texto = ''
+            elif '\x00' in texto:
+                especiais[codigo] = texto
+                texto = ''
+            textos.append(texto.encode('utf-8'))
+        inicios = np.cumsum([0] + [len(texto) + 1 for texto in textos])
+        metadados = {
+            'linhas': len(ids),
+            'destinos': self.tabela_destinos,
+            'quantidade_descricoes': len(textos),
+            'descricoes_nulas': nulas,
+            'descricoes_especiais': especiais
+        }
+        return metadados, {
+            'ids': ids.astype('<u8'),
+            'centavos': centavos.astype('<i8'),
+            'datas': datas.astype('<i4'),
+            'destinos': destinos.astype('<i4'),
+            'descricoes': descricoes.astype('<i4'),
+            'ordem_ids': np.argsort(ids, kind='stable').astype('<i4'),
+            'ordem_datas': ordem_datas.astype('<i4'),
+            'datas_ordenadas': datas[ordem_datas].astype('<i4'),
+            'textos': np.frombuffer(b'\x00'.join(textos), dtype=np.uint8),
+            'inicio_textos': inicios.astype('<i8')
+        }
+
+    @classmethod
+    def concatenar(cls, partes, tabela_destinos):
+        # Junta livros lidos separadamente (os segmentos mensais) em um só, na ordem das partes. Os códigos de
+        # destino das partes já são os de `tabela_destinos`; os de descrição são deslocados (um texto repetido
+        # entre partes fica com mais de um código)
+        livro = cls()
+        livro.tabela_destinos = [tuple(destino) for destino in tabela_destinos]
+        livro._codigos_destino = {destino: codigo for codigo, destino in enumerate(livro.tabela_destinos)}
+        for parte in partes:
+            for nome in ('ids', 'centavos', 'datas', 'destinos'):
+                getattr(livro, nome).extend(getattr(parte, nome))
+            deslocamento = len(livro.tabela_descricoes)
+            livro.descricoes.frombytes(
+                memoryview((np.frombuffer(parte.descricoes, dtype=np.intc) + deslocamento).astype(np.intc)).cast('B'))
+            livro.tabela_descricoes.extend(parte.tabela_descricoes)
+            livro._bytes_descricoes += parte._bytes_descricoes
+            livro._textos_data.update(parte._textos_data)
+            livro._ordinais.update(parte._ordinais)
+        livro.vivos = bytearray(b'\x01') * len(livro.ids)
+        livro._reindexar()
+        return livro
+
+    def _anexar_lista(self, registros, categoria, subcategoria):
+        # Carga em lote: cada coluna é estendida de uma vez; registros sem id válido seguem um a um
+        codigo = self._codigo_destino(categoria, subcategoria)
+        registros = [registro for registro in registros if registro is not None]
+        ids = [registro.get('id') or '' for registro in registros]
+        texto_ids = ''.join(ids)
+        if len(texto_ids) != 16 * len(ids) or re.fullmatch(r'[0-9a-f]*', texto_ids) is None:
+            for registro in registros:
+                self._anexar(registro, codigo)
+            return
+
+        # Textos novos recebem o próximo código da tabela (que pode ter textos repetidos, ver concatenar)
+        codigos = self._codigos_descricao
+        tabela = self.tabela_descricoes
+        antes = len(codigos)
+        deslocamento = len(tabela) - antes
+        descricoes = [codigos.setdefault(registro['descricao'], len(codigos) + deslocamento) for registro in registros]
+        novas = list(itertools.islice(reversed(codigos), len(codigos) - antes))[::-1]
+        tabela.extend(novas)
+        self._bytes_descricoes += sum(map(len, filter(None, novas)))
+
+        ordinais = self._ordinais
+        self.ids.extend([int(id_registro, 16) for id_registro in ids])
+        self.centavos.extend([registro['centavos'] if 'centavos' in registro else para_centavos(registro['valor'])
+                              for registro in registros])
+        self.datas.extend([ordinais.get(registro['data']) or self._ordinal(registro) for registro in registros])
+        self.destinos.extend(itertools.repeat(codigo, len(registros)))
+        self.descricoes.extend(descricoes)
+        self.vivos.extend(itertools.repeat(1, len(registros)))
+
+    def _anexar(self, registro, codigo_destino):
+        chave = self._chave(registro.get('id'))
+        if chave is None:
+            # Registros gravados antes dos identificadores estáveis
+            registro['id'] = novo_id()
+            chave = int(registro['id'], 16)
+            self.ids_novos = True
+        self.ids.append(chave)
+        self.centavos.append(normalizar_registro(registro)['centavos'])
+        self.datas.append(self._ordinal(registro))
+        self.destinos.append(codigo_destino)
+        self.descricoes.append(self._codigo_descricao(registro['descricao']))
+        self.vivos.append(1)
+        return len(self.vivos) - 1
+
+    @staticmethod
+    def _chave(id_registro):
+        if isinstance(id_registro, str) and ID_VALIDO.fullmatch(id_registro):
+            return int(id_registro, 16)
+        return None
+
+    def _codigo_destino(self, categoria, subcategoria):
+        destino = (categoria, subcategoria or None)
+        codigo = self._codigos_destino.get(destino)
+        if codigo is None:
+            codigo = self._codigos_destino[destino] = len(self.tabela_destinos)
+            self.tabela_destinos.append(destino)
+        return codigo
+
+    def _codigo_descricao(self, descricao):
+        codigos = self._codigos_descricao
+        codigo = codigos.get(descricao)
+        if codigo is None:
+            codigo = codigos[descricao] = len(self.tabela_descricoes)
+            self.tabela_descricoes.append(descricao)
+            self._bytes_descricoes += len(descricao or '')
+        return codigo
+
+    def _ordinal(self, registro):
+        # Datas se repetem muito; cada texto distinto é convertido uma única vez
+        texto = registro['data']
+        ordinal = self._ordinais.get(texto)
+        if ordinal is None:
+            try:
+                dia = date.fromisoformat(texto)
+            except (TypeError, ValueError):
+                dia = date.fromisoformat(converter_data(str(texto)))
+            ordinal = self._ordinais[texto] = dia.toordinal()
+            self._textos_data.setdefault(ordinal, dia.isoformat())
+        # Normaliza o texto no próprio registro para que os agregados usem o mesmo mês que o livro
+        registro['data'] = self._textos_data[ordinal]
+        return ordinal
+
+    def localizar(self, id_registro):
+        # Linha viva do registro, ou None
+        chave = self._chave(id_registro)
+        if chave is None:
+            return None
+        linha = self._recentes.get(chave)
+        if linha is None:
+            posicao = bisect_left(self._ids_ordenados, chave)
+            if posicao == len(self._ids_ordenados) or self._ids_ordenados[posicao] != chave:
+                return None
+            linha = self._linhas_ordenadas[posicao]
+        return linha if self.vivos[linha] else None
+
+    def registro(self, linha):
+        return {
+            'id': f'{self.ids[linha]:016x}',
+            'centavos': self.centavos[linha],
+            'descricao': self.tabela_descricoes[self.descricoes[linha]],
+            'data': self._textos_data[self.datas[linha]]
+        }
+
+    def destino(self, linha):
+        return self.tabela_destinos[self.destinos[linha]]
+
+    def data(self, linha):
+        return self._textos_data[self.datas[linha]]
+
+    def adicionar(self, registro, categoria=None, subcategoria=None):
+        # Retorna o necessário para desfazer_adicao()
+        destinos = len(self.tabela_destinos)
+        linha = self._anexar(registro, self._codigo_destino(categoria, subcategoria))
+        self.meses_alterados.add(registro['data'][:7])
+        chave = self.ids[linha]
+        anterior = self._recentes.get(chave)
+        self._recentes[chave] = linha
+        return anterior, destinos
+
+    def desfazer_adicao(self, anterior, destinos):
+        # Só desfaz a última linha: as reversões de uma transação rodam na ordem inversa
+        chave = self.ids.pop()
+        for coluna in (self.centavos, self.datas, self.destinos, self.descricoes, self.vivos):
+            coluna.pop()
+        if anterior is None:
+            self._recentes.pop(chave, None)
+        else:
+            self._recentes[chave] = anterior
+        while len(self.tabela_destinos) > destinos:
+            del self._codigos_destino[self.tabela_destinos.pop()]
+
+    def atualizar(self, linha, registro):
+        self.meses_alterados.add(self.data(linha)[:7])
+        self.centavos[linha] = registro['centavos']
+        self.datas[linha] = self._ordinal(registro)
+        self.descricoes[linha] = self._codigo_descricao(registro['descricao'])
+        self.meses_alterados.add(registro['data'][:7])
+
+    def remover(self, linha):
+        self.vivos[linha] = 0
+        self.mortos += 1
+        self.meses_alterados.add(self.data(linha)[:7])
+
+    def restaurar(self, linha):
+        self.vivos[linha] = 1
+        self.mortos -= 1
+        self.meses_alterados.add(self.data(linha)[:7])
+
+    def linhas_vivas(self, reverso=False):
+        if reverso:
+            return itertools.compress(range(len(self.vivos) - 1, -1, -1), reversed(self.vivos))
+        return itertools.compress(range(len(self.vivos)), self.vivos)
+
+    def registro_na_posicao(self, categoria, index, subcategoria=None):
+        # index-ésimo registro vivo do destino, na ordem de inclusão
+        codigo = self._codigos_destino.get((categoria, subcategoria or None))
+        if codigo is None or index < 0:
+            return None
+        linhas = (linha for linha in self.linhas_vivas() if self.destinos[linha] == codigo)
+        linha = next(itertools.islice(linhas, index, None), None)
+        return self.registro(linha) if linha is not None else None
+
+    def _mais_recentes(self, custos, n):
+        # Linhas vivas de custos (ou de faturamentos) com as n maiores (data, id), da mais recente para a mais
+        # antiga. A ordem das linhas não serve: ela muda com o backend (o segmentado relê mês a mês), e os
+        # "últimos" têm de ser os mesmos em todos
+        destinos = np.frombuffer(self.destinos, dtype=np.intc)
+        linhas = np.flatnonzero(np.frombuffer(self.vivos, dtype=np.uint8).astype(bool)
+                                & ((destinos != 0) if custos else (destinos == 0)))
+        if n <= 0 or not len(linhas):
+            return []
+        datas = np.frombuffer(self.datas, dtype=np.intc)[linhas]
+        if len(linhas) > n:
+            # Só as linhas com data a partir da n-ésima maior entram na ordenação
+            limite = np.partition(datas, len(datas) - n)[len(datas) - n]
+            linhas, datas = linhas[datas >= limite], datas[datas >= limite]
+        ids = np.frombuffer(self.ids, dtype=np.uint64)[linhas]
+        return linhas[np.lexsort((ids, datas))[::-1][:n]].tolist()
+
+    def ultimos_faturamentos(self, n):
+        # Os n faturamentos mais recentes (por data e, no empate, por id), do mais antigo para o mais novo
+        return [self.registro(linha) for linha in reversed(self._mais_recentes(False, n))]
+
+    def ultimos_custos(self, n):
+        # (data, categoria, subcategoria, descrição, valor em reais) dos n custos mais recentes (por data e,
+        # no empate, por id), do mais novo para o mais antigo
+        ultimos = []
+        for linha in self._mais_recentes(True, n):
+            categoria, subcat = self.destino(linha)
+            registro = self.registro(linha)
+            ultimos.append((registro['data'], categoria, subcat, registro['descricao'], registro['centavos'] / 100))
+        return ultimos
+
+    def categorias(self):
+        # Categorias na ordem em que apareceram, inclusive as que ficaram sem registros
+        return list(dict.fromkeys(categoria for categoria, _ in self.tabela_destinos[1:]))
+
+    def _vivas(self):
+        return np.flatnonzero(np.frombuffer(self.vivos, dtype=np.uint8))
+
+    @staticmethod
+    def _filtrar(coluna, linhas):
+        return array(coluna.typecode, np.frombuffer(coluna, dtype=coluna.typecode)[linhas].tobytes())
+
+    def _reindexar(self):
+        vivas = self._vivas()
+        ids = np.frombuffer(self.ids, dtype=np.uint64)[vivas]
+        ordem = np.argsort(ids, kind='stable')
+        self._ids_ordenados = array('Q', ids[ordem].tobytes())
+        self._linhas_ordenadas = array('i', vivas[ordem].astype(np.intc).tobytes())
+        self._recentes = {}
+
+    def purgar(self):
+        # Descarta as lápides e as descrições que nenhuma linha usa mais; não pode rodar dentro de uma transação
+        vivas = self._vivas()
+        for nome in ('ids', 'centavos', 'datas', 'destinos'):
+            setattr(self, nome, self._filtrar(getattr(self, nome), vivas))
+        descricoes = np.frombuffer(self.descricoes, dtype=np.intc)[vivas]
+        usadas, novos_codigos = np.unique(descricoes, return_inverse=True)
+        self.tabela_descricoes = [self.tabela_descricoes[codigo] for codigo in usadas.tolist()]
+        self._codigos_descricao = {}
+        self._bytes_descricoes = sum(map(len, filter(None, self.tabela_descricoes)))
+        self.descricoes = array('i', novos_codigos.astype(np.intc).tobytes())
+        self.vivos = bytearray(b'\x01' * len(vivas))
+        self.mortos = 0
+        self._reindexar()
+
+    def tamanho_bytes(self):
+        # Colunas pelo tamanho exato; textos, dicionários e objetos por estimativa
+        colunas = sum(coluna.itemsize * len(coluna) for coluna in (
+            self.ids, self.centavos, self.datas, self.destinos, self.descricoes,
+            self._ids_ordenados, self._linhas_ordenadas))
+        return (colunas + len(self.vivos) + self._bytes_descricoes + 110 * len(self.tabela_descricoes)
+                + 120 * len(self._recentes))
+
+    def documento(self, lucros, listas=True):
+        # Visão no formato do documento JSON (faturamentos, custos por categoria/subcategoria e lucros).
+        # Com listas=True os registros vêm com o valor em reais, como listas; com listas=False vêm no formato
+        # gravado e como geradores, para quem percorre uma única vez (a gravação do snapshot)
+        por_destino = [[] for _ in self.tabela_destinos]
+        for linha in self.linhas_vivas():
+            por_destino[self.destinos[linha]].append(linha)
+
+        def registros(linhas):
+            if listas:
+                return [com_valor(self.registro(linha)) for linha in linhas]
+            return (self.registro(linha) for linha in linhas)
+
+        categorias = {}
+        for codigo, (categoria, subcategoria) in enumerate(self.tabela_destinos[1:], start=1):
+            dados_categoria = categorias.setdefault(categoria, {})
+            if subcategoria is None:
+                dados_categoria['registros'] = registros(por_destino[codigo])
+            else:
+                dados_categoria.setdefault('subcategorias', {})[subcategoria] = registros(por_destino[codigo])
+        return {'faturamentos': registros(por_destino[0]), 'custos': {'categorias': categorias}, 'lucros': lucros}
+
+    def colunas(self):
+        # Registros vivos achatados em listas paralelas, no formato de colunas_registros()
+        colunas = {'tipo': [], 'categoria': [], 'subcategoria': [], 'descricao': [], 'valor': [], 'centavos': [],
+                   'data': [], 'id': []}
+        for linha in self.linhas_vivas():
+            categoria, subcategoria = self.destino(linha)
+            colunas['tipo'].append('Faturamento' if categoria is None else 'Custo')
+            colunas['categoria'].append(categoria)
+            colunas['subcategoria'].append(subcategoria)
+            colunas['descricao'].append(self.tabela_descricoes[self.descricoes[linha]])
+            colunas['valor'].append(self.centavos[linha] / 100)
+            colunas['centavos'].append(self.centavos[linha])
+            colunas['data'].append(self.data(linha))
+            colunas['id'].append(f'{self.ids[linha]:016x}')
+        return colunas
+
+    def quadro(self, linhas=None):
+        # DataFrame da análise montado direto das colunas: códigos viram categóricos e ordinais viram datas,
+        # sem passar por dicionários nem por textos de data. Com `linhas`, só essas linhas, nessa ordem
+        vivas = self._vivas() if linhas is None else linhas
+        destinos = np.frombuffer(self.destinos, dtype=np.intc)[vivas]
+        nomes_categoria = sorted({c for c, _ in self.tabela_destinos[1:]})
+        nomes_subcategoria = sorted({s for _, s in self.tabela_destinos[1:] if s is not None})
+        posicao_categoria = {nome: i for i, nome in enumerate(nomes_categoria)}
+        posicao_subcategoria = {nome: i for i, nome in enumerate(nomes_subcategoria)}
+        codigos_categoria = np.array([posicao_categoria.get(c, -1) for c, _ in self.tabela_destinos], dtype=np.intc)
+        codigos_subcategoria = np.array([posicao_subcategoria.get(s, -1) for _, s in self.tabela_destinos], dtype=np.intc)
+        ordinais = np.frombuffer(self.datas, dtype=np.intc)[vivas].astype('int64')
+        centavos = np.frombuffer(self.centavos, dtype=np.int64)[vivas]
+        ids = np.frombuffer(self.ids, dtype=np.uint64)[vivas]
+        return pd.DataFrame({
+            'tipo': pd.Categorical.from_codes((destinos == 0).astype(np.int8), categories=['Custo', 'Faturamento']),
+            'categoria': pd.Categorical.from_codes(codigos_categoria[destinos], categories=nomes_categoria),
+            'subcategoria': pd.Categorical.from_codes(codigos_subcategoria[destinos], categories=nomes_subcategoria),
+            'descricao': self._descricoes(np.frombuffer(self.descricoes, dtype=np.intc)[vivas]),
+            'valor': centavos / 100,
+            'centavos': centavos,
+            'data': (ordinais - date(1970, 1, 1).toordinal()).astype('datetime64[D]').astype('datetime64[ns]'),
+            'id': [f'{chave:016x}' for chave in ids.tolist()]
+        })
+
+    def _descricoes(self, codigos):
+        # Textos dos códigos; um bloco pequeno de uma tabela grande não converte a tabela inteira
+        tabela = self.tabela_descricoes
+        if len(codigos) * 4 < len(tabela):
+            return np.array([tabela[codigo] for codigo in codigos.tolist()], dtype=object)
+        return np.array(tabela, dtype=object)[codigos]
+
+    def linhas_periodo(self, inicio=None, fim=None):
+        # Linhas vivas com data em [inicio, fim]
+        vivas = self._vivas()
+        datas = np.frombuffer(self.datas, dtype=np.intc)[vivas]
+        manter = np.ones(len(vivas), dtype=bool)
+        if inicio is not None:
+            manter &= datas >= pd.Timestamp(inicio).toordinal()
+        if fim is not None:
+            manter &= datas <= pd.Timestamp(fim).toordinal()
+        return vivas[manter]
+
+    def linhas_por_data(self):
+        # Linhas vivas em ordem de data (estável: a ordem de inclusão vale dentro do mesmo dia)
+        vivas = self._vivas()
+        return vivas[np.argsort(np.frombuffer(self.datas, dtype=np.intc)[vivas], kind='stable')]
+
+    def recorte(self, linhas):
+        # Cópia das colunas das linhas dadas, para ler sem a trava do sistema. A tabela de descrições é
+        # compartilhada: só recebe inclusões no fim (purgar troca a lista inteira), então os códigos copiados
+        # continuam apontando para os mesmos textos
+        livro = LivroColunar()
+        for nome in ('ids', 'centavos', 'datas', 'destinos', 'descricoes'):
+            setattr(livro, nome, self._filtrar(getattr(self, nome), linhas))
+        livro.vivos = bytearray(b'\x01') * len(linhas)
+        livro.tabela_destinos = list(self.tabela_destinos)
+        livro.tabela_descricoes = self.tabela_descricoes
+        return livro
+
+    def meses(self):
+        # Mês de cada linha, como inteiro (meses desde 1970-01)
+        return ((np.frombuffer(self.datas, dtype=np.intc).astype('int64') - date(1970, 1, 1).toordinal())
+                .astype('datetime64[D]').astype('datetime64[M]').astype('int64'))
+
+    def somas(self):
+        # Somas exatas em int64 dos registros vivos: por destino (com a contagem de registros)
+        # e por mês e coluna ('AAAA-MM' -> {'Faturamento', 'Custos'})
+        vivas = self._vivas()
+        destinos = np.frombuffer(self.destinos, dtype=np.intc)[vivas]
+        centavos = np.frombuffer(self.centavos, dtype=np.int64)[vivas]
+        meses = self.meses()[vivas]
+        por_destino = np.zeros(len(self.tabela_destinos), dtype=np.int64)
+        np.add.at(por_destino, destinos, centavos)
+        contagem = np.bincount(destinos, minlength=len(self.tabela_destinos))
+
+        # Chave mês * 2 + 1 para faturamento, mês * 2 para custos
+        chaves, posicoes = np.unique(meses * 2 + (destinos == 0), return_inverse=True)
+        por_chave = np.zeros(len(chaves), dtype=np.int64)
+        np.add.at(por_chave, posicoes, centavos)
+        por_mes = {}
+        for chave, total in zip(chaves.tolist(), por_chave.tolist()):
+            mes = str(np.datetime64(chave // 2, 'M'))
+            por_mes.setdefault(mes, {'Faturamento': 0, 'Custos': 0})['Faturamento' if chave % 2 else 'Custos'] = total
+        return por_destino.tolist(), contagem.tolist(), por_mes
+
+    def somas_por_mes_categoria(self):
+        # Somas exatas dos registros vivos por ('AAAA-MM', categoria); categoria None é faturamento e as
+        # subcategorias entram na sua categoria
+        vivas = self._vivas()
+        destinos = np.frombuffer(self.destinos, dtype=np.intc)[vivas]
+        centavos = np.frombuffer(self.centavos, dtype=np.int64)[vivas]
+        chaves, posicoes = np.unique(self.meses()[vivas] * len(self.tabela_destinos) + destinos, return_inverse=True)
+        por_chave = np.zeros(len(chaves), dtype=np.int64)
+        np.add.at(por_chave, posicoes, centavos)
+        somas = {}
+        for chave, total in zip(chaves.tolist(), por_chave.tolist()):
+            mes, destino = divmod(chave, len(self.tabela_destinos))
+            chave = (str(np.datetime64(mes, 'M')), self.tabela_destinos[destino][0])
+            somas[chave] = somas.get(chave, 0) + total
+        return somas
+
+class EscritorSegundoPlano:
+    # Thread de um sistema para o trabalho que não precisa segurar quem alterou o ledger: o ponto da série de
+    # lucros e a compactação do snapshot. A alteração em si já foi gravada no journal antes de ser confirmada.
+    # Pedidos feitos durante a espera `atraso` ou durante um ciclo em andamento são atendidos juntos; a thread
+    # termina quando não há mais pedidos e é recriada no próximo
+    def __init__(self, sistema, atraso=0.05):
+        self.sistema = sistema
+        self.atraso = atraso
+        self._condicao = threading.Condition()
+        self._pedidos = 0
+        self._atendidos = 0
+        self._thread = None
+        escritores_ativos.add(self)
+
+    def agendar(self):
+        with self._condicao:
+            self._pedidos += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._executar, daemon=True,
+                                                name=f'gestor-escritor-{self.sistema.usuario}')
+                self._thread.start()
+
+    def _executar(self):
+        while True:
+            time.sleep(self.atraso)
+            with self._condicao:
+                alvo = self._pedidos
+            try:
+                with metricas.medir('gestor_escritor_ciclo_segundos'):
+                    self.sistema._executar_adiado()
+            except Exception:
+                # O journal já tem as alterações; o ciclo seguinte (ou a próxima gravação) tenta de novo
+                logger.exception('Falha no escritor em segundo plano de %s', self.sistema.usuario)
+            with self._condicao:
+                metricas.incrementar('gestor_escritor_pedidos_total', alvo - self._atendidos)
+                self._atendidos = alvo
+                self._condicao.notify_all()
+                if self._pedidos == alvo:
+                    self._thread = None
+                    return
+
+    def sincronizar(self, timeout=None):
+        # Barreira: espera os pedidos feitos até aqui; False se o timeout acabar antes
+        with self._condicao:
+            if self._thread is threading.current_thread():
+                return True
+            alvo = self._pedidos
+            return self._condicao.wait_for(lambda: self._atendidos >= alvo, timeout)
+
+# Escritores com threads possivelmente em andamento; na saída do processo, o trabalho adiado é concluído
+escritores_ativos = weakref.WeakSet()
+
+@atexit.register
+def _sincronizar_escritores():
+    for escritor in list(escritores_ativos):
+        escritor.sincronizar(timeout=30)
+
+class SistemaFinanceiro:
+    def __init__(self, usuario, armazenamento=None, segundo_plano=None, somente_leitura=False):
+        self.usuario = usuario
+        self.armazenamento = armazenamento or criar_armazenamento(usuario)
+        # Somente leitura (relatórios e rotinas em lote): nenhuma mutação, gravação ou compactação
+        self.somente_leitura = somente_leitura
+        self._dados = None
+        self.seq = 0
+        self.agregados = None
+        self.assinatura = None
+        self._pendentes = []
+        self._trava = threading.RLock()
+        self._analise = None
+        self._em_transacao = False
+        self._desfazer = None
+        self._lucros_pendentes = False
+        self._livro = LivroColunar()
+        # Manifesto do snapshot binário enquanto o ledger não foi lido (ver carregar_dados)
+        self._resumo = None
+        # Regras recorrentes (id -> regra) e a projeção delas sobre os agregados (ver agregados_efetivos)
+        self.regras = {}
+        self._projecao = None
+        # GESTOR_SEGUNDO_PLANO=1: lucro e compactação saem da thread que altera o ledger (ver EscritorSegundoPlano)
+        if segundo_plano is None:
+            segundo_plano = os.environ.get('GESTOR_SEGUNDO_PLANO') == '1'
+        self.escritor = EscritorSegundoPlano(self) if segundo_plano and not somente_leitura else None
+        self._lucros_adiados = False
+        self.carregar_dados()
+
+    @property
+    def dados(self):
+        # Visão de compatibilidade no formato do documento JSON, montada a cada acesso a partir do livro
+        # colunar: alterar os dicionários retornados não altera o ledger. Backends indexados só
+        # materializam o ledger quando alguém o acessa
+        with self._trava:
+            self._materializar()
+            return self._livro.documento(self._dados['lucros'])
+
+    def _materializar(self):
+        if self._dados is None and self._pendentes and not self._em_transacao:
+            self.salvar_dados(compactar=False)
+        if self._dados is None:
+            with self.armazenamento.trava:
+                self.assinatura = self.armazenamento.assinatura()
+                dados, self.seq, ops, agregados = self.armazenamento.carregar()
+            # Os registros vão para as colunas do livro; só a série de lucros continua como lista de dicionários.
+            # Históricos antigos tinham um ponto por mutação; reduz para a série compactada
+            self.regras = {regra['id']: regra for regra in dados.pop('regras', [])}
+            self._projecao = None
+            self._livro = dados.pop('livro') if 'livro' in dados else LivroColunar.de_documento(dados)
+            self._resumo = None
+            self._dados = {'lucros': compactar_serie_lucros(dados['lucros'], datetime.now().strftime('%Y-%m-%d'))}
+            # Agregados gravados antes dos centavos estavam em reais: recalcula e regrava o snapshot
+            legado = agregados is not None and agregados.get('unidade') != 'centavos'
+            self.agregados = (self._podar_subcategorias(agregados) if agregados is not None and not legado
+                              else self._recalcular_agregados())
+            # Dentro de uma transação, as mutações ainda não gravadas são reaplicadas sobre o que foi lido
+            for op in ops + self._pendentes:
+                self._executar(op)
+                self.seq = op['seq']
+            metricas.incrementar('gestor_registros_lidos_total', len(self._livro), origem='carregar')
+            if (self._livro.ids_novos or self._livro.mortos or legado) and not self._em_transacao:
+                # Persiste os ids gerados para registros antigos, os valores convertidos para centavos
+                # e as remoções do journal em um snapshot limpo
+                self._livro.ids_novos = False
+                self.compactar()
+        return self._dados
+
+    def carregar_dados(self):
+        with self._trava, self.armazenamento.trava, metricas.medir('gestor_carregar_segundos', backend=self.armazenamento.nome):
+            self._dados = None
+            self._livro = LivroColunar()
+            self._resumo = None
+            self.agregados = None
+            self.regras = {}
+            self._projecao = None
+            # A assinatura lida sob a trava é a versão sobre a qual as próximas mutações serão gravadas
+            self.assinatura = self.armazenamento.assinatura()
+            if self.armazenamento.consultas_indexadas:
+                self.seq = self.armazenamento.ultimo_seq()
+                self.regras = self.armazenamento.carregar_regras()
+                self.agregados = self.armazenamento.carregar_agregados()
+                if self.agregados is None or self.agregados.get('unidade') != 'centavos':
+                    self.agregados = self.armazenamento.recalcular_agregados()
+                self._podar_subcategorias(self.agregados)
+                return
+
+            resumo = self.armazenamento.carregar_resumo()
+            if resumo is not None and (resumo['agregados'] or {}).get('unidade') == 'centavos':
+                # Snapshot binário em dia: totais, lucros e últimos registros saem do manifesto e
+                # o ledger só é lido na primeira consulta ou mutação que precisar dele
+                self.seq, self.agregados, self._resumo = resumo['seq'], self._podar_subcategorias(resumo['agregados']), resumo
+                self.regras = {regra['id']: regra for regra in resumo.get('regras', [])}
+            else:
+                self._materializar()
+
+    def salvar_dados(self, compactar=True):
+        with self._trava:
+            if not self._pendentes or self._em_transacao:
+                return
+
+            with self.armazenamento.trava, metricas.medir('gestor_salvar_segundos', backend=self.armazenamento.nome):
+                if self.desatualizado():
+                    self._rebasear()
+                    if not self._pendentes:
+                        # Tudo o que estava pendente já tinha sido desfeito por outro processo
+                        return
+                self.armazenamento.gravar(self._pendentes, self.agregados)
+                metricas.incrementar('gestor_operacoes_gravadas_total', len(self._pendentes), backend=self.armazenamento.nome)
+                self._pendentes = []
+                self.assinatura = self.armazenamento.assinatura()
+                if compactar and self.armazenamento.precisa_compactar():
+                    if self.escritor is not None:
+                        self.escritor.agendar()
+                    else:
+                        self.compactar()
+                elif self._livro.mortos > len(self._livro):
+                    self._livro.purgar()
+
+    def compactar(self):
+        # Grava o estado completo (inclusive mutações pendentes) em um novo snapshot
+        with self._trava:
+            if self._em_transacao or self.somente_leitura:
+                return
+            with self.armazenamento.trava, metricas.medir('gestor_compactar_segundos', backend=self.armazenamento.nome):
+                if self.desatualizado():
+                    self._rebasear()
+                self._pendentes = []
+                self._materializar()
+                if self._livro.mortos:
+                    self._livro.purgar()
+                self.armazenamento.compactar(self._livro, self._dados['lucros'], self.seq, self.agregados,
+                                             list(self.regras.values()))
+                self._livro.meses_alterados.clear()
+                self.assinatura = self.armazenamento.assinatura()
+
+    def _rebasear(self):
+        # Controle otimista: outro processo gravou depois da nossa última leitura. Em vez de sobrescrever,
+        # recarrega a versão atual e reaplica por cima dela as mutações ainda não gravadas; remoções e
+        # edições de registros que deixaram de existir são descartadas e o lucro é recalculado
+        metricas.incrementar('gestor_conflitos_total', backend=self.armazenamento.nome)
+        pendentes = [op for op in self._pendentes if op['op'] not in ('lucro', 'reter_lucros')]
+        recalcular_lucro = len(pendentes) < len(self._pendentes)
+        self._pendentes = []
+        self.carregar_dados()
+        self._analise = None
+
+        # Como numa transação: as mutações reaplicadas ficam pendentes até a gravação em andamento
+        self._em_transacao = True
+        try:
+            for op in pendentes:
+                del op['seq']
+                self._registrar(op)
+            if recalcular_lucro:
+                self._registrar_lucro()
+        finally:
+            self._em_transacao = False
+
+    @contextmanager
+    def transacao(self):
+        # Agrupa mutações: uma única gravação e um único recálculo de lucro no commit,
+        # e nada é persistido (e o estado em memória é restaurado) se ocorrer um erro
+        with self._trava:
+            if self._em_transacao:
+                yield self
+                return
+
+            self.salvar_dados()
+            seq, agregados = self.seq, copy.deepcopy(self.agregados)
+            self._em_transacao = True
+            self._desfazer = []
+            self._lucros_pendentes = False
+            try:
+                yield self
+            except BaseException:
+                for desfazer in reversed(self._desfazer):
+                    desfazer()
+                self.seq, self.agregados = seq, agregados
+                self._pendentes = []
+                self._analise = None
+                self._projecao = None
+                raise
+            finally:
+                self._em_transacao = False
+                self._desfazer = None
+
+            if self._lucros_pendentes:
+                self._lucros_pendentes = False
+                self.calcular_lucros()
+            else:
+                self.salvar_dados()
+
+    def desatualizado(self):
+        # Verdadeiro quando outro processo ou instância gravou depois da nossa última leitura/escrita
+        return self.armazenamento.assinatura() != self.assinatura
+
+    def tamanho_estimado(self):
+        if self._dados is None:
+            return len(json.dumps(self.agregados))
+        return self._livro.tamanho_bytes() + 200 * len(self._dados['lucros'])
+
+    def _registrar(self, op):
+        if self.somente_leitura:
+            raise PermissionError(f'O ledger de {self.usuario} foi aberto somente para leitura')
+        with self._trava:
+            resultado = self._executar(op)
+            if resultado is not None:
+                metricas.incrementar('gestor_mutacoes_total', op=op['op'])
+                self.seq += 1
+                op['seq'] = self.seq
+                self._pendentes.append(op)
+            return resultado
+
+    def _executar(self, op):
+        if op['op'] in OPERACOES_REGRAS:
+            return self._aplicar_regra(op)
+        if op['op'] in ('add_faturamento', 'add_custo'):
+            normalizar_registro(op['registro'])
+        if self._dados is None and not self.armazenamento.consultas_indexadas:
+            # Sem backend indexado, toda mutação é aplicada sobre o ledger lido
+            self._materializar()
+        if self._dados is None:
+            return self._executar_no_backend(op)
+        return self._aplicar(op)
+
+    def _executar_no_backend(self, op):
+        # Backends indexados: valida a mutação e atualiza os contadores sem materializar o documento
+        tipo = op['op']
+        if tipo == 'add_faturamento':
+            self._contabilizar(op['registro'], None, None, 1)
+        elif tipo == 'add_custo':
+            self._contabilizar(op['registro'], op['categoria'], op.get('subcategoria'), 1)
+        elif tipo == 'fechar_regras':
+            return self._aplicar_fechamento(op)
+        if tipo in OPERACOES_SEM_ESTADO:
+            return op.get('registro', op)
+
+        self._usar_indices()
+        localizado = self._localizar_no_backend(op['id'])
+        if localizado is None:
+            return None
+        registro, categoria, subcategoria = localizado
+        self._contabilizar(registro, categoria, subcategoria, -1)
+        if tipo == 'upd':
+            registro, categoria, subcategoria = self._registro_atualizado(registro, categoria, subcategoria, op['campos'])
+            self._contabilizar(registro, categoria, subcategoria, 1)
+        return registro
+
+    def _localizar_no_backend(self, id_registro):
+        # (registro, categoria, subcategoria) como está no banco, com as mutações ainda não gravadas aplicadas por
+        # cima: dentro de uma transação elas só chegam ao banco no commit. None se não existe ou já foi removido
+        localizado = self.armazenamento.obter_registro(id_registro)
+        for pendente in self._pendentes:
+            for op in pendente.get('inclusoes', [pendente]):
+                if op['op'] in ('add_faturamento', 'add_custo') and op['registro']['id'] == id_registro:
+                    localizado = op['registro'], op.get('categoria'), op.get('subcategoria')
+                elif op['op'] in ('rem', 'upd') and op['id'] == id_registro and localizado is not None:
+                    localizado = None if op['op'] == 'rem' else self._registro_atualizado(*localizado, op['campos'])
+        return localizado
+
+    def _contabilizar(self, registro, categoria, subcategoria, sinal):
+        coluna = 'Faturamento' if categoria is None else 'Custos'
+        self._somar_agregado(self.agregados, coluna, sinal * registro['centavos'], registro['data'][:7],
+                             categoria, subcategoria)
+
+    @staticmethod
+    def _somar_agregado(agregados, coluna, centavos, mes, categoria=None, subcategoria=None):
+        # Contadores em centavos inteiros: somas exatas, sem arredondamento
+        if coluna == 'Faturamento':
+            agregados['faturamento_total'] += centavos
+        else:
+            agregados['custos_total'] += centavos
+            dados_categoria = agregados['categorias'].setdefault(categoria, {'total': 0, 'subcategorias': {}})
+            dados_categoria['total'] += centavos
+            if subcategoria:
+                # Como os meses: a subcategoria que fica sem valor (o último custo saiu dela) deixa de existir
+                subcategorias = dados_categoria['subcategorias']
+                subcategorias[subcategoria] = subcategorias.get(subcategoria, 0) + centavos
+                if not subcategorias[subcategoria]:
+                    del subcategorias[subcategoria]
+
+        dados_mes = agregados['meses'].setdefault(mes, {'Faturamento': 0, 'Custos': 0})
+        dados_mes[coluna] += centavos
+        if not dados_mes['Faturamento'] and not dados_mes['Custos']:
+            del agregados['meses'][mes]
+
+    @staticmethod
+    def _podar_subcategorias(agregados):
+        # Agregados gravados antes da poda em _somar_agregado podem trazer subcategorias zeradas
+        for dados_categoria in agregados['categorias'].values():
+            subcategorias = dados_categoria['subcategorias']
+            for subcategoria in [subcat for subcat, total in subcategorias.items() if not total]:
+                del subcategorias[subcategoria]
+        return agregados
+
+    def _recalcular_agregados(self):
+        metricas.incrementar('gestor_recalculos_agregados_total')
+        if self._usar_indices():
+            return self.armazenamento.recalcular_agregados()
+
+        # Somas vetorizadas em int64 sobre as colunas do livro
+        livro = self._livro
+        por_destino, contagem, por_mes = livro.somas()
+        agregados = {
+            'unidade': 'centavos',
+            'faturamento_total': por_destino[0],
+            'custos_total': sum(por_destino[1:]),
+            'categorias': {categoria: {'total': 0, 'subcategorias': {}} for categoria in livro.categorias()},
+            'meses': {mes: valores for mes, valores in por_mes.items() if valores['Faturamento'] or valores['Custos']}
+        }
+        for codigo, (categoria, subcat) in enumerate(livro.tabela_destinos[1:], start=1):
+            dados_categoria = agregados['categorias'][categoria]
+            dados_categoria['total'] += por_destino[codigo]
+            if subcat is not None and contagem[codigo] and por_destino[codigo]:
+                dados_categoria['subcategorias'][subcat] = por_destino[codigo]
+        return agregados
+
+    def verificar_agregados(self, tolerancia=0):
+        # Compara os contadores incrementais com um recálculo completo; retorna as divergências
+        esperado = self._recalcular_agregados()
+        divergencias = []
+
+        def comparar(caminho, atual, correto):
+            if abs((atual or 0) - (correto or 0)) > tolerancia:
+                divergencias.append((caminho, atual, correto))
+
+        comparar('faturamento_total', self.agregados['faturamento_total'], esperado['faturamento_total'])
+        comparar('custos_total', self.agregados['custos_total'], esperado['custos_total'])
+        for categoria in set(self.agregados['categorias']) | set(esperado['categorias']):
+            atual = self.agregados['categorias'].get(categoria, {'total': 0, 'subcategorias': {}})
+            correto = esperado['categorias'].get(categoria, {'total': 0, 'subcategorias': {}})
+            comparar(f'categorias.{categoria}', atual['total'], correto['total'])
+            for subcat in set(atual['subcategorias']) | set(correto['subcategorias']):
+                comparar(f'categorias.{categoria}.{subcat}',
+                         atual['subcategorias'].get(subcat), correto['subcategorias'].get(subcat))
+        for mes in set(self.agregados['meses']) | set(esperado['meses']):
+            atual = self.agregados['meses'].get(mes, {})
+            correto = esperado['meses'].get(mes, {})
+            for coluna in ('Faturamento', 'Custos'):
+                comparar(f'meses.{mes}.{coluna}', atual.get(coluna), correto.get(coluna))
+        return divergencias
+
+    def _aplicar(self, op):
+        tipo = op['op']
+        if tipo == 'add_faturamento':
+            return self._aplicar_adicionar(op['registro'])
+        if tipo == 'add_custo':
+            return self._aplicar_adicionar(op['registro'], op['categoria'], op.get('subcategoria'))
+        if tipo == 'rem':
+            return self._aplicar_remover(op['id'])
+        if tipo == 'upd':
+            return self._aplicar_atualizar(op['id'], op['campos'])
+        if tipo in ('rem_faturamento', 'rem_custo'):
+            # Operações posicionais de journals antigos
+            registro = self._registro_na_posicao(op.get('categoria'), op['index'], op.get('subcategoria'))
+            return self._aplicar_remover(registro['id']) if registro else None
+        if tipo == 'lucro':
+            # Um ponto por dia: o último cálculo do dia substitui o anterior
+            lucros = self._dados['lucros']
+            if lucros and lucros[-1]['data'] == op['registro']['data']:
+                self._ao_desfazer(lucros.__setitem__, -1, lucros[-1])
+                lucros[-1] = op['registro']
+            else:
+                lucros.append(op['registro'])
+                self._ao_desfazer(lucros.pop)
+            return op['registro']
+        if tipo == 'reter_lucros':
+            self._ao_desfazer(self._dados.__setitem__, 'lucros', self._dados['lucros'])
+            self._dados['lucros'] = compactar_serie_lucros(
+                self._dados['lucros'], op['hoje'], op['dias_diarios'], op['meses_retencao'])
+            return op
+        if tipo == 'fechar_regras':
+            return self._aplicar_fechamento(op)
+        raise ValueError(f"Operação desconhecida no journal: {tipo}")
+
+    def _ao_desfazer(self, funcao, *args):
+        # Registra como reverter a mutação em memória caso a transação em andamento falhe
+        if self._desfazer is not None:
+            self._desfazer.append(lambda: funcao(*args))
+
+    def _aplicar_regra(self, op):
+        # As regras ficam em memória em qualquer backend, carregado ou não o ledger
+        tipo = op['op']
+        if tipo == 'add_regra':
+            self.regras[op['regra']['id']] = op['regra']
+            self._ao_desfazer(self.regras.pop, op['regra']['id'])
+            return op['regra']
+        anterior = self.regras.get(op['id'])
+        if anterior is None:
+            return None
+        self._ao_desfazer(self.regras.__setitem__, op['id'], anterior)
+        if tipo == 'rem_regra':
+            del self.regras[op['id']]
+            return anterior
+        self.regras[op['id']] = dict(anterior, **op['campos'])
+        return self.regras[op['id']]
+
+    def _aplicar_fechamento(self, op):
+        # Ocorrências de cada regra até op['ate'] viram registros comuns e a regra passa a projetar só as
+        # seguintes. As inclusões são refeitas a partir das regras em memória (no journal e no rebase), por isso
+        # um período fechado duas vezes, ou por dois processos, não duplica nenhuma ocorrência
+        inclusoes = []
+        for regra in list(self.regras.values()):
+            for data in ocorrencias_regra(regra, op['ate']):
+                registro = {'id': id_ocorrencia(regra['id'], data), 'centavos': regra['centavos'],
+                            'descricao': regra['descricao'], 'data': data}
+                if regra['categoria'] is None:
+                    inclusoes.append({'op': 'add_faturamento', 'registro': registro})
+                else:
+                    inclusoes.append({'op': 'add_custo', 'categoria': regra['categoria'],
+                                      'subcategoria': regra['subcategoria'], 'registro': registro})
+            if (regra['fechado_ate'] or '') < op['ate']:
+                self.regras[regra['id']] = dict(regra, fechado_ate=op['ate'])
+                self._ao_desfazer(self.regras.__setitem__, regra['id'], regra)
+
+        for inclusao in inclusoes:
+            if self._dados is None:
+                self._contabilizar(inclusao['registro'], inclusao.get('categoria'), inclusao.get('subcategoria'), 1)
+            else:
+                self._aplicar_adicionar(inclusao['registro'], inclusao.get('categoria'), inclusao.get('subcategoria'))
+        # Backends indexados gravam as inclusões como estão na operação
+        op['inclusoes'] = inclusoes
+        return op
+
+    @staticmethod
+    def _novo_registro(centavos, descricao, data=None):
+        if data is None:
+            data = datetime.now().strftime('%Y-%m-%d')
+        return {
+            'id': novo_id(),
+            'centavos': centavos,
+            'descricao': descricao,
+            'data': data
+        }
+
+    def adicionar_faturamento(self, valor, descricao, data=None):
+        # valor em reais; é guardado em centavos inteiros
+        registro = self._registrar({
+            'op': 'add_faturamento',
+            'registro': self._novo_registro(para_centavos(valor), descricao, data)
+        })
+        self.calcular_lucros()
+        return com_valor(registro)
+
+    def remover_faturamento(self, index):
+        # Compatibilidade: index conta os faturamentos vivos na ordem de inclusão; prefira remover_registro
+        registro = self._registro_na_posicao(None, index)
+        return self.remover_registro(registro['id']) if registro else None
+
+    def adicionar_custo(self, categoria, valor, descricao, data=None, subcategoria=None):
+        return self._adicionar_custo(categoria, para_centavos(valor), descricao, data, subcategoria)
+
+    def _adicionar_custo(self, categoria, centavos, descricao, data=None, subcategoria=None):
+        registro = self._novo_registro(centavos, descricao, data)
+        self._registrar({
+            'op': 'add_custo',
+            'categoria': categoria,
+            'subcategoria': subcategoria,
+            'registro': registro
+        })
+        self.calcular_lucros()
+        return com_valor(registro)
+
+    def _aplicar_adicionar(self, registro, categoria=None, subcategoria=None):
+        self._ao_desfazer(self._livro.desfazer_adicao, *self._livro.adicionar(registro, categoria, subcategoria))
+        self._contabilizar(registro, categoria, subcategoria, 1)
+        return registro
+
+    def remover_custo(self, categoria, index, subcategoria=None):
+        # Compatibilidade: index conta os custos vivos da categoria/subcategoria; prefira remover_registro
+        registro = self._registro_na_posicao(categoria, index, subcategoria)
+        return self.remover_registro(registro['id']) if registro else None
+
+    def remover_registro(self, id_registro):
+        removido = self._registrar({'op': 'rem', 'id': id_registro})
+        if removido:
+            self.calcular_lucros()
+            return com_valor(removido)
+        return None
+
+    def atualizar_registro(self, id_registro, **campos):
+        # Campos aceitos: valor, descricao, data e, para custos, categoria e subcategoria
+        invalidos = set(campos) - {'valor', 'descricao', 'data', 'categoria', 'subcategoria'}
+        if invalidos:
+            raise ValueError(f"Campos inválidos: {', '.join(sorted(invalidos))}")
+        if 'valor' in campos:
+            campos['centavos'] = para_centavos(campos.pop('valor'))
+
+        atualizado = self._registrar({'op': 'upd', 'id': id_registro, 'campos': campos})
+        if atualizado:
+            self.calcular_lucros()
+            return com_valor(atualizado)
+        return None
+
+    def _aplicar_remover(self, id_registro):
+        linha = self._livro.localizar(id_registro)
+        if linha is None:
+            return None
+        categoria, subcategoria = self._livro.destino(linha)
+        removido = self._livro.registro(linha)
+        # Lápide: a linha fica desligada e nenhum outro registro é deslocado
+        self._livro.remover(linha)
+        self._ao_desfazer(self._livro.restaurar, linha)
+        self._contabilizar(removido, categoria, subcategoria, -1)
+        return removido
+
+    def _aplicar_atualizar(self, id_registro, campos):
+        linha = self._livro.localizar(id_registro)
+        if linha is None:
+            return None
+        registro = self._livro.registro(linha)
+        categoria, subcategoria = self._livro.destino(linha)
+        novo, nova_categoria, nova_subcategoria = self._registro_atualizado(registro, categoria, subcategoria, campos)
+        if (nova_categoria, nova_subcategoria) != (categoria, subcategoria):
+            # Troca de categoria/subcategoria: sai da lista antiga e entra no fim da nova
+            self._aplicar_remover(id_registro)
+            return self._aplicar_adicionar(novo, nova_categoria, nova_subcategoria)
+
+        self._livro.atualizar(linha, novo)
+        self._ao_desfazer(self._livro.atualizar, linha, registro)
+        self._contabilizar(registro, categoria, subcategoria, -1)
+        self._contabilizar(novo, categoria, subcategoria, 1)
+        return novo
+
+    @staticmethod
+    def _registro_atualizado(registro, categoria, subcategoria, campos):
+        # Um novo dicionário: o registro original pode estar em uma operação ainda não gravada
+        novo = dict(registro)
+        if 'valor' in campos:
+            # Edições gravadas antes dos centavos
+            novo['centavos'] = para_centavos(campos['valor'])
+        novo.update((campo, campos[campo]) for campo in ('centavos', 'descricao', 'data') if campo in campos)
+        if categoria is not None:
+            categoria = campos.get('categoria') or categoria
+            if 'subcategoria' in campos:
+                subcategoria = campos['subcategoria'] or None
+        return novo, categoria, subcategoria
+
+    def _registro_na_posicao(self, categoria, index, subcategoria=None):
+        # index-ésimo registro vivo da lista (faturamentos quando categoria é None)
+        if index < 0:
+            return None
+        if not self._em_transacao and self._usar_indices():
+            if categoria is None:
+                return self.armazenamento.obter_faturamento(index)
+            return self.armazenamento.obter_custo(categoria, index, subcategoria)
+        self._materializar()
+        return self._livro.registro_na_posicao(categoria, index, subcategoria)
+
+    def calcular_lucros(self):
+        if self._em_transacao:
+            # O lucro é recalculado uma única vez, no commit da transação
+            self._lucros_pendentes = True
+            return
+
+        if self.escritor is not None:
+            # As alterações são gravadas agora; o ponto de lucro de uma rajada delas é um só, no escritor
+            with self._trava:
+                self.salvar_dados(compactar=False)
+                self._lucros_adiados = True
+            self.escritor.agendar()
+            return
+
+        with metricas.medir('gestor_calcular_lucros_segundos'):
+            self._registrar_lucro()
+            self.salvar_dados()
+
+    def _executar_adiado(self):
+        # Ciclo do escritor em segundo plano; uma transação aberta em outra thread segura a trava até o commit
+        with self._trava:
+            if self._lucros_adiados:
+                self._lucros_adiados = False
+                with metricas.medir('gestor_calcular_lucros_segundos'):
+                    self._registrar_lucro()
+            self.salvar_dados(compactar=False)
+            if self.armazenamento.precisa_compactar():
+                self.compactar()
+
+    def sincronizar(self, timeout=None):
+        # Barreira para leituras que precisam do lucro e do snapshot das alterações já feitas. Dentro de uma
+        # transação não espera: a trava está com quem a abriu, e o escritor só roda depois do commit
+        if self.escritor is None or self._em_transacao:
+            return True
+        return self.escritor.sincronizar(timeout)
+
+    def _registrar_lucro(self):
+        # A série de lucros fica em reais, calculada a partir dos contadores exatos em centavos. O último ponto
+        # é lido antes dos totais: no backend indexado a leitura grava as mutações pendentes, e essa gravação
+        # pode rebasear os contadores sobre o que outro processo gravou
+        ultimo_lucro = self._ultimo_lucro()
+        total_faturamento = self.total_faturamento()
+        total_custos = self.calcular_total_custos()
+
+        agregados = self.agregados_efetivos()
+        lucro = (agregados['faturamento_total'] - agregados['custos_total']) / 100
+        hoje = datetime.now().strftime('%Y-%m-%d')
+
+        self._registrar({
+            'op': 'lucro',
+            'registro': {
+                'data': hoje,
+                'lucro': lucro,
+                'faturamento_total': total_faturamento,
+                'custos_total': total_custos
+            }
+        })
+        if ultimo_lucro is None or ultimo_lucro['data'] != hoje:
+            # A cada novo dia, reduz a resolução dos pontos antigos conforme a política de retenção
+            self._registrar({
+                'op': 'reter_lucros',
+                'hoje': hoje,
+                'dias_diarios': LUCROS_DIAS_DIARIOS,
+                'meses_retencao': LUCROS_MESES_RETENCAO
+            })
+
+    def _iterar_registros(self):
+        # (categoria, subcategoria, registro) de cada registro vivo, na ordem de inclusão; categoria None é faturamento
+        self._materializar()
+        livro = self._livro
+        for linha in livro.linhas_vivas():
+            categoria, subcat = livro.destino(linha)
+            yield categoria, subcat, livro.registro(linha)
+
+    def _usar_indices(self):
+        # Consultas no backend indexado precisam enxergar as mutações ainda pendentes
+        if self._dados is not None:
+            return False
+        if not self.armazenamento.consultas_indexadas:
+            self._materializar()
+            return False
+        self.salvar_dados()
+        return True
+
+    # Os contadores são mantidos em centavos; os totais públicos são em reais e incluem as ocorrências
+    # projetadas das regras recorrentes (ver agregados_efetivos)
+
+    def agregados_efetivos(self):
+        # Agregados do ledger somados às ocorrências das regras recorrentes ainda não materializadas até hoje.
+        # A projeção é refeita só quando o seq ou o dia mudam; sem regras, são os próprios agregados
+        with self._trava:
+            if not self.regras:
+                return self.agregados
+            chave = (self.seq, date.today().isoformat())
+            if self._projecao is None or self._projecao[0] != chave:
+                agregados = copy.deepcopy(self.agregados)
+                for regra in self.regras.values():
+                    coluna = 'Faturamento' if regra['categoria'] is None else 'Custos'
+                    por_mes = {}
+                    for data in ocorrencias_regra(regra, chave[1]):
+                        por_mes[data[:7]] = por_mes.get(data[:7], 0) + 1
+                    for mes, quantidade in por_mes.items():
+                        self._somar_agregado(agregados, coluna, quantidade * regra['centavos'], mes,
+                                             regra['categoria'], regra['subcategoria'])
+                self._projecao = (chave, agregados)
+            return self._projecao[1]
+
+    def versao(self):
+        # Chave de cache das visões do ledger: o seq e, com regras recorrentes, o dia (a projeção muda com a data)
+        return (self.seq, date.today().isoformat()) if self.regras else (self.seq,)
+
+    def total_faturamento(self):
+        return self.agregados_efetivos()['faturamento_total'] / 100
+
+    def calcular_total_custos(self):
+        return self.agregados_efetivos()['custos_total'] / 100
+
+    def distribuir_custos_porcentagem(self, categoria, porcentagens):
+        total = sum(p for p in porcentagens.values())
+        if abs(total - 100) > 0.01:
+            raise ValueError(f"A soma das porcentagens deve ser 100% (atual: {total}%)")
+        
+        # A base é o total antes da distribuição; as alocações não entram no cálculo das seguintes.
+        # Os centavos são repartidos por maiores restos, então as alocações somam exatamente a base
+        total_categoria = self.agregados_efetivos()['categorias'].get(categoria, {}).get('total', 0)
+        partes = distribuir_centavos(total_categoria, [Fraction(str(p)) for p in porcentagens.values()])
+        alocados = []
+        with self.transacao():
+            for (subcat, porcentagem), centavos in zip(porcentagens.items(), partes):
+                alocados.append(self._adicionar_custo(
+                    categoria, centavos, f"Alocação de {porcentagem}% para {subcat}", subcategoria=subcat))
+        return alocados
+
+    def calcular_total_categoria(self, categoria):
+        categorias = self.agregados_efetivos()['categorias']
+        if categoria in categorias:
+            return categorias[categoria]['total'] / 100
+        return 0
+
+    def calcular_total_subcategoria(self, categoria, subcategoria):
+        categorias = self.agregados_efetivos()['categorias']
+        if categoria in categorias:
+            return categorias[categoria]['subcategorias'].get(subcategoria, 0) / 100
+        return 0
+
+    def categorias(self):
+        return list(self.agregados_efetivos()['categorias'].keys())
+
+    def totais_por_categoria(self):
+        return {categoria: dados['total'] / 100 for categoria, dados in self.agregados_efetivos()['categorias'].items()}
+
+    def totais_categorias(self):
+        # Total de cada categoria e de cada subcategoria, em reais
+        return {categoria: {'total': dados['total'] / 100,
+                            'subcategorias': {subcat: total / 100 for subcat, total in dados['subcategorias'].items()}}
+                for categoria, dados in self.agregados_efetivos()['categorias'].items()}
+
+    def totais_mensais(self):
+        return {mes: {coluna: total / 100 for coluna, total in valores.items()}
+                for mes, valores in self.agregados_efetivos()['meses'].items()}
+
+    def colunas_registros(self):
+        # Registros achatados em colunas paralelas, prontos para montar um DataFrame
+        if self._usar_indices():
+            return self.armazenamento.colunas_registros()
+
+        colunas = self._livro.colunas()
+        metricas.incrementar('gestor_registros_lidos_total', len(colunas['id']), origem='colunas')
+        return colunas
+
+    def quadro_registros(self):
+        # DataFrame dos registros (tipo, categoria, subcategoria, descricao, valor, data, id) para a análise
+        if self._usar_indices():
+            return quadro_de_colunas(self.armazenamento.colunas_registros())
+        quadro = self._livro.quadro()
+        metricas.incrementar('gestor_registros_lidos_total', len(quadro), origem='colunas')
+        return quadro
+
+    def quadro_periodo(self, inicio, fim):
+        # Com o ledger ainda não lido, só os registros do período saem do snapshot binário; None quando
+        # não há esse atalho e a análise deve filtrar o quadro completo
+        with self._trava:
+            if self._resumo is None:
+                return None
+            livro = self.armazenamento.ler_periodo(inicio, fim, self.seq)
+            return livro.quadro() if livro is not None else None
+
+    def blocos_registros(self, inicio=None, fim=None, tamanho_bloco=TAMANHO_BLOCO_EXPORTACAO):
+        # Registros do período em ordem de data, em DataFrames de até tamanho_bloco linhas (colunas de
+        # quadro_registros). Só a cópia compacta do período é feita sob a trava; os blocos são montados
+        # fora dela, e alterações feitas durante a leitura não entram
+        with self._trava:
+            indexado = self._resumo is None and self._usar_indices()
+            livro = None
+            if not indexado and self._resumo is not None:
+                livro = self.armazenamento.ler_periodo(inicio, fim, self.seq)
+            if not indexado and livro is None:
+                self._materializar()
+                livro = self._livro.recorte(self._livro.linhas_periodo(inicio, fim))
+        if indexado:
+            yield from self.armazenamento.blocos_registros(inicio, fim, tamanho_bloco)
+            return
+        linhas = livro.linhas_por_data()
+        for inicio_bloco in range(0, len(linhas), tamanho_bloco):
+            yield livro.quadro(linhas[inicio_bloco:inicio_bloco + tamanho_bloco])
+
+    def remover_registros(self, ids):
+        # Remoção em lote por id: uma única gravação e um único recálculo de lucro
+        removidos = []
+        with self.transacao():
+            for id_registro in ids:
+                removido = self.remover_registro(id_registro)
+                if removido:
+                    removidos.append(removido)
+        return removidos
+
+    def incluir_registros(self, lancamentos):
+        # Inclusão em lote (importação): lancamentos é um iterável de (categoria, subcategoria, centavos,
+        # descricao, data), categoria None para faturamento. Tudo numa transação: uma única gravação e um
+        # único recálculo de lucro, e nada é gravado se a iteração falhar no meio. Retorna quantos entraram
+        incluidos = 0
+        with self.transacao():
+            for categoria, subcategoria, centavos, descricao, data in lancamentos:
+                registro = self._novo_registro(centavos, descricao, data)
+                if categoria is None:
+                    self._registrar({'op': 'add_faturamento', 'registro': registro})
+                else:
+                    self._registrar({'op': 'add_custo', 'categoria': categoria, 'subcategoria': subcategoria,
+                                     'registro': registro})
+                incluidos += 1
+            if incluidos:
+                self.calcular_lucros()
+        return incluidos
+
+    def adicionar_regra(self, valor, descricao, categoria=None, subcategoria=None, frequencia='mensal',
+                        inicio=None, fim=None):
+        # Regra recorrente (aluguel, folha, assinaturas; categoria None é faturamento) guardada uma única vez.
+        # Suas ocorrências até hoje entram nos totais, no lucro e na análise sem gravar um registro por
+        # ocorrência; fechar_periodo() as materializa no ledger. inicio e fim ('AAAA-MM-DD') são inclusivos
+        if frequencia not in FREQUENCIAS_RECORRENCIA:
+            raise ValueError(f"Frequência inválida: {frequencia} (use {', '.join(FREQUENCIAS_RECORRENCIA)})")
+        inicio = date.fromisoformat(inicio or datetime.now().strftime('%Y-%m-%d')).isoformat()
+        fim = date.fromisoformat(fim).isoformat() if fim else None
+        if fim is not None and fim < inicio:
+            raise ValueError("O fim da regra é anterior ao início")
+        regra = self._registrar({'op': 'add_regra', 'regra': {
+            'id': novo_id(),
+            'categoria': categoria,
+            'subcategoria': subcategoria if categoria is not None and subcategoria else None,
+            'centavos': para_centavos(valor),
+            'descricao': descricao,
+            'frequencia': frequencia,
+            'inicio': inicio,
+            'fim': fim,
+            'fechado_ate': None
+        }})
+        self.calcular_lucros()
+        return com_valor(regra)
+
+    def atualizar_regra(self, id_regra, **campos):
+        # Campos aceitos: valor, descricao e fim (None: sem fim). Valem para as ocorrências ainda não
+        # materializadas; as de períodos fechados já são registros comuns
+        invalidos = set(campos) - {'valor', 'descricao', 'fim'}
+        if invalidos:
+            raise ValueError(f"Campos inválidos: {', '.join(sorted(invalidos))}")
+        if 'valor' in campos:
+            campos['centavos'] = para_centavos(campos.pop('valor'))
+        if campos.get('fim'):
+            campos['fim'] = date.fromisoformat(campos['fim']).isoformat()
+            regra = self.regras.get(id_regra)
+            if regra is not None and campos['fim'] < regra['inicio']:
+                raise ValueError("O fim da regra é anterior ao início")
+
+        atualizada = self._registrar({'op': 'upd_regra', 'id': id_regra, 'campos': campos})
+        if atualizada:
+            self.calcular_lucros()
+            return com_valor(atualizada)
+        return None
+
+    def remover_regra(self, id_regra):
+        # Deixa de projetar ocorrências; as já materializadas continuam no ledger
+        removida = self._registrar({'op': 'rem_regra', 'id': id_regra})
+        if removida:
+            self.calcular_lucros()
+            return com_valor(removida)
+        return None
+
+    def regras_recorrentes(self):
+        return [com_valor(regra) for regra in self.regras.values()]
+
+    def fechar_periodo(self, ate=None):
+        # Materializa no ledger as ocorrências das regras até `ate` (padrão: último dia do mês anterior), numa
+        # única operação do journal; as seguintes continuam só projetadas. Retorna quantos registros incluiu
+        hoje = date.today()
+        ate = pd.Timestamp(ate).strftime('%Y-%m-%d') if ate else (hoje.replace(day=1) - timedelta(days=1)).isoformat()
+        if ate > hoje.isoformat():
+            raise ValueError("Só é possível fechar períodos até hoje")
+        if not self.regras:
+            return 0
+        op = self._registrar({'op': 'fechar_regras', 'ate': ate})
+        self.salvar_dados()
+        return len(op['inclusoes'])
+
+    def quadro_recorrentes(self, inicio=None, fim=None):
+        # Ocorrências projetadas das regras em [inicio, fim], limitado a hoje, com as colunas de quadro_registros
+        # e os ids que terão quando o período for fechado; None quando não há nenhuma
+        hoje = date.today().isoformat()
+        fim = hoje if fim is None else min(pd.Timestamp(fim).strftime('%Y-%m-%d'), hoje)
+        colunas = {'tipo': [], 'categoria': [], 'subcategoria': [], 'descricao': [], 'valor': [], 'centavos': [],
+                   'data': [], 'id': []}
+        for regra in list(self.regras.values()):
+            for data in ocorrencias_regra(regra, fim, inicio):
+                colunas['tipo'].append('Faturamento' if regra['categoria'] is None else 'Custo')
+                colunas['categoria'].append(regra['categoria'])
+                colunas['subcategoria'].append(regra['subcategoria'])
+                colunas['descricao'].append(regra['descricao'])
+                colunas['valor'].append(regra['centavos'] / 100)
+                colunas['centavos'].append(regra['centavos'])
+                colunas['data'].append(data)
+                colunas['id'].append(id_ocorrencia(regra['id'], data))
+        return quadro_de_colunas(colunas) if colunas['id'] else None
+
+    def series_mensais(self):
+        # Séries mensais em centavos, do primeiro mês com registros até o mês corrente: faturamento e os custos
+        # de cada categoria, com as ocorrências projetadas das regras recorrentes. Retorna (series, 'AAAA-MM' do
+        # primeiro mês), ou ({...vazias}, None) sem registros. Com o índice segmentado em dia, nada do ledger é lido
+        with self._trava:
+            somas = None
+            if self._resumo is not None:
+                somas = self.armazenamento.somas_por_mes_categoria(self.seq)
+            if somas is None:
+                if self._usar_indices():
+                    somas = self.armazenamento.somas_por_mes_categoria()
+                else:
+                    somas = self._livro.somas_por_mes_categoria()
+            hoje = date.today().isoformat()
+            for regra in self.regras.values():
+                for data in ocorrencias_regra(regra, hoje):
+                    chave = (data[:7], regra['categoria'])
+                    somas[chave] = somas.get(chave, 0) + regra['centavos']
+
+        somas = {chave: total for chave, total in somas.items() if total}
+        series = {'Faturamento': [], 'Custos': {}}
+        if not somas:
+            return series, None
+        primeiro = min(mes for mes, _ in somas)
+        base = indice_mes(primeiro)
+        quantidade = max(indice_mes(max(mes for mes, _ in somas)), indice_mes(hoje[:7])) - base + 1
+        series['Faturamento'] = [0] * quantidade
+        for categoria in sorted({categoria for _, categoria in somas if categoria is not None}):
+            series['Custos'][categoria] = [0] * quantidade
+        for (mes, categoria), total in somas.items():
+            lista = series['Faturamento'] if categoria is None else series['Custos'][categoria]
+            lista[indice_mes(mes) - base] += total
+        return series, primeiro
+
+    def analise(self):
+        if self._analise is None:
+            self._analise = AnaliseFinanceira(self)
+        return self._analise
+
+    def ultimos_faturamentos(self, n=5):
+        if self._resumo is not None and n <= REGISTROS_NO_RESUMO:
+            ultimos = self._resumo['ultimos_faturamentos']
+            return [com_valor(registro) for registro in ultimos[max(len(ultimos) - n, 0):]]
+        if self._usar_indices():
+            return [com_valor(registro) for registro in self.armazenamento.ultimos_faturamentos(n)]
+        return [com_valor(registro) for registro in self._livro.ultimos_faturamentos(n)]
+
+    def ultimos_custos(self, n=5):
+        if self._resumo is not None and n <= REGISTROS_NO_RESUMO:
+            return self._resumo['ultimos_custos'][:n]
+        if self._usar_indices():
+            return self.armazenamento.ultimos_custos(n)
+        return self._livro.ultimos_custos(n)
+
+    def _lucros(self):
+        # Série de lucros do ledger lido ou, antes da leitura, do manifesto do snapshot binário
+        if self._resumo is not None:
+            return self._resumo['lucros']
+        self._materializar()
+        return self._dados['lucros']
+
+    def ultimo_lucro(self):
+        self.sincronizar()
+        return self._ultimo_lucro()
+
+    def _ultimo_lucro(self):
+        if self._dados is None and self.armazenamento.consultas_indexadas:
+            self.salvar_dados()
+            return self.armazenamento.ultimo_lucro()
+        lucros = self._lucros()
+        return lucros[-1] if lucros else None
+
+    def historico_lucros(self, n=None):
+        self.sincronizar()
+        if self._dados is None and self.armazenamento.consultas_indexadas:
+            self.salvar_dados()
+            return self.armazenamento.historico_lucros(n)
+        lucros = self._lucros()
+        return lucros[-n:] if n else list(lucros)
+
+def quadro_de_colunas(colunas):
+    # Colunas paralelas de colunas_registros() -> DataFrame com os tipos usados pela análise
+    df = pd.DataFrame(colunas)
+    df['tipo'] = df['tipo'].astype('category')
+    df['categoria'] = df['categoria'].astype('category')
+    df['subcategoria'] = df['subcategoria'].astype('category')
+    df['valor'] = df['valor'].astype('float64')
+    df['centavos'] = df['centavos'].astype('int64')
+    df['data'] = pd.to_datetime(df['data'], format='%Y-%m-%d')
+    return df
+
+def juntar_quadros(df, extra):
+    # Quadro da análise + ocorrências projetadas com as mesmas colunas (None: nenhuma); a coluna projetado marca
+    # as linhas que ainda não estão no ledger. As colunas categóricas passam antes para as mesmas categorias:
+    # com categorias diferentes, pd.concat as converteria em object
+    df = df.assign(projetado=False)
+    if extra is None:
+        return df
+    tipos = {coluna: pd.CategoricalDtype(df[coluna].cat.categories.union(extra[coluna].cat.categories))
+             for coluna in ('tipo', 'categoria', 'subcategoria')}
+    return pd.concat([df.astype(tipos), extra.assign(projetado=True).astype(tipos)], ignore_index=True)
+
+def indice_mes(mes):
+    # 'AAAA-MM' -> meses desde o ano 0; o resto da divisão por 12 é o mês do calendário (0 é janeiro)
+    return int(mes[:4]) * 12 + int(mes[5:7]) - 1
+
+def texto_mes(indice):
+    return f'{indice // 12:04d}-{indice % 12 + 1:02d}'
+
+def _linhas_series(series):
+    # (categoria, valores) de cada série; categoria None é faturamento
+    yield None, series['Faturamento']
+    yield from series['Custos'].items()
+
+def _chave_series(series, inicio, ate):
+    # Impressão digital do histórico até o mês `ate`: se mudar (lançamento retroativo), o ajuste é refeito.
+    # Séries zeradas até lá ficam de fora, para que uma categoria nova não invalide o ajuste das outras
+    quantidade = indice_mes(ate) - indice_mes(inicio) + 1
+    texto = json.dumps([inicio] + [[categoria, valores[:quantidade]] for categoria, valores in _linhas_series(series)
+                                   if any(valores[:quantidade])])
+    return hashlib.sha1(texto.encode()).hexdigest()
+
+def suavizar_series(valores, mes_inicial, n, nivel, tendencia, sazonal):
+    # Holt-Winters aditivo com tendência amortecida, vetorizado: cada linha de `valores` (séries x meses, a partir
+    # de mes_inicial) é uma série, e NaN marca os meses que a linha não processa. O estado (n observações, nível,
+    # tendência e os 12 índices sazonais por mês do calendário) é atualizado no lugar. Enquanto a série tem menos
+    # de um ano, os índices sazonais ficam em zero; no primeiro ano em que são atualizados, cada índice é a média
+    # dos desvios vistos (peso 1/k) e depois segue o peso PREVISAO_GAMA
+    alfa, beta, gama, fi = PREVISAO_ALFA, PREVISAO_BETA, PREVISAO_GAMA, PREVISAO_AMORTECIMENTO
+    for coluna in range(valores.shape[1]):
+        x = valores[:, coluna]
+        ativo = ~np.isnan(x)
+        mes = (mes_inicial + coluna) % 12
+        inicio = ativo & (n == 0)
+        nivel[inicio] = x[inicio]
+        tendencia[inicio] = 0.0
+
+        seguir = ativo & (n > 0)
+        s = sazonal[:, mes]
+        novo_nivel = alfa * (x - s) + (1 - alfa) * (nivel + fi * tendencia)
+        nova_tendencia = beta * (novo_nivel - nivel) + (1 - beta) * fi * tendencia
+        peso = np.maximum(gama, 1.0 / np.maximum((n - 12) // 12 + 1, 1))
+        atualizar_sazonal = seguir & (n >= 12)
+        sazonal[atualizar_sazonal, mes] = (peso * (x - novo_nivel) + (1 - peso) * s)[atualizar_sazonal]
+        nivel[seguir] = novo_nivel[seguir]
+        tendencia[seguir] = nova_tendencia[seguir]
+        n += ativo
+
+def ajustar_previsoes(tarefas, mes_fechado, horizonte=PREVISAO_HORIZONTE):
+    # Previsões de vários ledgers num só ajuste vetorizado. Cada tarefa é (series, inicio, estado) com as séries
+    # de series_mensais() e o estado devolvido no ajuste anterior (ou None). Só os meses até mes_fechado
+    # (índice de indice_mes) entram no modelo; se o histórico já ajustado não mudou, o ajuste continua do estado
+    # guardado e só os meses fechados desde então são processados. Retorna [(estado, previsao)] na ordem das
+    # tarefas; a previsão traz os meses seguintes a mes_fechado, com valores em centavos
+    linhas = []
+    for posicao, (series, inicio, estado) in enumerate(tarefas):
+        if inicio is None or indice_mes(inicio) > mes_fechado:
+            continue
+        base = indice_mes(inicio)
+        anteriores = {}
+        desde = base
+        if (estado is not None and estado['inicio'] == inicio and indice_mes(estado['mes']) <= mes_fechado
+                and estado['chave'] == _chave_series(series, inicio, estado['mes'])):
+            anteriores = {linha[0]: linha for linha in estado['linhas']}
+            desde = indice_mes(estado['mes']) + 1
+        for categoria, valores in _linhas_series(series):
+            # Categoria que apareceu depois do último ajuste: a série é processada desde o início
+            linha_desde = desde if categoria in anteriores else base
+            linhas.append((posicao, categoria, valores[linha_desde - base:mes_fechado - base + 1],
+                           linha_desde, anteriores.get(categoria)))
+
+    quantidade = len(linhas)
+    primeira_coluna = min((linha[3] for linha in linhas), default=mes_fechado + 1)
+    valores = np.full((quantidade, max(mes_fechado - primeira_coluna + 1, 0)), np.nan)
+    n = np.zeros(quantidade, dtype=np.int64)
+    nivel, tendencia = np.zeros(quantidade), np.zeros(quantidade)
+    sazonal = np.zeros((quantidade, 12))
+    for i, (_, _, serie, desde, anterior) in enumerate(linhas):
+        valores[i, desde - primeira_coluna:desde - primeira_coluna + len(serie)] = serie
+        if anterior is not None:
+            n[i], nivel[i], tendencia[i] = anterior[1], anterior[2], anterior[3]
+            sazonal[i] = anterior[4]
+    suavizar_series(valores, primeira_coluna, n, nivel, tendencia, sazonal)
+
+    passos = np.arange(1, horizonte + 1)
+    meses = mes_fechado + passos
+    previstos = (nivel[:, None] + tendencia[:, None] * np.cumsum(PREVISAO_AMORTECIMENTO ** passos)[None, :]
+                 + np.where((n >= 24)[:, None], sazonal[:, meses % 12], 0.0))
+    previstos = np.where((n > 0)[:, None], np.maximum(np.rint(previstos), 0), 0).astype(np.int64)
+
+    resultados = []
+    for series, inicio, _ in tarefas:
+        resultados.append(({'inicio': inicio, 'mes': texto_mes(mes_fechado), 'linhas': [],
+                            'chave': _chave_series(series, inicio, texto_mes(mes_fechado)) if inicio else None},
+                           {'meses': [texto_mes(mes) for mes in meses.tolist()], 'Faturamento': [0] * horizonte,
+                            'Custos': {}}))
+    for i, (posicao, categoria, _, _, _) in enumerate(linhas):
+        estado, previsao = resultados[posicao]
+        estado['linhas'].append([categoria, int(n[i]), float(nivel[i]), float(tendencia[i]), sazonal[i].tolist()])
+        if categoria is None:
+            previsao['Faturamento'] = previstos[i].tolist()
+        else:
+            previsao['Custos'][categoria] = previstos[i].tolist()
+    return resultados
+
+class AnaliseFinanceira:
+    # Ledger achatado em um DataFrame colunar, com as ocorrências projetadas das regras recorrentes;
+    # só é reconstruído quando a versão do sistema (seq e, com regras, o dia) muda
+    def __init__(self, sistema):
+        self.sistema = sistema
+        self._versao = None
+        self._df = None
+        self._ordenado = None
+        self._recorte = None
+        self._ajuste = None
+
+    def dataframe(self):
+        versao = self.sistema.versao()
+        if self._df is None or self._versao != versao:
+            inicio = time.perf_counter()
+            df = juntar_quadros(self.sistema.quadro_registros(), self.sistema.quadro_recorrentes())
+            df['mes'] = df['data'].to_numpy().astype('datetime64[M]')
+            self._df = df
+            self._ordenado = None
+            self._versao = versao
+            metricas.observar('gestor_analise_dataframe_segundos', time.perf_counter() - inicio)
+        return self._df
+
+    def _periodo(self, inicio, fim):
+        # Recorte do período lido direto do snapshot, quando o sistema ainda não leu o ledger inteiro;
+        # guarda só o último recorte
+        chave = (self.sistema.versao(), inicio, fim)
+        if self._recorte is not None and self._recorte[0] == chave:
+            return self._recorte[1]
+        df = self.sistema.quadro_periodo(inicio, fim)
+        if df is None:
+            return None
+        df = juntar_quadros(df, self.sistema.quadro_recorrentes(inicio, fim))
+        df['mes'] = df['data'].to_numpy().astype('datetime64[M]')
+        self._recorte = (chave, df)
+        return df
+
+    def _por_data(self):
+        # Cópia ordenada por data: o filtro de período vira uma busca binária
+        df = self.dataframe()
+        if self._ordenado is None:
+            self._ordenado = df.sort_values('data', kind='stable', ignore_index=True)
+        return self._ordenado
+
+    def consultar_registros(self, tipo=None, inicio=None, fim=None, categoria=None, busca=None,
+                            pagina=0, tamanho_pagina=50, decrescente=True, projetados=True):
+        # Retorna só a página pedida e o total de registros que passam pelos filtros; projetados=False deixa de
+        # fora as ocorrências projetadas das regras recorrentes, que ainda não estão no ledger
+        df = self._por_data()
+        datas = df['data']
+        primeiro = datas.searchsorted(pd.Timestamp(inicio), 'left') if inicio is not None else 0
+        ultimo = datas.searchsorted(pd.Timestamp(fim), 'right') if fim is not None else len(df)
+        df = df.iloc[primeiro:ultimo]
+
+        if tipo:
+            df = df[df['tipo'] == tipo]
+        if categoria:
+            df = df[df['categoria'] == categoria]
+        if busca:
+            df = df[df['descricao'].str.contains(busca, case=False, regex=False, na=False)]
+        if not projetados:
+            df = df[~df['projetado']]
+
+        total = len(df)
+        if decrescente:
+            fim_pagina = total - pagina * tamanho_pagina
+            pagina_df = df.iloc[max(fim_pagina - tamanho_pagina, 0):max(fim_pagina, 0)].iloc[::-1]
+        else:
+            pagina_df = df.iloc[pagina * tamanho_pagina:(pagina + 1) * tamanho_pagina]
+        return pagina_df, total
+
+    def _filtrar(self, inicio=None, fim=None):
+        if inicio is not None or fim is not None:
+            df = self._periodo(inicio, fim)
+            if df is not None:
+                return df
+        df = self.dataframe()
+        if inicio is not None:
+            df = df[df['data'] >= pd.Timestamp(inicio)]
+        if fim is not None:
+            df = df[df['data'] <= pd.Timestamp(fim)]
+        return df
+
+    def mensal(self, inicio=None, fim=None):
+        if inicio is None and fim is None:
+            # Sem filtro de período os contadores mensais já mantidos pelo sistema bastam
+            df = pd.DataFrame.from_dict(self.sistema.totais_mensais(), orient='index',
+                                        columns=['Faturamento', 'Custos'], dtype='float64')
+            df.index = pd.to_datetime(df.index, format='%Y-%m')
+        else:
+            # Soma exata em centavos (int64); só o resultado é convertido para reais
+            df = (self._filtrar(inicio, fim)
+                  .groupby(['mes', 'tipo'], observed=True)['centavos'].sum()
+                  .unstack('tipo', fill_value=0)
+                  .reindex(columns=['Faturamento', 'Custo'], fill_value=0)
+                  .rename(columns={'Custo': 'Custos'})
+                  .rename_axis(index=None, columns=None)) / 100
+            df = df[(df['Faturamento'] != 0) | (df['Custos'] != 0)]
+        df['Lucro'] = df['Faturamento'] - df['Custos']
+        return df.sort_index().rename_axis('Mês').reset_index()
+
+    def por_categoria(self, inicio=None, fim=None):
+        if inicio is None and fim is None:
+            totais = self.sistema.totais_por_categoria()
+            return pd.DataFrame({'Categoria': list(totais.keys()), 'Valor': list(totais.values())},
+                                columns=['Categoria', 'Valor'])
+        custos = self._filtrar(inicio, fim)
+        custos = custos[custos['tipo'] == 'Custo']
+        return ((custos.groupby('categoria', observed=True)['centavos'].sum() / 100)
+                .rename_axis('Categoria').reset_index(name='Valor'))
+
+    def por_subcategoria(self, inicio=None, fim=None):
+        custos = self._filtrar(inicio, fim)
+        custos = custos[custos['tipo'] == 'Custo']
+        subcategorias = custos['subcategoria'].cat.add_categories(['(direto)']).fillna('(direto)')
+        return ((custos.groupby([custos['categoria'], subcategorias], observed=True)['centavos'].sum() / 100)
+                .rename_axis(['Categoria', 'Subcategoria']).reset_index(name='Valor'))
+
+    def _previsao(self, horizonte):
+        # Refeita só quando a versão do sistema ou o último mês fechado mudam; o estado do ajuste anterior
+        # é reaproveitado, então a virada do mês processa só o mês que fechou
+        mes_fechado = indice_mes(date.today().isoformat()[:7]) - 1
+        chave = (self.sistema.versao(), mes_fechado, horizonte)
+        if self._ajuste is not None and self._ajuste[0] == chave:
+            return self._ajuste[2]
+        series, inicio = self.sistema.series_mensais()
+        estado = self._ajuste[1] if self._ajuste is not None else None
+        [(estado, previsao)] = ajustar_previsoes([(series, inicio, estado)], mes_fechado, horizonte)
+        self._ajuste = (chave, estado, previsao)
+        return previsao
+
+    def previsao_mensal(self, horizonte=PREVISAO_HORIZONTE):
+        return quadro_previsao(self._previsao(horizonte))
+
+    def previsao_categorias(self, horizonte=PREVISAO_HORIZONTE):
+        return quadro_previsao_categorias(self._previsao(horizonte))
+
+def quadro_previsao(previsao):
+    # Mesmo formato de AnaliseFinanceira.mensal (Mês, Faturamento, Custos e Lucro em reais), para os meses previstos
+    custos = np.sum(list(previsao['Custos'].values()), axis=0) if previsao['Custos'] else 0
+    df = pd.DataFrame({'Mês': pd.to_datetime(previsao['meses'], format='%Y-%m'),
+                       'Faturamento': np.asarray(previsao['Faturamento'], dtype='float64') / 100,
+                       'Custos': np.zeros(len(previsao['meses'])) + np.asarray(custos, dtype='float64') / 100})
+    df['Lucro'] = df['Faturamento'] - df['Custos']
+    return df
+
+def quadro_previsao_categorias(previsao):
+    # Custos previstos por categoria em formato longo: Mês, Categoria e Valor em reais
+    meses = pd.to_datetime(previsao['meses'], format='%Y-%m')
+    categorias = list(previsao['Custos'])
+    valores = np.asarray([previsao['Custos'][categoria] for categoria in categorias], dtype='float64').reshape(-1)
+    return pd.DataFrame({'Mês': np.tile(meses, len(categorias)),
+                         'Categoria': np.repeat(categorias, len(meses)),
+                         'Valor': valores / 100}, columns=['Mês', 'Categoria', 'Valor'])
+
+def reduzir_serie(df, colunas, max_pontos=MAX_PONTOS_SERIE):
+    # Série longa -> no máximo max_pontos linhas: divide em faixas e, em cada uma, mantém as linhas de
+    # mínimo e máximo de cada coluna (picos e vales continuam visíveis), além da primeira e da última
+    if len(df) <= max_pontos:
+        return df
+    faixas = max((max_pontos - 2) // (2 * len(colunas)), 1)
+    limites = np.linspace(1, len(df) - 1, faixas + 1).astype(np.int64)
+    manter = [0, len(df) - 1]
+    for coluna in colunas:
+        valores = df[coluna].to_numpy()
+        for inicio, fim in zip(limites[:-1], limites[1:]):
+            if fim > inicio:
+                manter.append(inicio + int(np.argmin(valores[inicio:fim])))
+                manter.append(inicio + int(np.argmax(valores[inicio:fim])))
+    return df.iloc[np.unique(manter)].reset_index(drop=True)
+
+class CacheGraficos:
+    # Dados agregados e figuras serializadas dos gráficos, com despejo LRU por memória. A chave inclui
+    # o usuário e o seq do ledger, então uma alteração nunca devolve um gráfico antigo: as entradas da
+    # versão anterior só deixam de ser usadas e saem pelo despejo. Os valores são compartilhados entre
+    # sessões e não devem ser alterados por quem os recebe
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._itens = OrderedDict()
+        self._bytes = 0
+        self._trava = threading.Lock()
+        self.acertos = 0
+        self.falhas = 0
+        self.despejos = 0
+
+    @staticmethod
+    def _tamanho(valor):
+        if isinstance(valor, pd.DataFrame):
+            return int(valor.memory_usage(index=True, deep=True).sum())
+        if isinstance(valor, (str, bytes)):
+            return len(valor)
+        return sys.getsizeof(valor)
+
+    def obter(self, chave, construir):
+        with self._trava:
+            item = self._itens.get(chave)
+            if item is not None:
+                self._itens.move_to_end(chave)
+                self.acertos += 1
+            else:
+                self.falhas += 1
+        metricas.incrementar('gestor_cache_graficos_total', resultado='acerto' if item is not None else 'falha')
+        if item is not None:
+            return item[0]
+
+        # Construído fora da trava: duas sessões podem montar o mesmo gráfico, e a segunda só o substitui
+        valor = construir()
+        tamanho = self._tamanho(valor)
+        with self._trava:
+            if tamanho > self.max_bytes:
+                return valor
+            anterior = self._itens.pop(chave, None)
+            if anterior is not None:
+                self._bytes -= anterior[1]
+            self._itens[chave] = (valor, tamanho)
+            self._bytes += tamanho
+            while self._bytes > self.max_bytes:
+                _, (_, tamanho_despejado) = self._itens.popitem(last=False)
+                self._bytes -= tamanho_despejado
+                self.despejos += 1
+        return valor
+
+    def estatisticas(self):
+        with self._trava:
+            return {
+                'acertos': self.acertos,
+                'falhas': self.falhas,
+                'despejos': self.despejos,
+                'itens_em_cache': len(self._itens),
+                'bytes': self._bytes
+            }
+
+# Categoria usada para custos importados que não casam com nenhuma regra
+CATEGORIA_PADRAO_IMPORTACAO = 'Não categorizado'
+
+def converter_valor(texto):
+    # Aceita "1234.56", "1.234,56" e "R$ -1.234,56"; Decimal preserva os centavos exatos do extrato
+    texto = texto.replace('R$', '').replace(' ', '').strip()
+    if ',' in texto:
+        texto = texto.replace('.', '').replace(',', '.')
+    try:
+        return Decimal(texto)
+    except InvalidOperation:
+        raise ValueError(f"valor inválido: {texto!r}") from None
+
+def converter_data(texto):
+    # Aceita "2024-01-31", "31/01/2024" e o formato OFX "20240131120000[-3:BRT]"
+    texto = texto.strip()
+    try:
+        if '/' in texto:
+            dia, mes, ano = texto[:10].split('/')
+            return date(int(ano), int(mes), int(dia)).isoformat()
+        if '-' in texto[:10]:
+            return date.fromisoformat(texto[:10]).isoformat()
+        return date(int(texto[:4]), int(texto[4:6]), int(texto[6:8])).isoformat()
+    except ValueError:
+        raise ValueError(f"data inválida: {texto!r}") from None
+
+def ler_csv(arquivo):
+    # Colunas: tipo (faturamento/custo, opcional), valor, descricao, data, categoria, subcategoria
+    cabecalho = arquivo.readline()
+    arquivo.seek(0)
+    leitor = csv.DictReader(arquivo, delimiter=';' if cabecalho.count(';') > cabecalho.count(',') else ',')
+    for numero, linha in enumerate(leitor, start=2):
+        yield numero, {(chave or '').strip().lower(): (valor or '').strip() for chave, valor in linha.items()}
+
+def ler_ofx(arquivo, tamanho_bloco=64 * 1024):
+    # Lê o extrato em blocos, mantendo em memória apenas a transação incompleta do fim do bloco
+    campo = re.compile(r'<(\w+)>([^<\r\n]*)')
+    buffer = ''
+    numero = 0
+    while True:
+        bloco = arquivo.read(tamanho_bloco)
+        buffer += bloco
+        while True:
+            inicio = buffer.find('<STMTTRN>')
+            fim = buffer.find('</STMTTRN>', inicio)
+            if inicio < 0 or fim < 0:
+                break
+            numero += 1
+            campos = {tag.upper(): valor.strip() for tag, valor in campo.findall(buffer[inicio + 9:fim])}
+            buffer = buffer[fim + 10:]
+            valor = campos.get('TRNAMT', '')
+            yield numero, {
+                'valor': valor,
+                'descricao': campos.get('MEMO') or campos.get('NAME', ''),
+                'data': campos.get('DTPOSTED', '')
+            }
+        if not bloco:
+            return
+        inicio = buffer.find('<STMTTRN>')
+        buffer = buffer[inicio:] if inicio >= 0 else buffer[-len('<STMTTRN>'):]
+
+class ResultadoImportacao:
+    def __init__(self):
+        self.lidas = 0
+        self.importadas = 0
+        self.total_rejeitadas = 0
+        self.rejeitadas = []
+        self.segundos = 0.0
+
+    @property
+    def linhas_por_segundo(self):
+        return self.lidas / self.segundos if self.segundos else 0.0
+
+class ImportadorLancamentos:
+    # Importa extratos lidos em fluxo: as linhas válidas entram por SistemaFinanceiro.incluir_registros, numa
+    # única escrita no backend com o lucro recalculado uma vez; um erro no meio não deixa nada gravado
+    MAX_REJEITADAS_LISTADAS = 1000
+
+    def __init__(self, sistema, regras=None):
+        self.sistema = sistema
+        self.regras = [(palavra.lower(), categoria, subcategoria) for palavra, categoria, subcategoria in (regras or [])]
+
+    def importar_csv(self, arquivo):
+        return self.importar(ler_csv(arquivo))
+
+    def importar_ofx(self, arquivo):
+        return self.importar(ler_ofx(arquivo))
+
+    def importar(self, linhas):
+        resultado = ResultadoImportacao()
+        inicio = time.perf_counter()
+        resultado.importadas = self.sistema.incluir_registros(self._validas(linhas, resultado))
+        resultado.segundos = time.perf_counter() - inicio
+        metricas.observar('gestor_importacao_segundos', resultado.segundos)
+        metricas.incrementar('gestor_importacao_linhas_total', resultado.importadas, resultado='importada')
+        metricas.incrementar('gestor_importacao_linhas_total', resultado.total_rejeitadas, resultado='rejeitada')
+        return resultado
+
+    def _validas(self, linhas, resultado):
+        # Lançamentos convertidos; as linhas inválidas só são contadas (e listadas, até o limite)
+        for numero, linha in linhas:
+            resultado.lidas += 1
+            try:
+                lancamento = self._converter(linha)
+            except (ValueError, KeyError) as erro:
+                resultado.total_rejeitadas += 1
+                if len(resultado.rejeitadas) < self.MAX_REJEITADAS_LISTADAS:
+                    resultado.rejeitadas.append((numero, str(erro)))
+                continue
+            yield lancamento
+
+    def _converter(self, linha):
+        valor = converter_valor(linha['valor'])
+        descricao = linha.get('descricao', '')
+        data = converter_data(linha['data'])
+        tipo = linha.get('tipo', '').lower()
+        if tipo not in ('', 'faturamento', 'receita', 'custo', 'despesa'):
+            raise ValueError(f"tipo inválido: {tipo!r}")
+        if not tipo:
+            tipo = 'custo' if valor < 0 else 'faturamento'
+        centavos = abs(para_centavos(valor))
+        if centavos == 0:
+            raise ValueError("valor zerado")
+
+        if tipo in ('faturamento', 'receita'):
+            return None, None, centavos, descricao, data
+
+        categoria, subcategoria = linha.get('categoria'), linha.get('subcategoria') or None
+        if not categoria:
+            categoria, subcategoria = self._classificar(descricao)
+        return categoria, subcategoria, centavos, descricao, data
+
+    def _classificar(self, descricao):
+        descricao = descricao.lower()
+        for palavra, categoria, subcategoria in self.regras:
+            if palavra in descricao:
+                return categoria, subcategoria
+        return CATEGORIA_PADRAO_IMPORTACAO, None
+
+# Exportação: lançamentos (mesmas colunas aceitas por ImportadorLancamentos, mais o id e se a linha é uma ocorrência
+# projetada de regra recorrente) ou totais mensais
+FORMATOS_EXPORTACAO = ('csv', 'xlsx', 'parquet')
+COLUNAS_LANCAMENTOS = ['data', 'tipo', 'categoria', 'subcategoria', 'descricao', 'valor', 'id', 'projetado']
+COLUNAS_MENSAL = ['mes', 'faturamento', 'custos', 'lucro']
+
+# Linhas de dados por planilha no XLSX (o limite do formato é 1.048.576, contando o cabeçalho)
+LINHAS_POR_PLANILHA = 1048575
+
+def _blocos_lancamentos(sistema, inicio, fim, tamanho_bloco):
+    # Como o relatório, inclui as ocorrências projetadas das regras recorrentes (projetado = True), intercaladas
+    # por data com os blocos do ledger
+    tipos = {'tipo': object, 'categoria': object, 'subcategoria': object}
+    recorrentes = sistema.quadro_recorrentes(inicio, fim)
+    if recorrentes is not None:
+        recorrentes = recorrentes.assign(projetado=True)[COLUNAS_LANCAMENTOS].astype(tipos)
+        recorrentes = recorrentes.sort_values('data', kind='stable', ignore_index=True)
+    for bloco in sistema.blocos_registros(inicio, fim, tamanho_bloco):
+        bloco = bloco.assign(projetado=False)[COLUNAS_LANCAMENTOS].astype(tipos)
+        if recorrentes is not None and len(bloco):
+            antes = int(recorrentes['data'].searchsorted(bloco['data'].iloc[-1], 'right'))
+            if antes:
+                bloco = pd.concat([bloco, recorrentes.iloc[:antes]], ignore_index=True)
+                bloco = bloco.sort_values('data', kind='stable', ignore_index=True)
+                recorrentes = recorrentes.iloc[antes:]
+        yield bloco
+    if recorrentes is not None and len(recorrentes):
+        yield recorrentes
+
+def _blocos_mensal(sistema, inicio, fim, tamanho_bloco):
+    # Sem período os contadores mensais já bastam; com período, as somas são acumuladas bloco a bloco.
+    # Os dois incluem as ocorrências projetadas das regras recorrentes, como a análise
+    if inicio is None and fim is None:
+        totais = {mes: (valores['Faturamento'], valores['Custos'])
+                  for mes, valores in sistema.agregados_efetivos()['meses'].items()}
+    else:
+        totais = {}
+        recorrentes = sistema.quadro_recorrentes(inicio, fim)
+        for bloco in itertools.chain(sistema.blocos_registros(inicio, fim, tamanho_bloco),
+                                     [recorrentes] if recorrentes is not None else []):
+            somas = bloco.groupby([bloco['data'].dt.strftime('%Y-%m'), 'tipo'], observed=True)['centavos'].sum()
+            for (mes, tipo), centavos in somas.items():
+                faturamento, custos = totais.get(mes, (0, 0))
+                totais[mes] = (faturamento + centavos, custos) if tipo == 'Faturamento' else (faturamento, custos + centavos)
+    meses = sorted(totais)
+    yield pd.DataFrame({
+        'mes': meses,
+        'faturamento': [totais[mes][0] / 100 for mes in meses],
+        'custos': [totais[mes][1] / 100 for mes in meses],
+        'lucro': [(totais[mes][0] - totais[mes][1]) / 100 for mes in meses]
+    }, columns=COLUNAS_MENSAL)
+
+def _escrever_csv(f, blocos, colunas):
+    texto = io.TextIOWrapper(f, encoding='utf-8', newline='')
+    linhas = 0
+    texto.write(','.join(colunas) + '\n')
+    for bloco in blocos:
+        bloco.to_csv(texto, header=False, index=False, date_format='%Y-%m-%d', lineterminator='\n')
+        linhas += len(bloco)
+    texto.flush()
+    texto.detach()
+    return linhas
+
+def _escrever_xlsx(f, blocos, colunas, titulo):
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise ValueError("a exportação em XLSX requer o pacote openpyxl")
+    # Modo write_only: as linhas vão direto para o arquivo, sem manter a planilha em memória
+    planilhas = Workbook(write_only=True)
+    planilha, linhas, na_planilha = None, 0, LINHAS_POR_PLANILHA
+    for bloco in blocos:
+        if 'data' in bloco:
+            bloco = bloco.assign(data=bloco['data'].dt.date)
+        for linha in bloco.astype(object).where(bloco.notna(), None).itertuples(index=False, name=None):
+            if na_planilha == LINHAS_POR_PLANILHA:
+                numero = len(planilhas.worksheets) + 1
+                planilha = planilhas.create_sheet(titulo if numero == 1 else f'{titulo} ({numero})')
+                planilha.append(colunas)
+                na_planilha = 0
+            planilha.append(linha)
+            na_planilha += 1
+            linhas += 1
+    if planilha is None:
+        planilhas.create_sheet(titulo).append(colunas)
+    planilhas.save(f)
+    return linhas
+
+def _escrever_parquet(f, blocos, colunas):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("a exportação em Parquet requer o pacote pyarrow")
+    tipos = {'data': pa.date32(), 'valor': pa.float64(), 'faturamento': pa.float64(), 'custos': pa.float64(),
+             'lucro': pa.float64(), 'projetado': pa.bool_()}
+    esquema = pa.schema([(coluna, tipos.get(coluna, pa.string())) for coluna in colunas])
+    linhas = 0
+    # Um row group por bloco
+    with pq.ParquetWriter(f, esquema) as escritor:
+        for bloco in blocos:
+            escritor.write_table(pa.Table.from_pandas(bloco, preserve_index=False).cast(esquema))
+            linhas += len(bloco)
+    return linhas
+
+def exportar(sistema, destino, formato='csv', conteudo='lancamentos', inicio=None, fim=None,
+             tamanho_bloco=TAMANHO_BLOCO_EXPORTACAO):
+    # Grava os lançamentos ou os totais mensais do período em `destino` (caminho ou arquivo binário aberto),
+    # bloco a bloco; retorna a quantidade de linhas exportadas
+    if formato not in FORMATOS_EXPORTACAO:
+        raise ValueError(f"formato inválido: {formato!r} (use {', '.join(FORMATOS_EXPORTACAO)})")
+    if conteudo == 'lancamentos':
+        blocos, colunas, titulo = _blocos_lancamentos(sistema, inicio, fim, tamanho_bloco), COLUNAS_LANCAMENTOS, 'Lançamentos'
+    elif conteudo == 'mensal':
+        blocos, colunas, titulo = _blocos_mensal(sistema, inicio, fim, tamanho_bloco), COLUNAS_MENSAL, 'Mensal'
+    else:
+        raise ValueError(f"conteúdo inválido: {conteudo!r} (use lancamentos ou mensal)")
+
+    linhas = []
+    def escrever(f):
+        if formato == 'csv':
+            linhas.append(_escrever_csv(f, blocos, colunas))
+        elif formato == 'xlsx':
+            linhas.append(_escrever_xlsx(f, blocos, colunas, titulo))
+        else:
+            linhas.append(_escrever_parquet(f, blocos, colunas))
+
+    with metricas.medir('gestor_exportacao_segundos', formato=formato, conteudo=conteudo):
+        if isinstance(destino, (str, os.PathLike)):
+            gravar_atomico(destino, escrever, modo='wb')
+        else:
+            escrever(destino)
+    metricas.incrementar('gestor_exportacao_linhas_total', linhas[0], formato=formato)
+    return linhas[0]
+
+class CacheLedgers:
+    # Cache compartilhado entre sessões, reruns e requisições, com despejo LRU por quantidade e memória
+    def __init__(self, max_usuarios=64, max_bytes=256 * 1024 * 1024):
+        self.max_usuarios = max_usuarios
+        self.max_bytes = max_bytes
+        self._sistemas = OrderedDict()
+        self._trava = threading.Lock()
+        self.acertos = 0
+        self.falhas = 0
+        self.invalidacoes = 0
+        self.despejos = 0
+
+    def obter(self, usuario):
+        with self._trava:
+            sistema = self._sistemas.get(usuario)
+            if sistema is not None and not sistema.desatualizado():
+                self._sistemas.move_to_end(usuario)
+                self.acertos += 1
+                metricas.incrementar('gestor_cache_ledgers_total', resultado='acerto')
+                return sistema
+            if sistema is not None:
+                self.invalidacoes += 1
+                metricas.incrementar('gestor_cache_ledgers_total', resultado='invalidacao')
+            self.falhas += 1
+            metricas.incrementar('gestor_cache_ledgers_total', resultado='falha')
+
+        sistema = SistemaFinanceiro(usuario)
+        with self._trava:
+            self._sistemas[usuario] = sistema
+            self._sistemas.move_to_end(usuario)
+            self._despejar()
+        return sistema
+
+    def _despejar(self):
+        tamanhos = {usuario: sistema.tamanho_estimado() for usuario, sistema in self._sistemas.items()}
+        total = sum(tamanhos.values())
+        while self._sistemas and (len(self._sistemas) > self.max_usuarios or total > self.max_bytes):
+            usuario, _ = self._sistemas.popitem(last=False)
+            total -= tamanhos[usuario]
+            self.despejos += 1
+            metricas.incrementar('gestor_cache_ledgers_total', resultado='despejo')
+
+    def invalidar(self, usuario=None):
+        with self._trava:
+            if usuario is None:
+                self._sistemas.clear()
+            else:
+                self._sistemas.pop(usuario, None)
+
+    def estatisticas(self):
+        with self._trava:
+            return {
+                'acertos': self.acertos,
+                'falhas': self.falhas,
+                'invalidacoes': self.invalidacoes,
+                'despejos': self.despejos,
+                'usuarios_em_cache': len(self._sistemas),
+                'bytes_estimados': sum(s.tamanho_estimado() for s in self._sistemas.values())
+            }
+
+def versoes_arquivos(diretorio='dados_usuarios'):
+    # {usuario: [[arquivo, mtime_ns, tamanho], ...]} com os arquivos de dados de cada usuário, numa só
+    # varredura do diretório; qualquer gravação (snapshot, journal, banco ou índice de segmentos) muda a versão
+    versoes = {}
+    if not os.path.isdir(diretorio):
+        return versoes
+    for entrada in os.scandir(diretorio):
+        if entrada.name.endswith('_segmentos') and entrada.is_dir():
+            try:
+                info = os.stat(os.path.join(entrada.path, 'indice.json'))
+            except FileNotFoundError:
+                continue
+            usuario, arquivo = entrada.name[:-len('_segmentos')], 'indice.json'
+        elif '_dados.' in entrada.name and not entrada.name.endswith(('.lock', '.tmp')):
+            usuario, arquivo = entrada.name.rsplit('_dados.', 1)
+            info = entrada.stat()
+        else:
+            continue
+        versoes.setdefault(usuario, []).append([arquivo, info.st_mtime_ns, info.st_size])
+    for arquivos in versoes.values():
+        arquivos.sort()
+    return versoes
+
+def agregados_vazios():
+    return {'unidade': 'centavos', 'faturamento_total': 0, 'custos_total': 0, 'categorias': {}, 'meses': {}}
+
+def somar_agregados(total, parcial):
+    # Acumula em `total` os agregados (em centavos) de outro ledger
+    total['faturamento_total'] += parcial['faturamento_total']
+    total['custos_total'] += parcial['custos_total']
+    for categoria, dados in parcial['categorias'].items():
+        destino = total['categorias'].setdefault(categoria, {'total': 0, 'subcategorias': {}})
+        destino['total'] += dados['total']
+        for subcategoria, centavos in dados['subcategorias'].items():
+            destino['subcategorias'][subcategoria] = destino['subcategorias'].get(subcategoria, 0) + centavos
+    for mes, valores in parcial['meses'].items():
+        destino = total['meses'].setdefault(mes, {'Faturamento': 0, 'Custos': 0})
+        destino['Faturamento'] += valores['Faturamento']
+        destino['Custos'] += valores['Custos']
+    return total
+
+@contextmanager
+def sistema_somente_leitura(usuario, diretorio='dados_usuarios'):
+    # Ledger aberto para relatórios e rotinas em lote: trava compartilhada, nada é gravado (nem a compactação
+    # de snapshots legados) e a conexão SQLite é fechada mesmo se a leitura falhar
+    armazenamento = armazenamento_existente(usuario, diretorio, somente_leitura=True)
+    try:
+        yield SistemaFinanceiro(usuario, armazenamento, segundo_plano=False, somente_leitura=True)
+    finally:
+        if isinstance(armazenamento, ArmazenamentoSQLite):
+            armazenamento.conexao.close()
+
+def _parcial_usuario(usuario, diretorio):
+    # Roda nos processos do pool: só os agregados do ledger voltam para o processo principal. Com regras
+    # recorrentes eles incluem a projeção até hoje, que só vale no dia do cálculo
+    with sistema_somente_leitura(usuario, diretorio) as sistema:
+        return {'agregados': sistema.agregados_efetivos(),
+                'dia': date.today().isoformat() if sistema.regras else None}
+
+def _series_usuario(usuario, diretorio):
+    # Roda nos processos do pool: só as séries mensais do ledger voltam para o processo principal, com o dia
+    # do cálculo quando há regras recorrentes (a projeção delas muda com a data)
+    with sistema_somente_leitura(usuario, diretorio) as sistema:
+        series, inicio = sistema.series_mensais()
+        return series, inicio, date.today().isoformat() if sistema.regras else None
+
+class RelatorioConsolidado:
+    # Visão consolidada de todos os usuários. Os agregados de cada ledger (parciais) são calculados em paralelo
+    # num pool de processos e guardados em disco com a versão dos arquivos do usuário: uma nova execução só
+    # recalcula quem mudou desde a anterior. Os processos são criados com spawn, já que o processo principal
+    # (Streamlit, API) tem threads
+    def __init__(self, diretorio='dados_usuarios', workers=None):
+        self.diretorio = diretorio
+        self.workers = workers or os.cpu_count() or 2
+        self.arquivo_parciais = os.path.join(diretorio, 'consolidado_parciais.json')
+        self.agregados = agregados_vazios()
+        self.parciais = {}
+        self.recalculados = []
+
+    def _ler_parciais(self):
+        if not os.path.exists(self.arquivo_parciais):
+            return {}
+        try:
+            with open(self.arquivo_parciais, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning('Cache de parciais ilegível em %s; recalculando todos os usuários', self.arquivo_parciais)
+            return {}
+
+    def atualizar(self):
+        with metricas.medir('gestor_consolidado_segundos'):
+            versoes = versoes_arquivos(self.diretorio)
+            guardados = self._ler_parciais()
+            hoje = date.today().isoformat()
+            pendentes = sorted(usuario for usuario, versao in versoes.items()
+                               if guardados.get(usuario, {}).get('versao') != versao
+                               or guardados[usuario].get('dia') not in (None, hoje))
+
+            parciais = {usuario: guardados[usuario] for usuario in versoes if usuario not in pendentes}
+            if len(pendentes) > 1 and self.workers > 1:
+                contexto = multiprocessing.get_context('spawn')
+                with ProcessPoolExecutor(max_workers=min(self.workers, len(pendentes)), mp_context=contexto) as pool:
+                    calculados = pool.map(_parcial_usuario, pendentes, itertools.repeat(self.diretorio),
+                                          chunksize=max(len(pendentes) // (self.workers * 4), 1))
+                    calculados = list(calculados)
+            else:
+                calculados = [_parcial_usuario(usuario, self.diretorio) for usuario in pendentes]
+            # A versão é a lida antes do cálculo: se o usuário gravou no meio, a próxima execução recalcula
+            for usuario, parcial in zip(pendentes, calculados):
+                parciais[usuario] = dict(parcial, versao=versoes[usuario])
+
+            if pendentes or len(parciais) != len(guardados):
+                gravar_atomico(self.arquivo_parciais, lambda f: json.dump(parciais, f, separators=(',', ':')))
+
+            total = agregados_vazios()
+            for parcial in parciais.values():
+                somar_agregados(total, parcial['agregados'])
+            self.agregados = total
+            self.parciais = parciais
+            self.recalculados = pendentes
+            metricas.incrementar('gestor_consolidado_usuarios_total', len(pendentes), resultado='recalculado')
+            metricas.incrementar('gestor_consolidado_usuarios_total', len(parciais) - len(pendentes), resultado='cache')
+        return self
+
+    def totais(self):
+        faturamento = self.agregados['faturamento_total'] / 100
+        custos = self.agregados['custos_total'] / 100
+        return {'usuarios': len(self.parciais), 'faturamento_total': faturamento, 'custos_total': custos,
+                'lucro': round(faturamento - custos, 2)}
+
+    def totais_categorias(self):
+        return {categoria: {'total': dados['total'] / 100,
+                            'subcategorias': {subcat: total / 100 for subcat, total in dados['subcategorias'].items()}}
+                for categoria, dados in self.agregados['categorias'].items()}
+
+    def mensal(self):
+        # Mesmo formato de AnaliseFinanceira.mensal: Mês, Faturamento, Custos e Lucro em reais
+        df = pd.DataFrame.from_dict(self.agregados['meses'], orient='index',
+                                    columns=['Faturamento', 'Custos'], dtype='float64') / 100
+        df.index = pd.to_datetime(df.index, format='%Y-%m')
+        df['Lucro'] = df['Faturamento'] - df['Custos']
+        return df.sort_index().rename_axis('Mês').reset_index()
+
+    def por_usuario(self):
+        return pd.DataFrame([
+            {'Usuário': usuario,
+             'Faturamento': parcial['agregados']['faturamento_total'] / 100,
+             'Custos': parcial['agregados']['custos_total'] / 100,
+             'Lucro': (parcial['agregados']['faturamento_total'] - parcial['agregados']['custos_total']) / 100}
+            for usuario, parcial in sorted(self.parciais.items())
+        ], columns=['Usuário', 'Faturamento', 'Custos', 'Lucro'])
+
+class LotePrevisoes:
+    # Previsões de fluxo de caixa de todos os usuários, para a rotina noturna. As séries de quem mudou desde a
+    # execução anterior são lidas em paralelo (como no RelatorioConsolidado) e todas as previsões pendentes são
+    # ajustadas num único cálculo vetorizado; o estado do ajuste fica em disco, então a virada do mês processa
+    # só o mês que fechou, e um ledger sem mudanças e com o mesmo mês fechado nem é relido
+    def __init__(self, diretorio='dados_usuarios', workers=None, horizonte=PREVISAO_HORIZONTE):
+        self.diretorio = diretorio
+        self.workers = workers or os.cpu_count() or 2
+        self.horizonte = horizonte
+        self.arquivo = os.path.join(diretorio, 'previsoes.json')
+        self.previsoes = {}
+        self.recalculados = []
+
+    def _ler(self):
+        if not os.path.exists(self.arquivo):
+            return {}
+        try:
+            with open(self.arquivo, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning('Cache de previsões ilegível em %s; recalculando todos os usuários', self.arquivo)
+            return {}
+
+    def atualizar(self):
+        with metricas.medir('gestor_previsoes_segundos'):
+            versoes = versoes_arquivos(self.diretorio)
+            guardados = self._ler()
+            hoje = date.today().isoformat()
+            mes_fechado = indice_mes(hoje[:7]) - 1
+            pendentes = sorted(usuario for usuario, versao in versoes.items()
+                               if guardados.get(usuario, {}).get('versao') != versao
+                               or guardados[usuario]['mes'] != texto_mes(mes_fechado)
+                               or guardados[usuario]['horizonte'] != self.horizonte
+                               or guardados[usuario]['dia'] not in (None, hoje))
+
+            previsoes = {usuario: guardados[usuario] for usuario in versoes if usuario not in pendentes}
+            if len(pendentes) > 1 and self.workers > 1:
+                contexto = multiprocessing.get_context('spawn')
+                with ProcessPoolExecutor(max_workers=min(self.workers, len(pendentes)), mp_context=contexto) as pool:
+                    lidas = list(pool.map(_series_usuario, pendentes, itertools.repeat(self.diretorio),
+                                          chunksize=max(len(pendentes) // (self.workers * 4), 1)))
+            else:
+                lidas = [_series_usuario(usuario, self.diretorio) for usuario in pendentes]
+            tarefas = [(series, inicio, guardados.get(usuario, {}).get('estado'))
+                       for usuario, (series, inicio, _) in zip(pendentes, lidas)]
+            ajustes = ajustar_previsoes(tarefas, mes_fechado, self.horizonte)
+            # A versão é a lida antes do cálculo: se o usuário gravou no meio, a próxima execução recalcula
+            for usuario, (_, _, dia), (estado, previsao) in zip(pendentes, lidas, ajustes):
+                previsoes[usuario] = {'versao': versoes[usuario], 'dia': dia, 'mes': texto_mes(mes_fechado),
+                                      'horizonte': self.horizonte, 'estado': estado, 'previsao': previsao}
+
+            if pendentes or len(previsoes) != len(guardados):
+                gravar_atomico(self.arquivo, lambda f: json.dump(previsoes, f, separators=(',', ':')))
+            self.previsoes = previsoes
+            self.recalculados = pendentes
+            metricas.incrementar('gestor_previsoes_usuarios_total', len(pendentes), resultado='recalculado')
+            metricas.incrementar('gestor_previsoes_usuarios_total', len(previsoes) - len(pendentes), resultado='cache')
+        return self
+
+    def previsao(self, usuario):
+        # Mesmo formato de AnaliseFinanceira.previsao_mensal, ou None para quem não tem dados
+        if usuario not in self.previsoes:
+            return None
+        return quadro_previsao(self.previsoes[usuario]['previsao'])
+
+    def por_usuario(self):
+        # Totais previstos para o horizonte inteiro, por usuário, em reais
+        linhas = []
+        for usuario, guardado in sorted(self.previsoes.items()):
+            df = quadro_previsao(guardado['previsao'])
+            linhas.append({'Usuário': usuario, 'Faturamento': df['Faturamento'].sum(),
+                           'Custos': df['Custos'].sum(), 'Lucro': df['Lucro'].sum()})
+        return pd.DataFrame(linhas, columns=['Usuário', 'Faturamento', 'Custos', 'Lucro'])
+
+# Custo do hash das senhas: scrypt com N=GESTOR_SCRYPT_N (memória de 128 * N * r bytes por cálculo) ou,
+# sem scrypt no OpenSSL, PBKDF2-SHA256. Mudar os parâmetros não invalida as senhas gravadas: cada hash guarda
+# os seus, e os antigos são refeitos com os atuais no próximo login
+SCRYPT_N = int(os.environ.get('GESTOR_SCRYPT_N', 2 ** 14))
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERACOES = int(os.environ.get('GESTOR_PBKDF2_ITERACOES', 600000))
+
+# Cálculos de hash simultâneos no processo: uma rajada de logins espera na fila em vez de ocupar todos os núcleos
+executor_senhas = ThreadPoolExecutor(max_workers=int(os.environ.get('GESTOR_WORKERS_SENHA', os.cpu_count() or 2)),
+                                     thread_name_prefix='gestor-senhas')
+
+def _scrypt(senha, sal, n, r, p, tamanho=32):
+    return hashlib.scrypt(senha.encode(), salt=sal, n=n, r=r, p=p, maxmem=256 * n * r, dklen=tamanho)
+
+def hash_senha(senha):
+    # 'scrypt$N$r$p$sal$hash' ou 'pbkdf2_sha256$iterações$sal$hash', com sal aleatório de 16 bytes
+    sal = secrets.token_bytes(16)
+    if hasattr(hashlib, 'scrypt'):
+        chave = _scrypt(senha, sal, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+        return f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${sal.hex()}${chave.hex()}'
+    chave = hashlib.pbkdf2_hmac('sha256', senha.encode(), sal, PBKDF2_ITERACOES)
+    return f'pbkdf2_sha256${PBKDF2_ITERACOES}${sal.hex()}${chave.hex()}'
+
+def verificar_senha(senha, armazenado):
+    # -> (confere, precisa_refazer): precisa_refazer indica um hash legado ou com parâmetros desatualizados
+    partes = armazenado.split('$')
+    if partes[0] == 'scrypt':
+        n, r, p = (int(parte) for parte in partes[1:4])
+        esperado = bytes.fromhex(partes[5])
+        calculado = _scrypt(senha, bytes.fromhex(partes[4]), n, r, p, len(esperado))
+        atual = (n, r, p) == (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    elif partes[0] == 'pbkdf2_sha256':
+        iteracoes = int(partes[1])
+        esperado = bytes.fromhex(partes[3])
+        calculado = hashlib.pbkdf2_hmac('sha256', senha.encode(), bytes.fromhex(partes[2]), iteracoes, len(esperado))
+        atual = not hasattr(hashlib, 'scrypt') and iteracoes == PBKDF2_ITERACOES
+    else:
+        # SHA-256 sem sal das versões anteriores
+        esperado = armazenado.encode()
+        calculado = hashlib.sha256(senha.encode()).hexdigest().encode()
+        atual = False
+    confere = hmac.compare_digest(calculado, esperado)
+    return confere, confere and not atual
+
+class DiretorioUsuarios:
+    # Cadastro de usuários em SQLite (busca pela chave primária, sem ler o cadastro inteiro). Na primeira
+    # abertura importa o usuarios.json das versões anteriores, mantendo os hashes SHA-256, que são refeitos
+    # no login. Os hashes rodam em executor_senhas, fora da thread de quem chama
+    ESQUEMA = '''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            email TEXT PRIMARY KEY,
+            senha TEXT NOT NULL
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS meta (
+            chave TEXT PRIMARY KEY,
+            valor
+        );
+    '''
+
+    def __init__(self, diretorio='dados_usuarios'):
+        self.diretorio = diretorio
+        if not os.path.exists(diretorio):
+            os.makedirs(diretorio)
+        self.arquivo = os.path.join(diretorio, 'usuarios.sqlite3')
+        self.conexao = sqlite3.connect(self.arquivo, timeout=30, check_same_thread=False)
+        self._trava = threading.Lock()
+        # Hash de uma senha aleatória, com os parâmetros atuais, para os logins de e-mails desconhecidos
+        self._hash_ficticio = executor_senhas.submit(hash_senha, secrets.token_hex(16))
+        with self._trava:
+            self.conexao.execute('PRAGMA journal_mode=WAL')
+            self.conexao.executescript(self.ESQUEMA)
+            self._importar_json()
+
+    def _importar_json(self):
+        caminho = os.path.join(self.diretorio, 'usuarios.json')
+        if not os.path.exists(caminho):
+            return
+        with self.conexao:
+            if self.conexao.execute("SELECT 1 FROM meta WHERE chave = 'json_importado'").fetchone():
+                return
+            with open(caminho, 'r') as f:
+                usuarios = json.load(f)
+            self.conexao.executemany('INSERT OR IGNORE INTO usuarios (email, senha) VALUES (?, ?)',
+                                     [(email, dados['senha']) for email, dados in usuarios.items()])
+            self.conexao.execute("INSERT INTO meta (chave, valor) VALUES ('json_importado', ?)", (len(usuarios),))
+
+    def _senha(self, email):
+        with self._trava:
+            linha = self.conexao.execute('SELECT senha FROM usuarios WHERE email = ?', (email,)).fetchone()
+        return linha[0] if linha else None
+
+    def existe(self, email):
+        return self._senha(email) is not None
+
+    def quantidade(self):
+        with self._trava:
+            return self.conexao.execute('SELECT count(*) FROM usuarios').fetchone()[0]
+
+    def cadastrar(self, email, senha):
+        # INSERT OR IGNORE: cadastros simultâneos do mesmo email, mesmo em processos diferentes, criam um só
+        if self.existe(email):
+            return False
+        armazenado = executor_senhas.submit(hash_senha, senha).result()
+        with self._trava, self.conexao:
+            cursor = self.conexao.execute('INSERT OR IGNORE INTO usuarios (email, senha) VALUES (?, ?)',
+                                          (email, armazenado))
+        return cursor.rowcount == 1
+
+    def importar(self, usuarios):
+        # {email: hash} já calculados (migrações, carga inicial); emails existentes são mantidos
+        with self._trava, self.conexao:
+            self.conexao.executemany('INSERT OR IGNORE INTO usuarios (email, senha) VALUES (?, ?)',
+                                     list(usuarios.items()))
+
+    def autenticar(self, email, senha):
+        armazenado = self._senha(email)
+        with metricas.medir('gestor_login_segundos'):
+            if armazenado is None:
+                # E-mail desconhecido: o hash é conferido do mesmo jeito (contra o fictício), para que o tempo
+                # de resposta não revele quais contas existem
+                executor_senhas.submit(verificar_senha, senha, self._hash_ficticio.result()).result()
+                confere, refazer = False, False
+            else:
+                confere, refazer = executor_senhas.submit(verificar_senha, senha, armazenado).result()
+            if refazer:
+                novo = executor_senhas.submit(hash_senha, senha).result()
+                # Só troca se ninguém alterou a senha enquanto o hash novo era calculado
+                with self._trava, self.conexao:
+                    self.conexao.execute('UPDATE usuarios SET senha = ? WHERE email = ? AND senha = ?',
+                                         (novo, email, armazenado))
+        metricas.incrementar('gestor_login_total',
+                             resultado='falha' if not confere else 'refeito' if refazer else 'ok')
+        return confere
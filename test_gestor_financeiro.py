@@ -0,0 +1,939 @@
+# Testes do motor do gestor financeiro: python -m pytest -q
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import sqlite3
+import threading
+from datetime import date
+from decimal import Decimal
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pandas as pd
+import pytest
+
+import api_gestor
+import gestor_financeiro as gf
+
+BACKENDS = {
+    'json': gf.ArmazenamentoJSON,
+    'binario': gf.ArmazenamentoBinario,
+    'segmentado': gf.ArmazenamentoSegmentado,
+    'sqlite': gf.ArmazenamentoSQLite,
+}
+USUARIO = 'teste@e-flow.digital'
+
+@pytest.fixture(params=list(BACKENDS))
+def abrir(request, tmp_path):
+    # Cada chamada abre uma nova instância sobre os mesmos arquivos, como outro processo ou worker faria
+    fabrica = BACKENDS[request.param]
+    diretorio = str(tmp_path / 'dados')
+    return lambda: gf.SistemaFinanceiro(USUARIO, fabrica(USUARIO, diretorio), segundo_plano=False)
+
+def abrir_json(diretorio):
+    return gf.SistemaFinanceiro(USUARIO, gf.ArmazenamentoJSON(USUARIO, str(diretorio)), segundo_plano=False)
+
+def mes_relativo(meses, dia=1):
+    return gf.somar_meses(date.today().replace(day=dia), meses).isoformat()
+
+def totais(sistema):
+    return sistema.total_faturamento(), sistema.calcular_total_custos(), sistema.totais_categorias()
+
+# Journal
+
+def test_mutacoes_vao_para_o_journal_e_sao_reaplicadas(tmp_path):
+    sistema = abrir_json(tmp_path)
+    sistema.adicionar_faturamento(1000, 'Venda', '2026-01-10')
+    custo = sistema.adicionar_custo('Estrutura', 250.5, 'Aluguel', '2026-01-12')
+    sistema.atualizar_registro(custo['id'], descricao='Aluguel de janeiro')
+
+    armazenamento = sistema.armazenamento
+    # Nenhum snapshot reescrito: uma linha de journal por mutação (a mutação e o seu ponto de lucro)
+    assert not os.path.exists(armazenamento.arquivo_snapshot)
+    with open(armazenamento.arquivo_journal, 'rb') as f:
+        assert len(f.readlines()) == 3
+
+    recarregado = abrir_json(tmp_path)
+    assert recarregado.seq == sistema.seq
+    assert totais(recarregado) == totais(sistema)
+    assert recarregado.ultimos_custos(1)[0][3] == 'Aluguel de janeiro'
+
+def test_registro_incompleto_no_fim_do_journal_e_descartado(tmp_path):
+    sistema = abrir_json(tmp_path)
+    sistema.adicionar_faturamento(300, 'Venda', '2026-02-01')
+    journal = sistema.armazenamento.arquivo_journal
+    tamanho = os.path.getsize(journal)
+    # Queda no meio de uma escrita: a última linha fica sem o fim
+    with open(journal, 'ab') as f:
+        f.write(b'{"op":"add_faturamento","registro":{"id":"00')
+
+    recarregado = abrir_json(tmp_path)
+    assert recarregado.total_faturamento() == 300.0
+    assert os.path.getsize(journal) == tamanho
+    recarregado.adicionar_faturamento(200, 'Outra venda', '2026-02-02')
+    assert abrir_json(tmp_path).total_faturamento() == 500.0
+
+def test_compactacao_grava_snapshot_e_descarta_o_journal(tmp_path, monkeypatch):
+    monkeypatch.setattr(gf, 'LIMITE_JOURNAL', 3)
+    sistema = abrir_json(tmp_path)
+    for dia in range(1, 4):
+        sistema.adicionar_custo('Pessoal', 100, f'Diária {dia}', f'2026-03-0{dia}')
+
+    armazenamento = sistema.armazenamento
+    assert os.path.exists(armazenamento.arquivo_snapshot)
+    assert not os.path.exists(armazenamento.arquivo_journal)
+    sistema.adicionar_custo('Pessoal', 100, 'Diária 4', '2026-03-04')
+
+    recarregado = abrir_json(tmp_path)
+    assert recarregado.seq == sistema.seq
+    assert recarregado.calcular_total_categoria('Pessoal') == 400.0
+    assert [custo[3] for custo in recarregado.ultimos_custos(4)] == [f'Diária {dia}' for dia in range(4, 0, -1)]
+
+# Backend SQLite
+
+def registros(sistema):
+    quadro = sistema.quadro_registros().sort_values('id').reset_index(drop=True)
+    return quadro[['id', 'tipo', 'categoria', 'subcategoria', 'descricao', 'valor', 'data']].to_dict('records')
+
+def preencher(sistema):
+    sistema.adicionar_faturamento(1200, 'Venda', '2026-01-10')
+    sistema.adicionar_custo('Pessoal', 400.35, 'Salário', '2026-01-15', subcategoria='Folha')
+    removido = sistema.adicionar_custo('Estrutura', 90, 'Internet', '2026-02-01')
+    sistema.adicionar_custo('Estrutura', 150, 'Energia', '2026-02-03')
+    sistema.remover_registro(removido['id'])
+    sistema.adicionar_regra(50, 'Assinatura', categoria='Software', inicio='2026-01-05')
+
+def test_sqlite_ida_e_volta_igual_ao_json(tmp_path):
+    diretorio = str(tmp_path)
+    sqlite = gf.SistemaFinanceiro(USUARIO, gf.ArmazenamentoSQLite(USUARIO, diretorio), segundo_plano=False)
+    json_ = gf.SistemaFinanceiro('json@e-flow.digital', gf.ArmazenamentoJSON('json@e-flow.digital', diretorio),
+                                 segundo_plano=False)
+    preencher(sqlite)
+    preencher(json_)
+    # Ids aleatórios diferentes nos dois ledgers: compara pelo conteúdo
+    sem_id = lambda sistema: sorted((r['descricao'], r['valor'], r['data']) for r in registros(sistema))
+
+    recarregado = gf.SistemaFinanceiro(USUARIO, gf.ArmazenamentoSQLite(USUARIO, diretorio), segundo_plano=False)
+    assert recarregado.armazenamento.consultas_indexadas and recarregado._dados is None
+    assert totais(recarregado) == totais(json_)
+    assert recarregado.ultimos_custos(5) == json_.ultimos_custos(5)
+    assert sem_id(recarregado) == sem_id(json_)
+    assert recarregado.regras_recorrentes() == sqlite.regras_recorrentes()
+    assert recarregado.ultimo_lucro() == json_.ultimo_lucro()
+
+def test_sqlite_aberto_antes_da_migracao_nao_esconde_o_ledger(tmp_path, monkeypatch):
+    diretorio = str(tmp_path)
+    preencher(abrir_json(diretorio))
+    esperado = totais(abrir_json(diretorio))
+    # GESTOR_ARMAZENAMENTO=sqlite antes da migração: o banco é criado vazio, mas o ledger continua no JSON
+    monkeypatch.setenv('GESTOR_ARMAZENAMENTO', 'sqlite')
+    gf.ArmazenamentoSQLite(USUARIO, diretorio).conexao.close()
+    aberto = gf.SistemaFinanceiro(USUARIO, gf.criar_armazenamento(USUARIO, diretorio), segundo_plano=False)
+    assert aberto.armazenamento.nome == 'json'
+    assert totais(aberto) == esperado
+
+    assert gf.migrar_para_sqlite(diretorio) == [USUARIO]
+    migrado = gf.SistemaFinanceiro(USUARIO, gf.criar_armazenamento(USUARIO, diretorio), segundo_plano=False)
+    assert migrado.armazenamento.nome == 'sqlite'
+    assert totais(migrado) == esperado
+    assert registros(migrado) == registros(abrir_json(diretorio))
+    # Um banco com dados não é migrado de novo, nem é trocado pelo JSON antigo
+    assert gf.migrar_para_sqlite(diretorio) == []
+    monkeypatch.setenv('GESTOR_ARMAZENAMENTO', 'json')
+    assert gf.criar_armazenamento(USUARIO, diretorio).nome == 'sqlite'
+
+def test_migracao_de_banco_em_reais_arredonda_como_para_centavos(tmp_path):
+    # Banco de antes dos ids e dos centavos: só a coluna valor, em reais
+    conexao = sqlite3.connect(str(tmp_path / f'{USUARIO}_dados.sqlite3'))
+    conexao.executescript('''
+        CREATE TABLE faturamentos (id INTEGER PRIMARY KEY, valor REAL NOT NULL, descricao TEXT, data TEXT NOT NULL);
+        CREATE TABLE custos (id INTEGER PRIMARY KEY, categoria TEXT NOT NULL, subcategoria TEXT, valor REAL NOT NULL,
+                             descricao TEXT, data TEXT NOT NULL);
+    ''')
+    valores = [2.675, 1.005, 0.285, 10.0]
+    conexao.executemany('INSERT INTO faturamentos (valor, descricao, data) VALUES (?, ?, ?)',
+                        [(valor, f'Venda {valor}', '2026-01-10') for valor in valores])
+    conexao.execute("INSERT INTO custos (categoria, valor, descricao, data) VALUES ('Taxas', 0.145, 'Tarifa', '2026-01-11')")
+    conexao.commit()
+    conexao.close()
+
+    sistema = gf.SistemaFinanceiro(USUARIO, gf.ArmazenamentoSQLite(USUARIO, str(tmp_path)), segundo_plano=False)
+    centavos = [linha[0] for linha in sistema.armazenamento.conexao.execute('SELECT centavos FROM faturamentos ORDER BY id')]
+    assert centavos == [gf.para_centavos(valor) for valor in valores] == [268, 101, 29, 1000]
+    assert sistema.calcular_total_custos() == 0.15
+    assert sistema.total_faturamento() == 13.98
+    assert sistema.verificar_agregados() == []
+
+# Totais incrementais
+
+def test_totais_incrementais_iguais_ao_recalculo_completo(abrir):
+    sistema = abrir()
+    aleatorio = random.Random(3)
+    destinos = [(None, None), ('Pessoal', 'Folha'), ('Pessoal', 'Benefícios'), ('Pessoal', None), ('Estrutura', None)]
+    vivos = []
+    for passo in range(120):
+        acao = aleatorio.random()
+        if acao < 0.55 or not vivos:
+            categoria, subcategoria = aleatorio.choice(destinos)
+            valor = aleatorio.randint(1, 100000) / 100
+            data = f'2026-{aleatorio.randint(1, 6):02d}-{aleatorio.randint(1, 28):02d}'
+            if categoria is None:
+                registro = sistema.adicionar_faturamento(valor, f'Venda {passo}', data)
+            else:
+                registro = sistema.adicionar_custo(categoria, valor, f'Custo {passo}', data, subcategoria=subcategoria)
+            vivos.append(registro['id'])
+        elif acao < 0.8:
+            campos = aleatorio.choice([{'valor': aleatorio.randint(1, 100000) / 100}, {'data': '2026-07-01'},
+                                       {'subcategoria': 'Encargos'}, {'categoria': 'Estrutura', 'subcategoria': None}])
+            sistema.atualizar_registro(aleatorio.choice(vivos), **campos)
+        else:
+            sistema.remover_registro(vivos.pop(aleatorio.randrange(len(vivos))))
+
+    assert sistema.verificar_agregados() == []
+    quadro = sistema.quadro_registros()
+    centavos = (quadro['valor'] * 100).round().astype(int)
+    assert sistema.agregados['faturamento_total'] == centavos[quadro['tipo'] == 'Faturamento'].sum()
+    assert sistema.agregados['custos_total'] == centavos[quadro['tipo'] == 'Custo'].sum()
+    recarregado = abrir()
+    assert totais(recarregado) == totais(sistema)
+    assert recarregado.verificar_agregados() == []
+
+# Série de lucros
+
+def test_serie_de_lucros_compactada_por_dia_e_por_mes():
+    pontos = [{'data': data, 'lucro': i} for i, data in enumerate(
+        ['2025-12-01', '2025-12-20', '2026-01-03', '2026-01-03', '2026-04-01', '2026-04-01', '2026-04-02'])]
+    # Até 90 dias antes de hoje, um ponto por dia; antes disso, o último ponto de cada mês
+    assert gf.compactar_serie_lucros(pontos, '2026-04-10') == [
+        {'data': '2025-12-20', 'lucro': 1}, {'data': '2026-01-03', 'lucro': 3},
+        {'data': '2026-04-01', 'lucro': 5}, {'data': '2026-04-02', 'lucro': 6}]
+    # Com retenção, os meses anteriores ao limite são descartados
+    assert [p['data'] for p in gf.compactar_serie_lucros(pontos, '2026-04-10', meses_retencao=3)] == [
+        '2026-01-03', '2026-04-01', '2026-04-02']
+
+def test_um_ponto_de_lucro_por_dia(abrir):
+    sistema = abrir()
+    for dia in range(1, 21):
+        sistema.adicionar_faturamento(100, f'Venda {dia}', f'2026-05-{dia:02d}')
+    sistema.adicionar_custo('Estrutura', 300, 'Aluguel', '2026-05-05')
+
+    hoje = date.today().isoformat()
+    assert sistema.historico_lucros() == [
+        {'data': hoje, 'lucro': 1700.0, 'faturamento_total': 2000.0, 'custos_total': 300.0}]
+    assert abrir().historico_lucros() == sistema.historico_lucros()
+
+# Cache de ledgers
+
+def test_cache_de_ledgers_invalida_quando_outro_processo_grava(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = gf.CacheLedgers(max_usuarios=2)
+    sistema = cache.obter(USUARIO)
+    sistema.adicionar_faturamento(100, 'Venda', '2026-06-01')
+    assert cache.obter(USUARIO) is sistema
+
+    # Outra instância (outro processo, outro worker) grava no mesmo ledger
+    gf.SistemaFinanceiro(USUARIO, segundo_plano=False).adicionar_faturamento(50, 'Venda de outro processo', '2026-06-02')
+    atualizado = cache.obter(USUARIO)
+    assert atualizado is not sistema
+    assert atualizado.total_faturamento() == 150.0
+
+    for outro in ('a@e-flow.digital', 'b@e-flow.digital'):
+        cache.obter(outro)
+    estatisticas = cache.estatisticas()
+    assert (estatisticas['acertos'], estatisticas['falhas'], estatisticas['invalidacoes']) == (1, 4, 1)
+    assert (estatisticas['usuarios_em_cache'], estatisticas['despejos']) == (2, 1)
+
+# Análise
+
+def test_analise_vetorizada_soma_em_centavos(abrir):
+    sistema = abrir()
+    sistema.incluir_registros([
+        (None, None, 10010, 'Venda', '2026-01-10'),
+        (None, None, 20020, 'Venda', '2026-02-10'),
+        ('Pessoal', 'Folha', 5005, 'Salário', '2026-01-15'),
+        ('Pessoal', None, 1001, 'Vale', '2026-02-15'),
+        ('Estrutura', None, 3003, 'Aluguel', '2026-02-05'),
+    ])
+    analise = sistema.analise()
+
+    mensal = analise.mensal()
+    assert mensal['Mês'].dt.strftime('%Y-%m').tolist() == ['2026-01', '2026-02']
+    assert mensal[['Faturamento', 'Custos', 'Lucro']].values.tolist() == [[100.1, 50.05, 50.05], [200.2, 40.04, 160.16]]
+    assert analise.mensal('2026-02-01', '2026-02-28').values[:, 1:].tolist() == [[200.2, 40.04, 160.16]]
+
+    assert dict(analise.por_categoria().values.tolist()) == {'Pessoal': 60.06, 'Estrutura': 30.03}
+    assert dict(analise.por_categoria('2026-02-01', None).values.tolist()) == {'Pessoal': 10.01, 'Estrutura': 30.03}
+    assert sorted(analise.por_subcategoria().values.tolist()) == [
+        ['Estrutura', '(direto)', 30.03], ['Pessoal', '(direto)', 10.01], ['Pessoal', 'Folha', 50.05]]
+
+# Importação
+
+CSV = (
+    'data,valor,descricao,tipo,categoria\n'
+    '2026-01-05,1500.00,Venda balcão,,\n'
+    '06/01/2026,"-230,50",Conta de luz,,Utilidades\n'
+    'ontem,10,Data inválida,,\n'
+    '2026-01-07,0,Zerado,,\n'
+    '2026-01-08,99.90,Aluguel sala,custo,\n'
+)
+
+def test_importacao_csv_conta_importadas_e_rejeitadas(abrir):
+    sistema = abrir()
+    regras = [('aluguel', 'Estrutura', 'Aluguel')]
+    resultado = gf.ImportadorLancamentos(sistema, regras).importar_csv(io.StringIO(CSV))
+
+    assert (resultado.lidas, resultado.importadas, resultado.total_rejeitadas) == (5, 3, 2)
+    assert [numero for numero, _ in resultado.rejeitadas] == [4, 5]
+    assert sistema.total_faturamento() == 1500.0
+    assert sistema.calcular_total_categoria('Utilidades') == 230.5
+    assert sistema.calcular_total_subcategoria('Estrutura', 'Aluguel') == 99.9
+    # Uma importação é uma só gravação com um só ponto de lucro no fim
+    assert sistema.ultimo_lucro()['lucro'] == pytest.approx(1500.0 - 230.5 - 99.9)
+    assert totais(abrir()) == totais(sistema)
+
+def test_importacao_interrompida_nao_grava_nada(abrir):
+    sistema = abrir()
+    sistema.adicionar_faturamento(100, 'Antes da importação', '2026-01-01')
+    antes = (sistema.seq, totais(sistema))
+
+    def linhas():
+        for numero in range(1, 101):
+            yield numero, {'data': '2026-02-01', 'valor': '10', 'descricao': f'Linha {numero}'}
+        raise OSError('disco cheio')
+
+    with pytest.raises(OSError):
+        gf.ImportadorLancamentos(sistema).importar(linhas())
+
+    assert (sistema.seq, totais(sistema)) == antes
+    recarregado = abrir()
+    assert (recarregado.seq, totais(recarregado)) == antes
+    assert recarregado.verificar_agregados() == []
+
+def test_importacao_ofx_em_blocos(abrir):
+    sistema = abrir()
+    transacao = '<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20260105120000<TRNAMT>-{valor}<MEMO>Tarifa {i}</STMTTRN>\n'
+    extrato = 'OFXHEADER:100\n<OFX><BANKTRANLIST>\n' + ''.join(
+        transacao.format(valor=f'{i}.25', i=i) for i in range(1, 41)) + '</BANKTRANLIST></OFX>\n'
+    # Blocos menores que uma transação: as transações cortadas entre dois blocos não se perdem
+    linhas = gf.ler_ofx(io.StringIO(extrato), tamanho_bloco=37)
+    resultado = gf.ImportadorLancamentos(sistema).importar(linhas)
+
+    assert (resultado.lidas, resultado.importadas) == (40, 40)
+    assert sistema.calcular_total_categoria(gf.CATEGORIA_PADRAO_IMPORTACAO) == sum(i + 0.25 for i in range(1, 41))
+    assert abrir().seq == sistema.seq
+
+# Transações
+
+def test_transacao_com_erro_restaura_memoria_e_disco(abrir):
+    sistema = abrir()
+    custo = sistema.adicionar_custo('Pessoal', 300, 'Salário', '2026-03-05', subcategoria='Folha')
+    antes = (sistema.seq, totais(sistema), sistema.ultimos_custos(5))
+
+    with pytest.raises(RuntimeError):
+        with sistema.transacao():
+            sistema.adicionar_faturamento(1000, 'Venda', '2026-03-06')
+            sistema.atualizar_registro(custo['id'], subcategoria='Encargos', valor=350)
+            sistema.remover_registro(custo['id'])
+            raise RuntimeError('falha no meio')
+
+    assert (sistema.seq, totais(sistema), sistema.ultimos_custos(5)) == antes
+    assert sistema.verificar_agregados() == []
+    recarregado = abrir()
+    assert (recarregado.seq, totais(recarregado)) == antes[:2]
+
+def test_transacao_no_sqlite_nao_le_o_ledger_inteiro(tmp_path):
+    abrir = lambda: gf.SistemaFinanceiro(USUARIO, gf.ArmazenamentoSQLite(USUARIO, str(tmp_path)), segundo_plano=False)
+    sistema = abrir()
+    ids = [sistema.adicionar_custo('Estrutura', 10 * i, f'Custo {i}', f'2026-04-{i:02d}')['id'] for i in range(1, 11)]
+
+    assert len(sistema.remover_registros(ids[:4] + ['0' * 16])) == 4
+    with sistema.transacao():
+        novo = sistema.adicionar_custo('Pessoal', 500, 'Salário', '2026-04-20')
+        # Mutações sobre registros que só existem (ou só mudaram) dentro da transação
+        sistema.atualizar_registro(novo['id'], valor=600, subcategoria='Folha')
+        sistema.atualizar_registro(ids[4], categoria='Pessoal')
+        assert sistema.remover_registro(ids[4])['valor'] == 50.0
+        assert sistema.remover_registro(ids[4]) is None
+        assert sistema.remover_registro(novo['id'])['valor'] == 600.0
+
+    # O ledger continua no banco: as consultas seguem indexadas
+    assert sistema._dados is None
+    assert sistema.calcular_total_custos() == sum(10 * i for i in range(6, 11))
+    assert sistema.totais_categorias()['Pessoal'] == {'total': 0.0, 'subcategorias': {}}
+    assert sistema.verificar_agregados() == []
+    assert totais(abrir()) == totais(sistema)
+
+# Paginação
+
+def test_consulta_paginada_com_filtros(abrir):
+    sistema = abrir()
+    sistema.incluir_registros(
+        [(None, None, 1000 + dia, f'Venda {dia}', f'2026-03-{dia:02d}') for dia in range(1, 31)] +
+        [('Estrutura' if dia % 2 else 'Pessoal', None, 500, f'Custo {dia}', f'2026-03-{dia:02d}') for dia in range(1, 31)])
+    analise = sistema.analise()
+
+    pagina, total = analise.consultar_registros(tipo='Faturamento', tamanho_pagina=7)
+    assert total == 30
+    assert pagina['descricao'].tolist() == [f'Venda {dia}' for dia in range(30, 23, -1)]
+    pagina, _ = analise.consultar_registros(tipo='Faturamento', pagina=4, tamanho_pagina=7)
+    assert pagina['descricao'].tolist() == ['Venda 2', 'Venda 1']
+    pagina, _ = analise.consultar_registros(tipo='Faturamento', pagina=1, tamanho_pagina=7, decrescente=False)
+    assert pagina['descricao'].tolist() == [f'Venda {dia}' for dia in range(8, 15)]
+
+    pagina, total = analise.consultar_registros(inicio='2026-03-10', fim='2026-03-19', categoria='Pessoal')
+    assert total == 5
+    assert set(pagina['data'].dt.day) == {10, 12, 14, 16, 18}
+    pagina, total = analise.consultar_registros(busca='venda 2', tamanho_pagina=100)
+    assert total == 11
+    assert analise.consultar_registros(pagina=99)[0].empty
+
+# Ids estáveis
+
+def test_ids_continuam_validos_depois_de_remocoes(abrir):
+    sistema = abrir()
+    ids = [sistema.adicionar_custo('Estrutura', 10 + i, f'Custo {i}', '2026-05-01')['id'] for i in range(6)]
+    sistema.remover_registro(ids[1])
+    sistema.remover_registro(ids[4])
+
+    recarregado = abrir()
+    # Remover um registro não desloca os demais: os ids de antes ainda apontam para os mesmos registros
+    assert recarregado.atualizar_registro(ids[5], descricao='Último')['valor'] == 15.0
+    assert recarregado.remover_registro(ids[2])['descricao'] == 'Custo 2'
+    assert recarregado.remover_registro(ids[1]) is None
+    assert sorted(abrir().quadro_registros()['descricao']) == ['Custo 0', 'Custo 3', 'Último']
+
+def test_mover_custo_remove_subcategoria_vazia(abrir):
+    sistema = abrir()
+    custo = sistema.adicionar_custo('Pessoal', 100, 'Salário', '2026-03-05', subcategoria='Folha')
+    sistema.adicionar_custo('Pessoal', 50, 'Vale', '2026-03-05', subcategoria='Benefícios')
+    sistema.atualizar_registro(custo['id'], subcategoria='Encargos')
+
+    subcategorias = sistema.totais_categorias()['Pessoal']['subcategorias']
+    assert subcategorias == {'Benefícios': 50.0, 'Encargos': 100.0}
+    assert sistema.verificar_agregados() == []
+    assert abrir().totais_categorias()['Pessoal']['subcategorias'] == subcategorias
+
+# Concorrência otimista
+
+def test_duas_instancias_mesclam_as_gravacoes(abrir):
+    primeira = abrir()
+    base = primeira.adicionar_custo('Estrutura', 80, 'Internet', '2026-04-01')
+    segunda = abrir()
+
+    primeira.adicionar_faturamento(500, 'Venda da primeira', '2026-04-02')
+    # A segunda gravou sobre uma versão antiga: o rebase reaplica a mutação dela sobre a da primeira
+    segunda.adicionar_custo('Estrutura', 20, 'Energia', '2026-04-03')
+    assert segunda.total_faturamento() == 500.0
+    assert segunda.calcular_total_custos() == 100.0
+
+    # Remoção de um registro que a outra instância já removeu é descartada no rebase
+    primeira.remover_registro(base['id'])
+    segunda.remover_registro(base['id'])
+
+    final = abrir()
+    assert (final.total_faturamento(), final.calcular_total_custos()) == (500.0, 20.0)
+    assert [custo[3] for custo in final.ultimos_custos(5)] == ['Energia']
+    assert final.verificar_agregados() == []
+    assert final.ultimo_lucro()['lucro'] == 480.0
+
+def test_gravacoes_de_varios_processos_nao_se_perdem(abrir):
+    # Threads com instâncias próprias disputam a trava do arquivo como processos diferentes
+    abrir().adicionar_faturamento(1, 'Inicial', '2026-04-01')
+    instancias = [abrir() for _ in range(4)]
+
+    def gravar(sistema, n):
+        for i in range(10):
+            sistema.adicionar_custo('Estrutura', 1, f'Custo {n}.{i}', '2026-04-02')
+
+    threads = [threading.Thread(target=gravar, args=(sistema, n)) for n, sistema in enumerate(instancias)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    final = abrir()
+    assert final.calcular_total_custos() == 40.0
+    assert len(final.quadro_registros()) == 41
+    assert final.verificar_agregados() == []
+
+# API
+
+def test_api_valida_token_e_content_length(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    usuarios = gf.DiretorioUsuarios(str(tmp_path / 'usuarios'))
+    usuarios.cadastrar(USUARIO, 'senha-forte')
+    api = api_gestor.ApiGestor(workers=2, token='segredo', usuarios=usuarios)
+    corpo = b'{"valor": 10.5, "descricao": "Venda", "data": "2026-06-01"}'
+
+    def requisicao(tamanho, token='segredo'):
+        return (f'POST /usuarios/{USUARIO}/faturamentos HTTP/1.1\r\nAuthorization: Bearer {token}\r\n'
+                f'Content-Length: {tamanho}\r\nConnection: close\r\n\r\n').encode('latin-1') + corpo
+
+    async def enviar(*requisicoes):
+        servidor = await asyncio.start_server(api.tratar_conexao, '127.0.0.1', 0)
+        porta = servidor.sockets[0].getsockname()[1]
+        respostas = []
+        async with servidor:
+            for dados in requisicoes:
+                leitor, escritor = await asyncio.open_connection('127.0.0.1', porta)
+                escritor.write(dados)
+                respostas.append((await leitor.read()).split(b'\r\n', 1)[0].decode())
+                escritor.close()
+        return respostas
+
+    respostas = asyncio.run(enviar(requisicao('abc'), requisicao('-5'), requisicao(len(corpo), token='outro'),
+                                   requisicao(len(corpo))))
+    assert respostas == ['HTTP/1.1 400 Bad Request', 'HTTP/1.1 400 Bad Request', 'HTTP/1.1 401 Unauthorized',
+                         'HTTP/1.1 201 Created']
+    assert api.cache.obter(USUARIO).total_faturamento() == 10.5
+    # A trava do usuário não sobrevive às requisições que a usaram
+    assert len(api._travas) == 0
+    with pytest.raises(ValueError):
+        api_gestor.ApiGestor(token=None, usuarios=usuarios)
+
+# Métricas
+
+def test_endpoint_de_metricas_so_na_maquina_local(tmp_path):
+    sistema = abrir_json(tmp_path)
+    sistema.adicionar_faturamento(10, 'Venda', '2026-06-01')
+    servidor = gf.iniciar_servidor_metricas(0)
+    try:
+        host, porta = servidor.server_address
+        assert host == '127.0.0.1'
+        with urlopen(f'http://127.0.0.1:{porta}/metrics') as resposta:
+            texto = resposta.read().decode('utf-8')
+        assert 'gestor_mutacoes_total{op="add_faturamento"}' in texto
+        assert 'gestor_salvar_segundos_count{backend="json"}' in texto
+        with pytest.raises(HTTPError):
+            urlopen(f'http://127.0.0.1:{porta}/outro')
+    finally:
+        servidor.shutdown()
+        servidor.server_close()
+
+# Livro colunar
+
+def test_livro_colunar_remove_purga_e_volta_ao_documento():
+    registro = lambda i, data: {'id': f'{i:016x}', 'centavos': 100 * i, 'descricao': 'Repetida' if i % 2 else None,
+                                'data': data}
+    documento = {
+        'faturamentos': [registro(i, '2026-01-0%d' % i) for i in range(1, 4)],
+        'custos': {'categorias': {'Pessoal': {'registros': [registro(4, '2026-02-01')],
+                                              'subcategorias': {'Folha': [registro(5, '2026-02-02')]}}}},
+    }
+    livro = gf.LivroColunar.de_documento(dict(documento))
+    assert len(livro) == 5
+    # Descrições internadas: o texto repetido é guardado uma vez
+    assert livro.tabela_descricoes.count('Repetida') == 1
+
+    linha = livro.localizar(f'{4:016x}')
+    assert livro.registro(linha) == registro(4, '2026-02-01')
+    assert livro.destino(linha) == ('Pessoal', None)
+    livro.remover(linha)
+    assert livro.localizar(f'{4:016x}') is None and len(livro) == 4
+    livro.adicionar(registro(6, '2026-03-01'), 'Pessoal', 'Folha')
+
+    livro.purgar()
+    assert livro.mortos == 0 and len(livro.ids) == 5
+    assert livro.registro(livro.localizar(f'{6:016x}'))['centavos'] == 600
+    assert livro.localizar('f' * 16) is None and livro.localizar('não é um id') is None
+    visao = livro.documento([], listas=False)
+    assert list(visao['faturamentos']) == documento['faturamentos']
+    assert list(visao['custos']['categorias']['Pessoal']['registros']) == []
+    assert list(visao['custos']['categorias']['Pessoal']['subcategorias']['Folha']) == [
+        registro(5, '2026-02-02'), registro(6, '2026-03-01')]
+
+# Centavos
+
+def test_para_centavos_arredonda_meio_centavo_para_cima():
+    assert [gf.para_centavos(valor) for valor in (0.29, 2.675, 1.005, '0.125', Decimal('10.994'), 7, -0.005)] == [
+        29, 268, 101, 13, 1099, 700, -1]
+    with pytest.raises(ValueError):
+        gf.para_centavos('dez reais')
+
+def test_somas_e_distribuicao_exatas(abrir):
+    sistema = abrir()
+    for _ in range(10):
+        sistema.adicionar_custo('Serviços', 0.1, 'Taxa', '2026-06-01')
+    sistema.adicionar_custo('Serviços', 0.01, 'Ajuste', '2026-06-01')
+    # Dez vezes 0,10 em float daria 0,9999999999999999
+    assert sistema.calcular_total_categoria('Serviços') == 1.01
+
+    assert gf.distribuir_centavos(100, [1, 1, 1]) == [34, 33, 33]
+    alocados = sistema.distribuir_custos_porcentagem('Serviços', {'A': 33.33, 'B': 33.33, 'C': 33.34})
+    assert sum(registro['centavos'] for registro in alocados) == 101
+    assert [registro['centavos'] for registro in alocados] == [34, 33, 34]
+    assert sistema.calcular_total_categoria('Serviços') == 2.02
+    assert sistema.verificar_agregados() == []
+
+# Snapshot binário
+
+def test_snapshot_binario_ida_e_volta_e_leitura_parcial(tmp_path):
+    diretorio = str(tmp_path)
+    preencher(abrir_json(diretorio))
+    esperado = abrir_json(diretorio)
+    abrir = lambda: gf.SistemaFinanceiro(USUARIO, gf.ArmazenamentoBinario(USUARIO, diretorio), segundo_plano=False)
+    abrir().compactar()
+    assert not os.path.exists(os.path.join(diretorio, f'{USUARIO}_dados.json'))
+
+    sistema = abrir()
+    # Totais, lucro e últimos registros saem do manifesto, sem ler as colunas do livro
+    assert sistema._dados is None
+    assert totais(sistema) == totais(esperado)
+    assert sistema.ultimos_custos(3) == esperado.ultimos_custos(3)
+    assert sistema.ultimo_lucro() == esperado.ultimo_lucro()
+    assert sorted(sistema.quadro_periodo('2026-02-01', '2026-02-28')['descricao']) == ['Energia']
+    assert sistema._dados is None
+    assert registros(sistema) == registros(esperado)
+
+def test_ledger_compactado_em_binario_continua_visivel_com_o_backend_padrao(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('GESTOR_ARMAZENAMENTO', 'binario')
+    sistema = gf.CacheLedgers().obter(USUARIO)
+    preencher(sistema)
+    sistema.compactar()
+    esperado = totais(sistema)
+
+    monkeypatch.delenv('GESTOR_ARMAZENAMENTO')
+    reaberto = gf.CacheLedgers().obter(USUARIO)
+    assert reaberto.armazenamento.nome == 'binario'
+    assert totais(reaberto) == esperado
+
+# Segmentos mensais
+
+def test_segmentos_mensais_so_regravam_os_meses_alterados(tmp_path):
+    diretorio = str(tmp_path)
+    abrir = lambda: gf.SistemaFinanceiro(USUARIO, gf.ArmazenamentoSegmentado(USUARIO, diretorio), segundo_plano=False)
+    sistema = abrir()
+    preencher(sistema)
+    sistema.compactar()
+    armazenamento = sistema.armazenamento
+    arquivos = armazenamento._ler_indice()['segmentos']
+    assert sorted(arquivos) == ['2026-01', '2026-02']
+    assert armazenamento.segmentos()['2026-02'] == {'linhas': 1, 'faturamento': 0, 'custos': 15000,
+                                                     'categorias': {'Estrutura': 15000}}
+
+    sistema.adicionar_faturamento(10, 'Venda', '2026-02-10')
+    sistema.compactar()
+    depois = armazenamento._ler_indice()['segmentos']
+    assert depois['2026-01']['arquivo'] == arquivos['2026-01']['arquivo']
+    assert depois['2026-02']['arquivo'] != arquivos['2026-02']['arquivo']
+    assert sorted(os.listdir(armazenamento.diretorio_segmentos)) == sorted(
+        ['indice.json'] + [segmento['arquivo'] for segmento in depois.values()])
+
+    recarregado = abrir()
+    assert totais(recarregado) == totais(sistema)
+    # Só os segmentos do período são lidos
+    assert sorted(recarregado.quadro_periodo('2026-02-05', None)['descricao']) == ['Venda']
+    assert registros(recarregado) == registros(sistema)
+
+def test_ledger_segmentado_continua_visivel_com_outro_backend(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('GESTOR_ARMAZENAMENTO', 'segmentado')
+    sistema = gf.CacheLedgers().obter(USUARIO)
+    preencher(sistema)
+    sistema.compactar()
+    esperado = totais(sistema)
+
+    for backend in ('json', 'binario'):
+        monkeypatch.setenv('GESTOR_ARMAZENAMENTO', backend)
+        reaberto = gf.CacheLedgers().obter(USUARIO)
+        assert reaberto.armazenamento.nome == 'segmentado'
+        assert totais(reaberto) == esperado
+
+# Últimos registros
+
+def test_ultimos_na_mesma_ordem_em_todos_os_backends(tmp_path):
+    origem = str(tmp_path / 'json')
+    sistema = gf.SistemaFinanceiro(USUARIO, gf.ArmazenamentoJSON(USUARIO, origem), segundo_plano=False)
+    # Datas fora de ordem e repetidas: o desempate é pelo id
+    datas = ['2026-03-10', '2026-01-05', '2026-03-10', '2026-02-20', '2026-01-05', '2026-03-01'] * 3
+    sistema.incluir_registros([(None, None, 100 + i, f'F{i}', data) for i, data in enumerate(datas)] +
+                              [('Custos', None, 100 + i, f'C{i}', data) for i, data in enumerate(datas)])
+    sistema.compactar()
+    esperado = ([f['descricao'] for f in sistema.ultimos_faturamentos(7)], sistema.ultimos_custos(7))
+    datas_faturamentos = [f['data'] for f in sistema.ultimos_faturamentos(7)]
+    assert datas_faturamentos == sorted(datas_faturamentos)
+    assert [custo[0] for custo in esperado[1]] == sorted((custo[0] for custo in esperado[1]), reverse=True)
+
+    for nome in ('binario', 'segmentado'):
+        diretorio = str(tmp_path / nome)
+        shutil.copytree(origem, diretorio)
+        fabrica = BACKENDS[nome]
+        gf.SistemaFinanceiro(USUARIO, fabrica(USUARIO, diretorio), segundo_plano=False).compactar()
+        outro = gf.SistemaFinanceiro(USUARIO, fabrica(USUARIO, diretorio), segundo_plano=False)
+        assert ([f['descricao'] for f in outro.ultimos_faturamentos(7)], outro.ultimos_custos(7)) == esperado
+
+    gf.migrar_para_sqlite(origem)
+    sqlite = gf.SistemaFinanceiro(USUARIO, gf.ArmazenamentoSQLite(USUARIO, origem), segundo_plano=False)
+    assert ([f['descricao'] for f in sqlite.ultimos_faturamentos(7)], sqlite.ultimos_custos(7)) == esperado
+
+# Cache de gráficos
+
+def test_cache_de_graficos_por_versao_com_despejo_lru():
+    cache = gf.CacheGraficos(max_bytes=250)
+    construidos = []
+
+    def construir(texto):
+        def montar():
+            construidos.append(texto)
+            return texto * 100
+        return montar
+
+    assert cache.obter((USUARIO, 1, 'mensal'), construir('a')) == 'a' * 100
+    assert cache.obter((USUARIO, 1, 'mensal'), construir('b')) == 'a' * 100
+    # Outra versão do ledger é outra chave: nada de gráfico antigo
+    assert cache.obter((USUARIO, 2, 'mensal'), construir('c')) == 'c' * 100
+    cache.obter((USUARIO, 2, 'categorias'), construir('d'))
+    assert construidos == ['a', 'c', 'd']
+    estatisticas = cache.estatisticas()
+    assert (estatisticas['acertos'], estatisticas['falhas'], estatisticas['despejos']) == (1, 3, 1)
+    assert estatisticas['bytes'] == 200
+    # Valores maiores que o cache inteiro são devolvidos sem entrar nele
+    assert cache.obter('grande', lambda: 'x' * 300) == 'x' * 300
+    assert cache.estatisticas()['itens_em_cache'] == 2
+
+def test_reduzir_serie_mantem_picos_e_pontas():
+    valores = [0.0] * 1000
+    valores[137], valores[642] = 50.0, -40.0
+    df = pd.DataFrame({'dia': range(1000), 'valor': valores})
+    reduzida = gf.reduzir_serie(df, ['valor'], max_pontos=40)
+    assert len(reduzida) <= 40
+    assert {0, 137, 642, 999} <= set(reduzida['dia'])
+    assert len(gf.reduzir_serie(df.head(30), ['valor'], max_pontos=40)) == 30
+
+# Usuários
+
+def test_diretorio_de_usuarios_importa_e_refaz_hashes_legados(tmp_path):
+    with open(tmp_path / 'usuarios.json', 'w') as f:
+        json.dump({'antigo@e-flow.digital': {'senha': hashlib.sha256(b'antiga').hexdigest()}}, f)
+    usuarios = gf.DiretorioUsuarios(str(tmp_path))
+    assert usuarios.quantidade() == 1
+    assert usuarios.cadastrar(USUARIO, 'nova-senha')
+    assert not usuarios.cadastrar(USUARIO, 'outra')
+
+    assert usuarios.autenticar(USUARIO, 'nova-senha')
+    assert not usuarios.autenticar(USUARIO, 'errada')
+    assert not usuarios.autenticar('ninguem@e-flow.digital', 'nova-senha')
+    # O SHA-256 sem sal é trocado por um hash com sal no primeiro login
+    assert usuarios.autenticar('antigo@e-flow.digital', 'antiga')
+    assert usuarios._senha('antigo@e-flow.digital').startswith(('scrypt$', 'pbkdf2_sha256$'))
+    assert gf.DiretorioUsuarios(str(tmp_path)).autenticar('antigo@e-flow.digital', 'antiga')
+
+# Leitura somente leitura
+
+def test_relatorio_consolidado_soma_os_ledgers_sem_gravar_neles(tmp_path):
+    diretorio = str(tmp_path / 'dados')
+    for i, fabrica in enumerate(BACKENDS.values()):
+        usuario = f'usuario{i}@e-flow.digital'
+        sistema = gf.SistemaFinanceiro(usuario, fabrica(usuario, diretorio), segundo_plano=False)
+        sistema.adicionar_faturamento(100, 'Venda', '2026-05-01')
+    # Snapshot legado, sem ids nem agregados: uma carga normal o compactaria
+    with open(os.path.join(diretorio, 'legado@e-flow.digital_dados.json'), 'w') as f:
+        json.dump({'faturamentos': [{'valor': 5.0, 'descricao': 'Antigo', 'data': '2025-01-01'}],
+                   'custos': {'categorias': {}}, 'lucros': []}, f)
+
+    antes = gf.versoes_arquivos(diretorio)
+    relatorio = gf.RelatorioConsolidado(diretorio, workers=1).atualizar()
+    assert relatorio.totais()['faturamento_total'] == 405.0
+    assert len(relatorio.por_usuario()) == 5
+    assert gf.versoes_arquivos(diretorio) == antes
+
+    with gf.sistema_somente_leitura('legado@e-flow.digital', diretorio) as sistema:
+        with pytest.raises(PermissionError):
+            sistema.adicionar_faturamento(1, 'Não deve gravar')
+
+# Exportação
+
+@pytest.mark.parametrize('formato', gf.FORMATOS_EXPORTACAO)
+def test_exportacao_em_blocos(abrir, formato, tmp_path):
+    sistema = abrir()
+    sistema.incluir_registros([(None, None, 1000 + i, f'Venda {i}', f'2026-0{1 + i % 3}-{1 + i:02d}') for i in range(25)] +
+                              [('Pessoal', 'Folha', 700, 'Salário', '2026-02-05')])
+    destino = str(tmp_path / f'lancamentos.{formato}')
+    assert gf.exportar(sistema, destino, formato, inicio='2026-02-01', fim='2026-03-31', tamanho_bloco=4) == 17
+
+    if formato == 'csv':
+        lido = pd.read_csv(destino, dtype={'id': str})
+    elif formato == 'xlsx':
+        lido = pd.read_excel(destino, dtype={'id': str})
+    else:
+        lido = pd.read_parquet(destino)
+    assert lido.columns.tolist() == gf.COLUNAS_LANCAMENTOS
+    # Em ordem de data, com o período inclusivo nas duas pontas
+    datas = pd.to_datetime(lido['data']).dt.strftime('%Y-%m-%d').tolist()
+    assert datas == sorted(datas) and datas[0] >= '2026-02-01' and datas[-1] <= '2026-03-31'
+    no_periodo = [r for r in registros(sistema) if pd.Timestamp('2026-02-01') <= r['data'] <= pd.Timestamp('2026-03-31')]
+    assert dict(zip(lido['id'], lido['valor'])) == {r['id']: r['valor'] for r in no_periodo}
+
+    mensal = str(tmp_path / f'mensal.{formato}')
+    assert gf.exportar(sistema, mensal, formato, conteudo='mensal') == 3
+    if formato == 'csv':
+        assert pd.read_csv(mensal).values.tolist() == [
+            [mes, v['Faturamento'], v['Custos'], v['Faturamento'] - v['Custos']]
+            for mes, v in sorted(sistema.totais_mensais().items())]
+
+def test_exportacao_rejeita_formato_desconhecido(tmp_path):
+    with pytest.raises(ValueError):
+        gf.exportar(abrir_json(tmp_path), str(tmp_path / 'saida.ods'), 'ods')
+
+# Escritor em segundo plano
+
+def test_escritor_em_segundo_plano_grava_lucro_e_compacta_na_sincronizacao(tmp_path, monkeypatch):
+    monkeypatch.setattr(gf, 'LIMITE_JOURNAL', 5)
+    diretorio = str(tmp_path)
+    sistema = gf.SistemaFinanceiro(USUARIO, gf.ArmazenamentoJSON(USUARIO, diretorio), segundo_plano=True)
+    for i in range(12):
+        sistema.adicionar_faturamento(100, f'Venda {i}', '2026-07-01')
+    sistema.adicionar_custo('Estrutura', 200, 'Aluguel', '2026-07-02')
+
+    # As alterações já estão no disco antes do escritor rodar
+    assert abrir_json(diretorio).total_faturamento() == 1200.0
+    assert sistema.sincronizar(timeout=10)
+    assert sistema.escritor._thread is None
+    # Uma rajada de alterações vira um só ponto de lucro, calculado sobre o estado final
+    recarregado = abrir_json(diretorio)
+    assert recarregado.historico_lucros() == [
+        {'data': date.today().isoformat(), 'lucro': 1000.0, 'faturamento_total': 1200.0, 'custos_total': 200.0}]
+    # O journal passou do limite: a compactação também saiu da thread das alterações
+    assert os.path.exists(sistema.armazenamento.arquivo_snapshot)
+    assert sistema.ultimo_lucro()['lucro'] == 1000.0
+
+# Regras recorrentes
+
+def test_regra_projetada_e_fechamento_idempotente(abrir):
+    sistema = abrir()
+    # Mensal no dia 1, há três meses: quatro ocorrências até hoje (três meses fechados e o corrente)
+    sistema.adicionar_regra(1000, 'Aluguel', categoria='Estrutura', inicio=mes_relativo(-3))
+    sistema.adicionar_faturamento(5000, 'Venda', mes_relativo(-1, 10))
+
+    assert sistema.calcular_total_custos() == 4000.0
+    assert sistema.ultimo_lucro()['lucro'] == 1000.0
+    mensal = sistema.analise().mensal()
+    assert mensal['Custos'].tolist() == [1000.0] * 4
+
+    assert sistema.fechar_periodo() == 3
+    assert sistema.fechar_periodo() == 0
+    assert sistema.calcular_total_custos() == 4000.0
+    assert len(sistema.analise().consultar_registros(tipo='Custo')[0]) == 4
+
+    recarregado = abrir()
+    assert recarregado.calcular_total_custos() == 4000.0
+    fim_mes_anterior = date.fromordinal(date.today().replace(day=1).toordinal() - 1).isoformat()
+    assert recarregado.regras_recorrentes()[0]['fechado_ate'] == fim_mes_anterior
+    assert recarregado.fechar_periodo() == 0
+
+def test_fechamento_concorrente_nao_duplica(abrir):
+    primeira = abrir()
+    primeira.adicionar_regra(100, 'Assinatura', categoria='Software', inicio=mes_relativo(-2))
+    segunda = abrir()
+
+    assert primeira.fechar_periodo() == 2
+    segunda.fechar_periodo()
+    final = abrir()
+    assert final.calcular_total_custos() == 300.0
+    assert final.verificar_agregados() == []
+
+def test_ocorrencias_projetadas_ficam_fora_da_remocao_e_entram_na_exportacao(abrir, tmp_path):
+    sistema = abrir()
+    sistema.adicionar_regra(100, 'Assinatura', categoria='Software', inicio=mes_relativo(-2))
+    lancado = sistema.adicionar_custo('Estrutura', 50, 'Energia', mes_relativo(-1, 10))
+
+    analise = sistema.analise()
+    pagina, total = analise.consultar_registros()
+    assert total == 4 and pagina['projetado'].sum() == 3
+    somente_ledger, total = analise.consultar_registros(projetados=False)
+    assert total == 1 and somente_ledger['id'].tolist() == [lancado['id']]
+
+    destino = str(tmp_path / 'lancamentos.csv')
+    assert gf.exportar(sistema, destino, tamanho_bloco=1) == 4
+    lido = pd.read_csv(destino, dtype={'id': str})
+    assert lido['data'].tolist() == sorted(lido['data'])
+    assert dict(zip(lido['id'], lido['projetado'])) == dict(zip(pagina['id'], pagina['projetado']))
+
+    # Depois do fechamento as mesmas linhas saem do ledger, com os mesmos ids
+    sistema.fechar_periodo()
+    assert gf.exportar(sistema, destino) == 4
+    fechado = pd.read_csv(destino, dtype={'id': str})
+    assert set(fechado['id']) == set(lido['id'])
+    assert fechado['projetado'].sum() == 1
+
+# Previsões
+
+def series_sinteticas(meses, categorias=('Aluguel', 'Pessoal')):
+    # Faturamento com tendência e sazonalidade de dezembro; custos quase constantes
+    inicio = '2022-01'
+    faturamento = [100000 + 500 * m + (30000 if m % 12 == 11 else 0) for m in range(meses)]
+    custos = {categoria: [20000 + 100 * i + (m % 3) * 10 for m in range(meses)]
+              for i, categoria in enumerate(categorias)}
+    return {'Faturamento': faturamento, 'Custos': custos}, inicio
+
+def test_ajuste_incremental_igual_ao_completo():
+    series, inicio = series_sinteticas(40)
+    base = gf.indice_mes(inicio)
+    [(estado, _)] = gf.ajustar_previsoes([(series, inicio, None)], base + 30)
+    [(retomado, previsao)] = gf.ajustar_previsoes([(series, inicio, estado)], base + 38, horizonte=12)
+    [(completo, esperada)] = gf.ajustar_previsoes([(series, inicio, None)], base + 38, horizonte=12)
+
+    assert previsao == esperada
+    assert retomado['chave'] == completo['chave']
+    assert previsao['meses'][0] == gf.texto_mes(base + 39)
+    assert len(previsao['Faturamento']) == 12
+    # Com dois anos de histórico a sazonalidade de dezembro aparece na previsão
+    dezembro = previsao['meses'].index('2025-12')
+    assert previsao['Faturamento'][dezembro] > max(previsao['Faturamento'][:dezembro])
+
+def test_ajuste_retomado_refaz_com_lancamento_retroativo():
+    series, inicio = series_sinteticas(30)
+    base = gf.indice_mes(inicio)
+    [(estado, _)] = gf.ajustar_previsoes([(series, inicio, None)], base + 25)
+    series['Faturamento'][3] += 50000
+    [(_, retomada)] = gf.ajustar_previsoes([(series, inicio, estado)], base + 28)
+    [(_, completa)] = gf.ajustar_previsoes([(series, inicio, None)], base + 28)
+    assert retomada == completa
+
+def test_ajuste_com_categoria_nova_e_varios_ledgers():
+    series, inicio = series_sinteticas(30, categorias=('Aluguel',))
+    base = gf.indice_mes(inicio)
+    [(estado, _)] = gf.ajustar_previsoes([(series, inicio, None)], base + 26)
+    # Categoria que só aparece depois do ajuste guardado não invalida as demais
+    series['Custos']['Marketing'] = [0] * 28 + [5000, 5000]
+    vazio = ({'Faturamento': [], 'Custos': {}}, None, None)
+    resultados = gf.ajustar_previsoes([(series, inicio, estado), vazio], base + 29)
+    [(_, completa)] = gf.ajustar_previsoes([(series, inicio, None)], base + 29)
+
+    assert resultados[0][1] == completa
+    assert resultados[1][1]['Faturamento'] == [0] * gf.PREVISAO_HORIZONTE
+    assert resultados[1][1]['Custos'] == {}
+
+def test_previsao_da_analise_usa_meses_fechados(abrir):
+    sistema = abrir()
+    sistema.incluir_registros([(None, None, 100000, 'Venda', mes_relativo(-m, 10)) for m in range(1, 13)] +
+                              [('Aluguel', None, 30000, 'Aluguel', mes_relativo(-m, 5)) for m in range(1, 13)] +
+                              [(None, None, 999999, 'Mês corrente', mes_relativo(0))])
+    df = sistema.analise().previsao_mensal(3)
+
+    assert df['Mês'].dt.strftime('%Y-%m').tolist() == [mes_relativo(m)[:7] for m in range(0, 3)]
+    assert df['Faturamento'].tolist() == [1000.0] * 3
+    assert df['Custos'].tolist() == [300.0] * 3
+    categorias = sistema.analise().previsao_categorias(3)
+    assert categorias['Categoria'].unique().tolist() == ['Aluguel']
+
+def test_lote_de_previsoes_le_os_ledgers_sem_gravar_neles(tmp_path):
+    diretorio = str(tmp_path / 'dados')
+    for i, fabrica in enumerate(BACKENDS.values()):
+        usuario = f'usuario{i}@e-flow.digital'
+        sistema = gf.SistemaFinanceiro(usuario, fabrica(usuario, diretorio), segundo_plano=False)
+        sistema.incluir_registros([(None, None, 1000 * (i + 1), 'Venda', mes_relativo(-m, 10)) for m in range(1, 7)])
+
+    antes = gf.versoes_arquivos(diretorio)
+    lote = gf.LotePrevisoes(diretorio, workers=1).atualizar()
+    assert len(lote.recalculados) == 4
+    assert gf.versoes_arquivos(diretorio) == antes
+    assert lote.previsao('usuario1@e-flow.digital')['Faturamento'].tolist() == [20.0] * gf.PREVISAO_HORIZONTE
+
+    # Sem mudanças nos ledgers a execução seguinte usa só o cache
+    assert gf.LotePrevisoes(diretorio, workers=1).atualizar().recalculados == []